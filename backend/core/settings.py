@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
+import importlib.util
 import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -42,7 +43,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
-    'django.middleware.gzip.GZipMiddleware',
+    'machineconfig.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -196,8 +197,17 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
     ],
+    # JSON (using orjson when installed) by default, see machineconfig/renderers.py
+    'DEFAULT_RENDERER_CLASSES': [
+        'machineconfig.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# MessagePack responses ("Accept: application/msgpack" or ?format=msgpack), if installed
+if importlib.util.find_spec('msgpack') is not None:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('machineconfig.renderers.MessagePackRenderer')
+
 # https://github.com/Rhumbix/django-request-logging
 MIDDLEWARE = MIDDLEWARE + (
     'request_logging.middleware.LoggingMiddleware',
@@ -224,6 +234,11 @@ LOGGING = {
             'level': 'DEBUG',  # change debug level as appropiate
             'propagate': False,
         },
+        'machineconfig': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         #'django_python3_ldap': {
         #    'handlers': ['console'],
         #    'level': 'DEBUG',
@@ -242,3 +257,64 @@ RQ_QUEUES = {
         'DEFAULT_TIMEOUT': int(os.environ.get('RQ_DEFAULT_TIMEOUT', '60')),
     },
 }
+
+# Diagnostic tools (ping, traceroute, host, dig) run as RQ jobs on one queue per tool,
+# so that a handful of slow traceroutes cannot starve the web workers. The number of
+# "manage.py rqworker tools_<name>" processes started for each queue caps how many of
+# that tool run at once; this setting caps how many jobs may be waiting or running
+# before new submissions are rejected with HTTP 429 Too Many Requests.
+TOOLS_MAX_INFLIGHT = {
+    'ping': int(os.environ.get('TOOLS_MAX_INFLIGHT_PING', '32')),
+    'traceroute': int(os.environ.get('TOOLS_MAX_INFLIGHT_TRACEROUTE', '8')),
+    'host': int(os.environ.get('TOOLS_MAX_INFLIGHT_HOST', '32')),
+    'dig': int(os.environ.get('TOOLS_MAX_INFLIGHT_DIG', '32')),
+}
+
+for tool in TOOLS_MAX_INFLIGHT:
+    RQ_QUEUES[f'tools_{tool}'] = dict(RQ_QUEUES['default'])
+
+# Nameserver used by the in-process DNS resolver (tools_resolve). When this is
+# not set, the first nameserver in /etc/resolv.conf is used.
+DNS_RESOLVER_NAMESERVER = os.environ.get('DNS_RESOLVER_NAMESERVER', None)
+
+# Maximum number of "ping" processes run in parallel by a single batch "alive" request.
+# Every device of a Site should be pinged at once: the pool is sized to the number of
+# devices (up to this limit), so that the whole batch answers within one ping deadline.
+ALIVE_MAX_WORKERS = int(os.environ.get('ALIVE_MAX_WORKERS', '512'))
+
+# The ipmitool program used for all IPMI operations (can be pointed at a simulator for testing)
+IPMITOOL_COMMAND = os.environ.get('IPMITOOL_COMMAND', '/usr/bin/ipmitool')
+
+# Delay (in seconds) between each machine during a bulk IPMI power on, so that every
+# machine at a site does not start drawing inrush current at the same instant
+IPMI_POWER_ON_STAGGER = float(os.environ.get('IPMI_POWER_ON_STAGGER', '2.0'))
+
+# Puppet batch coordinators (see machineconfig/puppet.py) run on their own queue, and
+# need their own "manage.py rqworker puppet_batch" process, so that they never occupy
+# the default queue workers which run the individual "puppet agent --test" jobs.
+RQ_QUEUES['puppet_batch'] = dict(RQ_QUEUES['default'])
+
+# SSH access to managed hosts (see machineconfig/remote.py). All commands to the same
+# host share one multiplexed master connection, started on its own, which is closed
+# after SSH_CONTROL_PERSIST seconds without any use.
+SSH_USER = os.environ.get('SSH_USER', 'eng')
+SSH_IDENTITY_FILE = os.environ.get('SSH_IDENTITY_FILE', '/app/ssh/id_rsa')
+SSH_CONNECT_TIMEOUT = int(os.environ.get('SSH_CONNECT_TIMEOUT', '15'))
+SSH_CONTROL_DIR = os.environ.get('SSH_CONTROL_DIR', '/tmp/serverbuild-ssh')
+SSH_CONTROL_PERSIST = int(os.environ.get('SSH_CONTROL_PERSIST', '300'))
+
+# Retention (in days) of each history table, enforced by "manage.py prune_history"
+# (see machineconfig/retention.py). Old rows are deleted in small batches, so that
+# no single statement holds locks for long. A value of 0 keeps the rows forever.
+# Retention is opt-in: only the History table is pruned by default (it always was,
+# after 7 days); set the other values to start pruning those tables.
+HISTORY_RETENTION_DAYS = {
+    'history': int(os.environ.get('HISTORY_RETENTION_DAYS_HISTORY', '7')),
+    'boot_history': int(os.environ.get('HISTORY_RETENTION_DAYS_BOOT_HISTORY', '0')),
+    'build_history': int(os.environ.get('HISTORY_RETENTION_DAYS_BUILD_HISTORY', '0')),
+    'unrecognized_pxe_device': int(os.environ.get('HISTORY_RETENTION_DAYS_UNRECOGNIZED_PXE_DEVICE', '0')),
+    'remote_job': int(os.environ.get('HISTORY_RETENTION_DAYS_REMOTE_JOB', '0')),
+    'job_output': int(os.environ.get('HISTORY_RETENTION_DAYS_JOB_OUTPUT', '0')),
+    'history_rollup_hourly': int(os.environ.get('HISTORY_RETENTION_DAYS_HISTORY_ROLLUP_HOURLY', '0')),
+}
+HISTORY_RETENTION_BATCH_SIZE = int(os.environ.get('HISTORY_RETENTION_BATCH_SIZE', '5000'))
@@ -26,16 +26,22 @@ from machineconfig.views import tftp_default
 from machineconfig.views import kickstart
 
 from machineconfig.api_views import lcogtinstruments
+from machineconfig.api_views import jobs_output
 from machineconfig.api_views import tools_ping
 from machineconfig.api_views import tools_host
 from machineconfig.api_views import tools_dig
 from machineconfig.api_views import tools_traceroute
+from machineconfig.api_views import tools_resolve
+from machineconfig.api_views import search_view
 
 from machineconfig.viewsets import SiteViewSet
 from machineconfig.viewsets import NetworkDeviceViewSet
 from machineconfig.viewsets import UnrecognizedPXEDeviceViewSet
 from machineconfig.viewsets import BootHistoryViewSet
 from machineconfig.viewsets import BuildHistoryViewSet
+from machineconfig.viewsets import RemoteJobViewSet
+from machineconfig.viewsets import IPReservationViewSet
+from machineconfig.viewsets import ChangeViewSet
 
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
@@ -44,6 +50,9 @@ router.register(r'networkdevice', NetworkDeviceViewSet)
 router.register(r'unrecognized-pxe-device', UnrecognizedPXEDeviceViewSet)
 router.register(r'boot-history', BootHistoryViewSet)
 router.register(r'build-history', BuildHistoryViewSet)
+router.register(r'remote-job', RemoteJobViewSet)
+router.register(r'ip-reservation', IPReservationViewSet)
+router.register(r'changes', ChangeViewSet, basename='changes')
 
 # Common MAC address pattern
 macaddress = r'(?P<macaddress>([0-9a-f]{2}[\-:]){5}([0-9a-f]{2}))'
@@ -72,6 +81,10 @@ urlpatterns = (
     url(r'^api/tools/host/(?P<target>([^/]+))/', tools_host, name='tools_host'),
     url(r'^api/tools/dig/(?P<target>([^/]+))/', tools_dig, name='tools_dig'),
     url(r'^api/tools/traceroute/(?P<target>([^/]+))/', tools_traceroute, name='tools_traceroute'),
+    url(r'^api/jobs/(?P<job_id>([^/]+))/output/', jobs_output, name='jobs_output'),
+    url(r'^api/tools/resolve/$', tools_resolve, name='tools_resolve_batch'),
+    url(r'^api/tools/resolve/(?P<target>([^/]+))/', tools_resolve, name='tools_resolve'),
+    url(r'^api/search/$', search_view, name='search'),
 
     # Django REST Framework OpenAPI SchemaView
     # https://www.django-rest-framework.org/api-guide/schemas/
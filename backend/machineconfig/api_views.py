@@ -1,13 +1,35 @@
 from rest_framework.decorators import permission_classes
 from rest_framework.decorators import api_view
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 from rest_framework import permissions
 from rest_framework import status
 
-import subprocess
+from django.conf import settings
+
+import django_rq
+
+from machineconfig.jobs import read_job_output
+from machineconfig.jobs import run_streaming_command
+from machineconfig.jobs import stream_job_output
+from machineconfig.jobs import streaming_ndjson_response
+
+from machineconfig.resolver import DNSError
+from machineconfig.resolver import RESOLVE_DEADLINE
+from machineconfig.resolver import default_nameserver
+from machineconfig.resolver import make_query
+from machineconfig.resolver import resolve
+
+from machineconfig.search import SEARCH_MAX_LENGTH
+from machineconfig.search import describe_hits
+from machineconfig.search import search
+
 import ipaddress
 import requests
 
+# Maximum number of DNS queries in a single tools_resolve batch request
+RESOLVE_MAX_QUERIES = 1000
+
 class MyArgumentError(Exception):
     pass
 
@@ -31,6 +53,105 @@ def make_simple_error(message):
     }
     return data
 
+# Maximum number of lines returned by a single job output read
+JOB_OUTPUT_MAX_LINES = 10000
+
+def parse_output_range(params):
+    '''
+    Parse the "start", "limit" and "tail" parameters of a job output read. Returns
+    (start, limit, tail). Raises ValueError if any of them is not an integer.
+    When none are given, the last 100 lines are returned.
+    '''
+    start = params.get('start', None)
+    limit = params.get('limit', None)
+    tail = params.get('tail', None)
+
+    if start is None and limit is None and tail is None:
+        tail = 100
+
+    start = max(0, int(start)) if start is not None else None
+    limit = clamp(int(limit), 1, JOB_OUTPUT_MAX_LINES) if limit is not None else JOB_OUTPUT_MAX_LINES
+    tail = clamp(int(tail), 1, JOB_OUTPUT_MAX_LINES) if tail is not None else None
+    return (start, limit, tail)
+
+def run_tool_command(cmd, timeout):
+    '''
+    Run a diagnostic tool command, capturing all output into a single stream.
+    This is executed by an RQ worker, never inside of a web request. The output is
+    published line by line as it is produced, so that it can be streamed to the
+    client while the tool is still running.
+
+    The returncode is simply reported when the tool terminates incorrectly (for
+    example, ping cannot reach the device). The output is not part of the result:
+    read it with GET /api/jobs/<job_id>/output/ (or stream it).
+    '''
+    result = run_streaming_command(cmd, timeout=timeout)
+    data = {
+        'command': cmd,
+        'returncode': result['returncode'],
+        'lines': result['lines'],
+    }
+    return data
+
+def tool_job(request, tool, cmd, timeout):
+    '''
+    Job-style API shared by all of the diagnostic tools.
+
+    POST requests submit the command to the RQ queue for this tool, and return the
+    job_id to poll. If too many jobs for this tool are already waiting or running,
+    the request is rejected with HTTP 429 Too Many Requests.
+
+    GET requests poll for completion using the job_id parameter. Add the stream=true
+    parameter to receive the output line by line (newline-delimited JSON) as the
+    tool produces it, instead of waiting for the tool to finish.
+    '''
+    queue = django_rq.get_queue(f'tools_{tool}')
+
+    # POST request submits a new job
+    if request.method == 'POST':
+        inflight = queue.count + queue.started_job_registry.count
+        if inflight >= settings.TOOLS_MAX_INFLIGHT[tool]:
+            data = make_simple_error(f'Too many {tool} jobs in progress ({inflight}), please try again later')
+            return Response(data, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '5', })
+
+        # Add a few seconds to the job timeout for RQ overhead. The command timeout
+        # is always the one which should hit.
+        job = queue.enqueue(run_tool_command, cmd=cmd, timeout=timeout, job_timeout=(timeout + 5))
+        data = {
+            'job_id': job.id,
+            'job_timeout': job.timeout,
+        }
+        return Response(data)
+
+    # GET request polls for completion
+    job_id = request.GET.get('job_id', None)
+    if job_id is None:
+        data = make_simple_error(f'GET parameter job_id is required')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    # Fetch RQ Job by UUID (and make sure it is a job for this tool)
+    job = queue.fetch_job(job_id)
+    if job is None or job.origin != queue.name:
+        data = make_simple_error(f'No RQ Job with job_id={job_id} found')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    # stream parameter (default: false)
+    try:
+        stream = request.GET.get('stream', 'false')
+        stream = parse_boolean(stream)
+    except ValueError as ex:
+        data = make_simple_error(f'unable to parse "stream={stream}" as boolean (true/false)')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    if stream:
+        return streaming_ndjson_response(stream_job_output(job))
+
+    data = {
+        'status': job.get_status(),
+        'result': job.result,
+    }
+    return Response(data)
+
 @api_view(['GET',], )
 @permission_classes([permissions.AllowAny, ])
 def lcogtinstruments(request):
@@ -42,12 +163,13 @@ def lcogtinstruments(request):
     response.raise_for_status()
     return Response(response.json())
 
-@api_view(['GET', ], )
+@api_view(['GET', 'POST', ], )
 @permission_classes([permissions.AllowAny, ])
 def tools_ping(request, target):
     '''
     Run the /bin/ping command to perform a simple connectivity test. May not work
-    for all hosts, depending on whether or not they block ICMP.
+    for all hosts, depending on whether or not they block ICMP. POST to start the
+    command, then GET with the job_id parameter to poll for the result.
 
     No target IP Address / Hostname checking or validation is performed. This is a
     totally open remote hole into the LCO-internal network.
@@ -96,24 +218,21 @@ def tools_ping(request, target):
         str(target),
     ]
 
-    # Run the command, capturing all output into a single stream. Another hard
-    # deadline on the execution time is added here too. This should never hit,
-    # but will protect us just in case something else is going wrong in /bin/ping.
-    # Also prevent the subprocess module from raising subprocess.CalledProcessError
-    # when the /bin/ping program terminates incorrectly (cannot reach the device).
+    # Another hard deadline on the execution time is added here too. This should
+    # never hit, but will protect us just in case something else is going wrong
+    # in /bin/ping.
     timeout = (deadline + 5)
     timeout = clamp(timeout, 5, 40)
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
-    data = {
-        'command': cmd,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
-    }
-    return Response(data=data, status=status.HTTP_200_OK)
+    return tool_job(request, 'ping', cmd, timeout)
 
-@api_view(['GET', ], )
+@api_view(['GET', 'POST', ], )
 @permission_classes([permissions.AllowAny, ])
 def tools_traceroute(request, target):
+    '''
+    Run the /usr/bin/traceroute command to show the network path to a host. This
+    can take up to 45 seconds. POST to start the command, then GET with the job_id
+    parameter to poll for the result.
+    '''
     cmd = [
         '/usr/bin/traceroute',
         '--sim-queries=10000',
@@ -123,21 +242,16 @@ def tools_traceroute(request, target):
     ]
 
     timeout = 45
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
-    data = {
-        'command': cmd,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
-    }
-    return Response(data=data, status=status.HTTP_200_OK)
+    return tool_job(request, 'traceroute', cmd, timeout)
 
-@api_view(['GET', ], )
+@api_view(['GET', 'POST', ], )
 @permission_classes([permissions.AllowAny, ])
 def tools_host(request, target):
     '''
     Run the /usr/bin/host command to perform a human-readable DNS lookup. No target
     IP Address / Hostname checking or validation is performed: this is a totally
-    open remote hole into the LCO-internal DNS system.
+    open remote hole into the LCO-internal DNS system. POST to start the command,
+    then GET with the job_id parameter to poll for the result.
     '''
     # verbose parameter (default: false)
     try:
@@ -156,23 +270,16 @@ def tools_host(request, target):
 
     # run command
     timeout = 5
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
-
-    # return response to user
-    data = {
-        'command': cmd,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
-    }
-    return Response(data=data, status=status.HTTP_200_OK)
+    return tool_job(request, 'host', cmd, timeout)
 
-@api_view(['GET', ], )
+@api_view(['GET', 'POST', ], )
 @permission_classes([permissions.AllowAny, ])
 def tools_dig(request, target):
     '''
     Run the /usr/bin/dig command to perform an advanced DNS lookup. No target
     IP Address / Hostname checking or validation is performed: this is a totally
-    open remote hole into the LCO-internal DNS system.
+    open remote hole into the LCO-internal DNS system. POST to start the command,
+    then GET with the job_id parameter to poll for the result.
     '''
     cmd = [
         '/usr/bin/dig',
@@ -191,14 +298,122 @@ def tools_dig(request, target):
 
     # run command
     timeout = 5
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
+    return tool_job(request, 'dig', cmd, timeout)
+
+@api_view(['GET', ], )
+@permission_classes([permissions.AllowAny, ])
+def jobs_output(request, job_id):
+    '''
+    Read part of the output of an RQ job (puppet agent --test, diagnostic tools),
+    while it runs or after it has finished:
+
+    /api/jobs/<job_id>/output/?tail=100 (the last 100 lines, the default)
+    /api/jobs/<job_id>/output/?start=200&limit=100 (lines 200 - 299)
+    '''
+    try:
+        (start, limit, tail) = parse_output_range(request.GET)
+    except ValueError as ex:
+        data = make_simple_error(f'unable to parse start/limit/tail parameters as integers')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    connection = django_rq.get_connection()
+    data = read_job_output(connection, job_id, start=start, limit=limit, tail=tail)
+    return Response(data)
+
+@api_view(['GET', 'POST', ], )
+@permission_classes([permissions.AllowAny, ])
+def tools_resolve(request, target=None):
+    '''
+    Perform DNS lookups using the in-process resolver, rather than by running the
+    /usr/bin/host or /usr/bin/dig commands. Answers are returned as structured
+    records, and are cached according to their TTL.
+
+    GET looks up a single target: /api/tools/resolve/<target>/?type=MX
+    POST looks up many targets at once (all sent in parallel from one socket):
+
+    {
+        "queries": ["core1.lsc.lco.gtn", "10.5.0.15", {"name": "lsc.lco.gtn", "type": "NS"}],
+        "nameserver": "10.5.0.15"
+    }
+
+    IP Address targets are automatically turned into reverse (PTR) lookups. No
+    target checking or validation is performed, same as the other tools. The whole
+    batch answers within RESOLVE_DEADLINE seconds: queries which have not been
+    answered by then are reported with the ERROR status.
+    '''
+    params = request.GET if request.method == 'GET' else request.data
+    if not isinstance(params, dict):
+        data = make_simple_error('The POST data must be a JSON object')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    # nameserver parameter (default: system resolver)
+    nameserver = params.get('nameserver', None) or default_nameserver()
+    try:
+        ipaddress.ip_address(nameserver)
+    except ValueError as ex:
+        data = make_simple_error(f'unable to parse nameserver="{nameserver}" as an IP Address')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    # type parameter (default: A record)
+    record_type = params.get('type', 'A')
+
+    # build the list of queries
+    if request.method == 'GET':
+        targets = [target, ]
+    else:
+        targets = request.data.get('queries', None)
+        if not isinstance(targets, list) or len(targets) <= 0:
+            data = make_simple_error(f'The "queries" POST data parameter (list) is required')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(targets) > RESOLVE_MAX_QUERIES:
+            data = make_simple_error(f'Too many queries (maximum: {RESOLVE_MAX_QUERIES})')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        queries = []
+        for elem in targets:
+            if isinstance(elem, dict):
+                queries.append(make_query(elem.get('name', ''), elem.get('type', record_type)))
+            else:
+                queries.append(make_query(elem, record_type))
+    except DNSError as ex:
+        data = make_simple_error(str(ex))
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
-    # return response to user
     data = {
-        'command': cmd,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
+        'nameserver': nameserver,
+        'results': resolve(queries, nameserver=nameserver, deadline=RESOLVE_DEADLINE),
     }
-    return Response(data=data, status=status.HTTP_200_OK)
+    return Response(data)
+
+class SearchPagination(LimitOffsetPagination):
+    default_limit = 25
+    max_limit = 200
+
+@api_view(['GET', ], )
+@permission_classes([permissions.AllowAny, ])
+def search_view(request):
+    '''
+    Search NetworkDevices (by Hostname, MAC Address, IP Address and information),
+    UnrecognizedPXEDevices (by MAC Address and IP Address) and Sites, in a single
+    request. Hits are ranked best first, and paginated (?limit=&offset=):
+
+    /api/search/?q=core1 (Hostnames and information containing "core1")
+    /api/search/?q=00-11-22 (MAC Addresses starting with 00:11:22)
+    /api/search/?q=10.5.0.0/16 (IP Addresses within the network)
+    '''
+    q = request.GET.get('q', '').strip()
+    if len(q) <= 0:
+        data = make_simple_error(f'The "q" query parameter is required')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    if len(q) > SEARCH_MAX_LENGTH:
+        data = make_simple_error(f'The "q" query parameter is too long (maximum: {SEARCH_MAX_LENGTH})')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = SearchPagination()
+    hits = paginator.paginate_queryset(search(q), request)
+    return paginator.get_paginated_response(describe_hits(hits))
 
 # vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+'''
+Bulk import/upsert of NetworkDevices (POST /api/networkdevice/bulk/).
+
+Every item is validated up front: first each item on its own (the normal
+NetworkDeviceSerializer field validation), then the MAC Addresses and Hostnames
+of all of the items together, in one query per field. Only when every item is
+valid is anything written: all of the items in one transaction, with one bulk
+INSERT/UPDATE per model, rather than one transaction (and dozens of single row
+INSERTs) per device.
+'''
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from machineconfig.models import NetworkDevice
+from machineconfig.models import PuppetMachine
+from machineconfig.models import Webcam
+from machineconfig.models import update_history_site
+from machineconfig.nested import NestedWrite
+from machineconfig.nested import bulk_unique_conflicts
+from machineconfig.nested import check_deferred_constraints
+from machineconfig.nested import existing_networkinterfaces
+from machineconfig.nested import plan_networkinterfaces
+from machineconfig.nested import refresh_primary_fields
+from machineconfig.serializers import NetworkDeviceSerializer
+
+from collections import Counter
+import json
+
+# Maximum number of NetworkDevices in a single bulk request
+BULK_MAX_ITEMS = 5000
+
+def parse_ndjson(body):
+    '''
+    Parse a newline delimited JSON request body. Returns a list with one item per
+    non-empty line: the parsed JSON value, or a ValueError for a line which is not
+    valid JSON (so that it can be reported against the right item).
+    '''
+    items = []
+    for line in body.decode('utf-8', errors='replace').splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            items.append(json.loads(line))
+        except ValueError as ex:
+            items.append(ValueError(f'Invalid JSON: {ex}'))
+
+    return items
+
+def item_id(item):
+    '''
+    The "id" of an item: None if it has none, or the integer primary key (a string
+    of digits is accepted too). Raises ValueError for any other value.
+    '''
+    pk = item.get('id', None)
+    if pk is None:
+        return None
+
+    if isinstance(pk, int) and not isinstance(pk, bool):
+        return pk
+
+    if isinstance(pk, str) and pk.strip().isdigit():
+        return int(pk)
+
+    raise ValueError(f'Invalid id {json.dumps(pk)}: a valid integer is required')
+
+def validate_items(items, context):
+    '''
+    Validate each item with the NetworkDeviceSerializer. Items with an "id" update
+    that (existing) NetworkDevice, and all other items create a new one. An id may
+    only appear once: every item which repeats it is rejected. Returns a list of
+    (networkdevice or None, validated data, errors) tuples, one per item.
+    '''
+    ids = {}
+    for (index, item) in enumerate(items):
+        if isinstance(item, dict):
+            try:
+                ids[index] = item_id(item)
+            except ValueError as ex:
+                ids[index] = ex
+
+    counts = Counter(pk for pk in ids.values() if isinstance(pk, int))
+    queryset = NetworkDevice.objects.filter(pk__in=list(counts.keys()))
+    queryset = queryset.select_related('puppetmachine', 'webcam')
+    networkdevices = {networkdevice.pk: networkdevice for networkdevice in queryset}
+
+    results = []
+    for (index, item) in enumerate(items):
+        if isinstance(item, ValueError):
+            results.append((None, None, {'non_field_errors': [str(item), ], }, ))
+            continue
+
+        if not isinstance(item, dict):
+            results.append((None, None, {'non_field_errors': ['Each item must be a JSON object', ], }, ))
+            continue
+
+        if 'image' in item:
+            results.append((None, None, {'image': ['Images are not supported in bulk requests', ], }, ))
+            continue
+
+        pk = ids[index]
+        networkdevice = None
+        if isinstance(pk, ValueError):
+            results.append((None, None, {'id': [str(pk), ], }, ))
+            continue
+
+        if pk is not None and counts[pk] > 1:
+            results.append((None, None, {'id': [f'Duplicate id {pk} in payload', ], }, ))
+            continue
+
+        if pk is not None:
+            networkdevice = networkdevices.get(pk, None)
+            if networkdevice is None:
+                results.append((None, None, {'id': [f'NetworkDevice(pk={pk}) does not exist', ], }, ))
+                continue
+
+        serializer = NetworkDeviceSerializer(networkdevice, data=item, partial=networkdevice is not None,
+                                             context=context)
+        if not serializer.is_valid():
+            results.append((networkdevice, None, serializer.errors, ))
+            continue
+
+        results.append((networkdevice, serializer.validated_data, None, ))
+
+    # uniqueness of MAC Addresses and Hostnames, across every item at once
+    entries = [(networkdevice, validated_data['networkinterface_set'], )
+               for (networkdevice, validated_data, errors) in results
+               if errors is None and 'networkinterface_set' in validated_data]
+    conflicts = iter(bulk_unique_conflicts(entries))
+    for (index, (networkdevice, validated_data, errors)) in enumerate(results):
+        if errors is None and 'networkinterface_set' in validated_data:
+            conflict = next(conflicts)
+            if conflict is not None:
+                results[index] = (networkdevice, None, conflict, )
+
+    return results
+
+def apply_fields(instance, data):
+    '''Set the (changed) fields of an existing object. Returns the names of the fields which changed.'''
+    changed = []
+    for (attr, value) in data.items():
+        if getattr(instance, attr) != value:
+            setattr(instance, attr, value)
+            changed.append(attr)
+
+    return changed
+
+def write_items(results):
+    '''
+    Write every validated item: NetworkDevices (and their PuppetMachine and Webcam
+    sub-objects) with one bulk INSERT and one bulk UPDATE per model, then every
+    NetworkInterface tree with a single NestedWrite. Must be called within a
+    database transaction. Returns the list of NetworkDevices, one per item.
+    '''
+    networkdevices = []
+    creates = {NetworkDevice: [], PuppetMachine: [], Webcam: [], }
+    updates = {NetworkDevice: {}, PuppetMachine: {}, Webcam: {}, }
+    update_fields = {NetworkDevice: set(), PuppetMachine: set(), Webcam: set(), }
+    interfaces = []
+    moved = []
+
+    for (networkdevice, validated_data, errors) in results:
+        validated_data = dict(validated_data)
+        networkinterface_set_data = validated_data.pop('networkinterface_set', None)
+        sub_objects = (
+            (PuppetMachine, 'puppetmachine', validated_data.pop('puppetmachine', None), ),
+            (Webcam, 'webcam', validated_data.pop('webcam', None), ),
+        )
+
+        if networkdevice is None:
+            networkdevice = NetworkDevice(**validated_data)
+            creates[NetworkDevice].append(networkdevice)
+            touched = False
+        else:
+            changed = apply_fields(networkdevice, validated_data)
+            update_fields[NetworkDevice].update(changed)
+            if 'site' in changed:
+                moved.append(networkdevice)
+
+            # any change to the device, or to the objects nested in it, is a change to
+            # the device (Site.dns_serialno is computed from NetworkDevice.updated_at)
+            touched = len(changed) > 0 or networkinterface_set_data is not None
+
+        for (model, name, data) in sub_objects:
+            if data is None:
+                continue
+
+            instance = getattr(networkdevice, name, None) if networkdevice.pk is not None else None
+            if instance is None:
+                instance = model(networkdevice=networkdevice, **data)
+                creates[model].append(instance)
+                if networkdevice.pk is not None:
+                    touched = True
+            else:
+                sub_changed = apply_fields(instance, data)
+                if len(sub_changed) > 0:
+                    updates[model][instance.pk] = instance
+                    update_fields[model].update(sub_changed)
+                    touched = True
+
+        if touched:
+            # bulk_update() does not know about auto_now fields
+            networkdevice.updated_at = timezone.now()
+            updates[NetworkDevice][networkdevice.pk] = networkdevice
+            update_fields[NetworkDevice].add('updated_at')
+
+        if networkinterface_set_data is not None:
+            interfaces.append((networkdevice, networkinterface_set_data, ))
+
+        networkdevices.append(networkdevice)
+
+    # NetworkDevices first: every other object references their primary keys
+    for model in (NetworkDevice, PuppetMachine, Webcam, ):
+        if len(creates[model]) > 0:
+            if model is not NetworkDevice:
+                for instance in creates[model]:
+                    instance.networkdevice_id = instance.networkdevice.pk
+
+            model.objects.bulk_create(creates[model])
+
+        if len(updates[model]) > 0:
+            model.objects.bulk_update(updates[model].values(), fields=sorted(update_fields[model]))
+
+    # the history records carry a copy of the Site: move them along with the devices
+    update_history_site(moved)
+
+    existing = existing_networkinterfaces([networkdevice for (networkdevice, data) in interfaces])
+    write = NestedWrite()
+    for (networkdevice, networkinterface_set_data) in interfaces:
+        plan_networkinterfaces(write, networkdevice, networkinterface_set_data, existing.get(networkdevice.pk, []))
+
+    write.execute()
+    check_deferred_constraints()
+    refresh_primary_fields([networkdevice for (networkdevice, data) in interfaces])
+
+    return networkdevices
+
+def bulk_upsert_networkdevices(items, context=None, dry_run=False):
+    '''
+    Validate and then write (unless dry_run) a list of NetworkDevice items. Either
+    every item is written, or none are. Returns a dictionary with the per-item
+    results, and whether every item was valid ("ok").
+    '''
+    # the MAC Address and Hostname uniqueness is checked for every item at once
+    context = dict(context if context is not None else {}, bulk_unique_validation=True)
+    results = validate_items(items, context)
+    ok = all(errors is None for (networkdevice, validated_data, errors) in results)
+
+    data = {
+        'ok': ok,
+        'dry_run': dry_run,
+        'total': len(results),
+        'created': 0,
+        'updated': 0,
+        'results': [],
+    }
+
+    if not ok:
+        data['results'] = [{'index': index, 'errors': errors, } if errors is not None else {'index': index, }
+                           for (index, (networkdevice, validated_data, errors)) in enumerate(results)]
+        return data
+
+    if dry_run:
+        data['results'] = [{'index': index, 'id': networkdevice.pk if networkdevice is not None else None, }
+                           for (index, (networkdevice, validated_data, errors)) in enumerate(results)]
+        return data
+
+    created = [networkdevice is None for (networkdevice, validated_data, errors) in results]
+    try:
+        with transaction.atomic():
+            networkdevices = write_items(results)
+    except serializers.ValidationError as ex:
+        data['ok'] = False
+        data['results'] = [{'errors': ex.detail, }, ]
+        return data
+
+    data['created'] = created.count(True)
+    data['updated'] = created.count(False)
+    data['results'] = [{
+        'index': index,
+        'id': networkdevice.pk,
+        'status': 'created' if was_created else 'updated',
+    } for (index, (networkdevice, was_created)) in enumerate(zip(networkdevices, created))]
+    return data
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+'''
+Delta sync (GET /api/changes/?since=<version>): clients keep a local mirror of the
+Sites and NetworkDevices up to date by asking only for what changed since the
+latest version which they have seen, rather than downloading everything again.
+
+The ChangeLog (see machineconfig.models.ChangeLog) holds the version of the latest
+change of every object, written by database triggers. A client starts with
+since=0 (everything), then repeats the request with since=<version> from each
+response (while "more" is true, to page through a large backlog). Deleted objects
+are returned as tombstones ("deleted": true, "data": null).
+'''
+
+from django.db.models import Max
+
+from machineconfig.models import ChangeLog
+
+# Number of changes returned by a single request, by default and at most
+CHANGES_DEFAULT_LIMIT = 500
+CHANGES_MAX_LIMIT = 1000
+
+def latest_version():
+    '''The version of the latest committed change (0 when nothing has changed yet)'''
+    return ChangeLog.objects.aggregate(version=Max('version'))['version'] or 0
+
+def changes_since(since, limit=CHANGES_DEFAULT_LIMIT):
+    '''
+    The ChangeLog rows with a version above since (at most limit of them, oldest
+    first), and whether there are more
+    '''
+    queryset = ChangeLog.objects.filter(version__gt=since).order_by('version')
+    rows = list(queryset[:limit + 1])
+    return (rows[:limit], len(rows) > limit)
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
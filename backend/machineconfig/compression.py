@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+'''
+HTTP response compression.
+
+CompressionMiddleware compresses responses on the fly, only where it pays off:
+
+- at least COMPRESSION_MIN_SIZE bytes (smaller responses gain less than the overhead)
+- text, JSON, and other compressible content types (never images or archives)
+- never the PXE boot paths (tftp and kickstart), which are tiny, and are fetched
+  by boot loaders and installers which may not handle compressed responses
+- never streaming responses, whose lines would be held back by the compressor
+- with a fast compression level, since the work is repeated on every request
+
+The generated DNS/DHCP configuration files are downloaded over and over again by
+every Site, but only change when the Site's devices do. precompressed_response()
+caches each file, and each compressed variant of it, keyed by a content version
+(which is cheap to compute), and compresses each variant once with the best
+compression level. Repeated downloads cost neither rendering nor compression, and
+the content version is sent as the ETag so that unchanged files are not
+downloaded again at all (304 Not Modified).
+
+The encoding is negotiated with the Accept-Encoding header. Zstandard (zstd) and
+Brotli (br) are used when the zstandard and brotli packages are installed, in
+preference to gzip.
+'''
+
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from collections import OrderedDict
+import gzip
+import hashlib
+import re
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Smallest response which is compressed
+COMPRESSION_MIN_SIZE = 1024
+
+# Content types which are compressed (prefixes)
+COMPRESSIBLE_CONTENT_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/msgpack',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+# Paths which are never compressed: PXE boot configuration and kickstart files
+COMPRESSION_EXCLUDED_PATHS_RE = re.compile(r'^/(tftp|ks|kickstart)/')
+
+# Compression levels for responses which are compressed on every request
+DYNAMIC_LEVELS = {
+    'zstd': 3,
+    'br': 4,
+    'gzip': 6,
+}
+
+# Compression levels for cached variants, which are compressed only once per content version
+PRECOMPRESSED_LEVELS = {
+    'zstd': 19,
+    'br': 9,
+    'gzip': 9,
+}
+
+# Maximum number of documents kept by the precompressed cache
+PRECOMPRESSED_CACHE_SIZE = 256
+
+def available_encodings():
+    '''The supported Content-Encodings, most preferred first'''
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+
+    if brotli is not None:
+        encodings.append('br')
+
+    encodings.append('gzip')
+    return encodings
+
+def accepted_encoding(request):
+    '''
+    The best Content-Encoding which the client accepts: highest q-value first, then
+    our preference. Returns None when the response must not be compressed.
+    '''
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        (name, _, params) = part.partition(';')
+        name = name.strip().lower()
+        if name == '':
+            continue
+
+        q = 1.0
+        for param in params.split(';'):
+            (key, _, value) = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError as ex:
+                    q = 0.0
+
+        accepted[name] = q
+
+    best = (None, 0.0, )
+    for encoding in available_encodings():
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best[1]:
+            best = (encoding, q, )
+
+    return best[0]
+
+def compress(content, encoding, level):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(content)
+
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+
+    # mtime=0 makes the output (and therefore any ETag derived from it) reproducible
+    return gzip.compress(content, compresslevel=level, mtime=0)
+
+def is_compressible(request, response):
+    '''Is this response worth compressing (apart from the encodings the client accepts)?'''
+    if response.streaming or response.has_header('Content-Encoding'):
+        return False
+
+    if COMPRESSION_EXCLUDED_PATHS_RE.match(request.path_info):
+        return False
+
+    content_type = response.get('Content-Type', '').lower()
+    if not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES):
+        return False
+
+    return len(response.content) >= COMPRESSION_MIN_SIZE
+
+def compress_response(request, response):
+    '''Compress the response (in place) with the best encoding the client accepts, if worthwhile'''
+    if not is_compressible(request, response):
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding', ))
+
+    encoding = accepted_encoding(request)
+    if encoding is None:
+        return response
+
+    compressed = compress(response.content, encoding, DYNAMIC_LEVELS[encoding])
+    if len(compressed) >= len(response.content):
+        return response
+
+    response.content = compressed
+    response['Content-Length'] = str(len(compressed))
+    response['Content-Encoding'] = encoding
+
+    # Same as the Django GZipMiddleware: the compressed content is only semantically equal
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+
+    return response
+
+################################################################################
+# Precompressed Cache
+################################################################################
+
+class PrecompressedDocument:
+    '''One version of a document, and its compressed variants (each compressed on first use)'''
+
+    def __init__(self, etag, content, content_type):
+        self.etag = etag
+        self.content = content
+        self.content_type = content_type
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    def variant(self, encoding):
+        '''The (encoding, content) to send, for the encoding accepted by the client'''
+        if encoding is None or len(self.content) < COMPRESSION_MIN_SIZE:
+            return (None, self.content, )
+
+        with self.lock:
+            if encoding not in self.variants:
+                compressed = compress(self.content, encoding, PRECOMPRESSED_LEVELS[encoding])
+                self.variants[encoding] = compressed if len(compressed) < len(self.content) else None
+
+            compressed = self.variants[encoding]
+
+        if compressed is None:
+            return (None, self.content, )
+
+        return (encoding, compressed, )
+
+_precompressed = OrderedDict()
+_precompressed_lock = threading.Lock()
+
+def precompressed_get(key, etag):
+    with _precompressed_lock:
+        document = _precompressed.get(key, None)
+        if document is None or document.etag != etag:
+            return None
+
+        _precompressed.move_to_end(key)
+        return document
+
+def precompressed_put(key, document):
+    with _precompressed_lock:
+        _precompressed[key] = document
+        _precompressed.move_to_end(key)
+        while len(_precompressed) > PRECOMPRESSED_CACHE_SIZE:
+            _precompressed.popitem(last=False)
+
+def precompressed_clear():
+    with _precompressed_lock:
+        _precompressed.clear()
+
+def precompressed_response(request, key, version, render):
+    '''
+    Serve a generated document from the precompressed cache.
+
+    key identifies the document (for example: ('dhcpconf', site.pk)), version must
+    change whenever its content would, and render() returns the HttpResponse for
+    the current content. render() is only called when the version is not cached.
+    '''
+    etag = '"' + hashlib.sha1(repr((key, version, )).encode('utf-8')).hexdigest() + '"'
+
+    # the ETag only depends on the content, not on the encoding, so weak matches are fine
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if etag in [tag.replace('W/', '', 1) for tag in parse_etags(if_none_match)]:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept-Encoding', ))
+        return response
+
+    document = precompressed_get(key, etag)
+    if document is None:
+        response = render()
+        if response.status_code != 200:
+            return response
+
+        document = PrecompressedDocument(etag, response.content, response['Content-Type'])
+        precompressed_put(key, document)
+
+    (encoding, content) = document.variant(accepted_encoding(request))
+    response = HttpResponse(content, content_type=document.content_type)
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+
+    return response
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+'''
+IP Address management (IPAM) of the network of each Site.
+
+The address space of a Site network is a compact bitmap (one bit per address),
+built from one query for the addresses used by NetworkInterfaceConfigurations
+and one for the IPReservations. Reserved addresses are never handed out: the
+network and broadcast addresses, the gateway and DNS servers, the DHCP dynamic
+range, and every (unexpired) IPReservation.
+
+Allocation is atomic: the Site row is locked (SELECT ... FOR UPDATE) while the
+free addresses are found, and each allocated address is held by a temporary
+IPReservation, so that concurrent requests never get the same address even
+before it has been saved onto a NetworkDevice.
+'''
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from machineconfig.models import IPReservation
+from machineconfig.models import NetworkInterfaceConfiguration
+from machineconfig.models import Site
+
+from ipaddress import ip_address
+from ipaddress import ip_network
+import datetime
+
+# How long an allocated address is held for, before it must be saved onto a NetworkDevice
+IPAM_HOLD_DURATION = datetime.timedelta(minutes=30)
+
+# Maximum number of addresses returned (or allocated) by a single request
+IPAM_MAX_COUNT = 256
+
+def site_network(site):
+    return ip_network(f'{site.networkip}/{site.networkcidr}', strict=False)
+
+def dhcp_range(site):
+    '''
+    The (start, end) IP Addresses of the DHCP dynamic range of the Site network:
+    x.y.249.1 - x.y.249.99 for 10.x.y.z networks, otherwise None.
+    '''
+    network = site_network(site)
+    if not str(network.network_address).startswith('10.'):
+        return None
+
+    parts = str(network.network_address).split('.')
+    return (ip_address(f'{parts[0]}.{parts[1]}.249.1'), ip_address(f'{parts[0]}.{parts[1]}.249.99'), )
+
+class AddressBitmap:
+    '''One bit per address of a network, set for every address which is not free'''
+
+    def __init__(self, network):
+        self.network = network
+        self.first = int(network.network_address)
+        self.size = network.num_addresses
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def address(self, offset):
+        return ip_address(self.first + offset)
+
+    def mark(self, start, end=None):
+        '''Set the bits of the (inclusive) range of addresses, clipped to the network'''
+        end = start if end is None else end
+        lower = max(int(start) - self.first, 0)
+        upper = min(int(end) - self.first, self.size - 1)
+        for offset in range(lower, upper + 1):
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def free_offsets(self, start=0):
+        '''Yield the offsets of the free addresses, in order, skipping over full bytes'''
+        for index in range(start >> 3, len(self.bits)):
+            byte = self.bits[index]
+            if byte == 0xff:
+                continue
+
+            for bit in range(8):
+                offset = (index << 3) + bit
+                if offset >= start and offset < self.size and not byte & (1 << bit):
+                    yield offset
+
+    def free_ranges(self):
+        '''Yield the (first, last) offsets of every run of free addresses'''
+        run = None
+        for offset in self.free_offsets():
+            if run is not None and offset == run[1] + 1:
+                run[1] = offset
+                continue
+
+            if run is not None:
+                yield tuple(run)
+
+            run = [offset, offset]
+
+        if run is not None:
+            yield tuple(run)
+
+    def count(self):
+        '''The number of addresses which are not free'''
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+class AddressSpace:
+    '''The used and reserved addresses of the network of one Site'''
+
+    def __init__(self, site, now=None):
+        self.site = site
+        self.network = site_network(site)
+        self.used = used_addresses(self.network)
+        self.reserved = reserved_ranges(site, self.network, now=now)
+
+        self.used_bitmap = AddressBitmap(self.network)
+        for address in self.used:
+            self.used_bitmap.mark(address)
+
+        self.bitmap = AddressBitmap(self.network)
+        self.bitmap.bits[:] = self.used_bitmap.bits
+        for (start, end, reason, temporary) in self.reserved:
+            self.bitmap.mark(start, end)
+
+    def next_free(self, count=1, start=None):
+        '''The first count free addresses (at or after the start address, if given)'''
+        offset = 0
+        if start is not None:
+            offset = max(int(start) - self.bitmap.first, 0)
+
+        addresses = []
+        for offset in self.bitmap.free_offsets(start=offset):
+            addresses.append(self.bitmap.address(offset))
+            if len(addresses) >= count:
+                break
+
+        return addresses
+
+    def free_ranges(self, min_size=1):
+        ranges = []
+        for (first, last) in self.bitmap.free_ranges():
+            if (last - first + 1) >= min_size:
+                ranges.append({
+                    'start': str(self.bitmap.address(first)),
+                    'end': str(self.bitmap.address(last)),
+                    'size': last - first + 1,
+                })
+
+        return ranges
+
+    def summary(self):
+        used = self.used_bitmap.count()
+        unavailable = self.bitmap.count()
+        return {
+            'network': str(self.network),
+            'total': self.bitmap.size,
+            'used': used,
+            'reserved': unavailable - used,
+            'free': self.bitmap.size - unavailable,
+        }
+
+    def conflicts(self):
+        '''
+        Addresses which are used by more than one NetworkInterfaceConfiguration, used
+        addresses within a (permanent) reserved range, and addresses of this Site's
+        NetworkDevices which are outside of the Site network
+        '''
+        conflicts = []
+        for (address, pks) in sorted(self.used.items()):
+            if len(pks) > 1:
+                conflicts.append({
+                    'ipaddress': str(address),
+                    'reason': 'used more than once',
+                    'networkdevices': sorted(set(pks)),
+                })
+
+            for (start, end, reason, temporary) in self.reserved:
+                if not temporary and start <= address <= end:
+                    conflicts.append({
+                        'ipaddress': str(address),
+                        'reason': f'reserved: {reason}',
+                        'networkdevices': sorted(set(pks)),
+                    })
+
+        queryset = NetworkInterfaceConfiguration.objects.filter(networkinterface__networkdevice__site=self.site)
+        queryset = queryset.filter(ipaddress__isnull=False)
+        queryset = queryset.exclude(ipaddress__net_contained_or_equal=str(self.network))
+        queryset = queryset.values_list('ipaddress', 'networkinterface__networkdevice')
+        for (address, pk) in queryset:
+            conflicts.append({
+                'ipaddress': address,
+                'reason': f'outside of the Site network {self.network}',
+                'networkdevices': [pk, ],
+            })
+
+        return conflicts
+
+def used_addresses(network):
+    '''
+    Every IP Address within the network which is used by a NetworkInterfaceConfiguration
+    (of any Site), with the NetworkDevice pks which use it, in one query
+    '''
+    queryset = NetworkInterfaceConfiguration.objects.filter(ipaddress__net_contained_or_equal=str(network))
+    queryset = queryset.values_list('ipaddress', 'networkinterface__networkdevice')
+
+    used = {}
+    for (address, pk) in queryset:
+        used.setdefault(ip_address(address), []).append(pk)
+
+    return used
+
+def reserved_ranges(site, network, now=None):
+    '''The (start, end, reason, temporary) ranges of the Site network which must not be allocated'''
+    now = timezone.now() if now is None else now
+    ranges = [(network.network_address, network.network_address, 'network address', False, ), ]
+    if network.prefixlen < 31:
+        ranges.append((network.broadcast_address, network.broadcast_address, 'broadcast address', False, ))
+
+    gateway = ip_address(site.gateway)
+    ranges.append((gateway, gateway, 'gateway', False, ))
+    for dnsserver in site.dnsservers:
+        dnsserver = ip_address(dnsserver)
+        ranges.append((dnsserver, dnsserver, 'DNS server', False, ))
+
+    dhcp = dhcp_range(site)
+    if dhcp is not None:
+        ranges.append((dhcp[0], dhcp[1], 'DHCP dynamic range', False, ))
+
+    queryset = IPReservation.objects.filter(site=site)
+    queryset = queryset.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+    for reservation in queryset:
+        reason = reservation.description or f'IPReservation(pk={reservation.pk})'
+        temporary = reservation.expires_at is not None
+        ranges.append((ip_address(reservation.start), ip_address(reservation.end), reason, temporary, ))
+
+    return ranges
+
+@transaction.atomic
+def allocate_addresses(site, count=1, description='', start=None):
+    '''
+    Allocate the first count free addresses of the Site network, and hold each of
+    them with a temporary IPReservation. Concurrent allocations for the same Site
+    wait for each other. Returns (addresses, expires_at); fewer addresses than
+    requested (and nothing held) when the network does not have enough free.
+    '''
+    # serialize allocations per Site: the lock is held until the transaction commits
+    site = Site.objects.select_for_update().get(pk=site.pk)
+
+    now = timezone.now()
+    IPReservation.objects.filter(site=site, expires_at__lte=now).delete()
+
+    addresses = AddressSpace(site, now=now).next_free(count=count, start=start)
+    if len(addresses) < count:
+        return (addresses, None)
+
+    expires_at = now + IPAM_HOLD_DURATION
+    IPReservation.objects.bulk_create([IPReservation(
+        site=site,
+        start=str(address),
+        end=str(address),
+        description=description,
+        expires_at=expires_at,
+    ) for address in addresses])
+
+    print(f'allocate_addresses: Site(code={site.code}): {", ".join(str(address) for address in addresses)}')
+    return (addresses, expires_at)
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
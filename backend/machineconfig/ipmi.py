@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+'''
+Helpers for talking to the BMC of a NetworkDevice with ipmitool, and for keeping
+a cached copy of the chassis status of every Puppet managed device (IPMIStatus).
+
+BMCs are slow and fragile, so the chassis status is refreshed in the background
+by "manage.py poll_ipmi_status", and the API returns the cached copy.
+'''
+
+from django.conf import settings
+from django.utils import timezone
+
+from machineconfig.models import IPMIStatus
+from machineconfig.models import PuppetMachine
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from ipaddress import IPv4Address
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# IPMI operations which may be run in bulk against many NetworkDevices at once
+IPMI_OPERATIONS = {
+    'chassis_status': ['chassis', 'status', ],
+    'power_status': ['power', 'status', ],
+    'power_on': ['power', 'on', ],
+    'power_off': ['power', 'off', ],
+}
+
+# Fields of "ipmitool chassis status" which indicate a fault when "true" or "active"
+CHASSIS_STATUS_FAULTS = (
+    'Power Overload',
+    'Power Interlock',
+    'Main Power Fault',
+    'Power Control Fault',
+    'Chassis Intrusion',
+    'Drive Fault',
+    'Cooling/Fan Fault',
+)
+
+def ipmi_target(networkdevice):
+    '''
+    Return the (hostname, username, password) needed to reach the BMC of a
+    NetworkDevice. The hostname is None when it is not known.
+    '''
+    puppetmachine = networkdevice.puppetmachine
+    site = networkdevice.site
+
+    username = 'ADMIN'
+    password = f'{site.code.lower()}cana1'
+    hostname = puppetmachine.ipmi_ipaddress
+
+    return (hostname, username, password)
+
+def ipmitool(hostname, username, password, command, timeout=15):
+    '''
+    Run the ipmitool utility (settings.IPMITOOL_COMMAND), with the given command,
+    against a single BMC. Return a dictionary with the output and returncode.
+
+    The subprocess.TimeoutExpired exception is raised if the BMC does not answer
+    within the timeout (in seconds).
+    '''
+    cmd = [
+        settings.IPMITOOL_COMMAND,
+        '-U',
+        str(username),
+        '-P',
+        str(password),
+        '-H',
+        str(hostname),
+    ] + command
+
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
+    data = {
+        #'command': cmd,
+        'stdout': proc.stdout,
+        'returncode': proc.returncode,
+    }
+    return data
+
+def parse_chassis_status(stdout):
+    '''
+    Parse the output of "ipmitool chassis status". Returns a dictionary with the
+    power state (True/False, or None if unknown) and a list of the active faults.
+    '''
+    fields = {}
+    for line in stdout.splitlines():
+        (key, sep, value) = line.partition(':')
+        if sep:
+            fields[key.strip()] = value.strip().lower()
+
+    power = fields.get('System Power', None)
+    data = {
+        'power_on': {'on': True, 'off': False, }.get(power, None),
+        'faults': [name for name in CHASSIS_STATUS_FAULTS if fields.get(name, None) in ('true', 'active', )],
+    }
+    return data
+
+def fetch_chassis_status(target, timeout=15):
+    '''
+    Fetch and parse the chassis status of a single BMC, given its (hostname,
+    username, password) target (see ipmi_target()). Never raises: any failure is
+    reported in the "error" key of the result.
+
+    Only the target is needed, not the NetworkDevice, so this does not touch the
+    database, and is safe to run in a worker thread.
+    '''
+    data = {
+        'bmc': '',
+        'power_on': None,
+        'faults': [],
+        'returncode': None,
+        'stdout': '',
+        'error': '',
+    }
+
+    try:
+        (hostname, username, password) = target
+        if hostname is None:
+            data['error'] = 'No BMC IP Address known'
+            return data
+
+        data['bmc'] = hostname
+        result = ipmitool(hostname, username, password, command=IPMI_OPERATIONS['chassis_status'], timeout=timeout)
+    except subprocess.TimeoutExpired as ex:
+        data['error'] = f'BMC did not answer within {timeout} seconds'
+        return data
+    except Exception as ex:
+        data['error'] = str(ex)
+        return data
+
+    data['returncode'] = result['returncode']
+    data['stdout'] = result['stdout'].decode('utf-8', errors='replace')
+    if result['returncode'] == 0:
+        data.update(parse_chassis_status(data['stdout']))
+    else:
+        data['error'] = f'ipmitool exited with returncode {result["returncode"]}'
+
+    return data
+
+def refresh_ipmi_status(networkdevices, timeout=15, concurrency=16):
+    '''
+    Refresh the cached IPMIStatus of many (Puppet managed) NetworkDevices, talking
+    to at most "concurrency" BMCs at once. Returns a dictionary of the updated
+    IPMIStatus objects, keyed by NetworkDevice primary key.
+
+    Only the BMC queries run in worker threads: the BMC targets are looked up (which
+    loads the PuppetMachine and Site, unless they were selected with the devices)
+    and all database writes happen in the calling thread.
+    '''
+    networkdevices = list(networkdevices)
+    statuses = {}
+    if len(networkdevices) <= 0:
+        return statuses
+
+    targets = [(networkdevice, ipmi_target(networkdevice)) for networkdevice in networkdevices]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(networkdevices), concurrency))) as executor:
+        futures = {executor.submit(fetch_chassis_status, target, timeout): networkdevice
+                   for (networkdevice, target) in targets}
+
+        for future in as_completed(futures):
+            networkdevice = futures[future]
+            (ipmistatus, created) = IPMIStatus.objects.update_or_create(
+                puppetmachine_id=networkdevice.pk,
+                defaults=future.result(),
+            )
+            statuses[networkdevice.pk] = ipmistatus
+
+    return statuses
+
+def invalidate_ipmi_status(networkdevice_ids):
+    '''Throw away the cached IPMIStatus (after a power on/off, for example)'''
+    IPMIStatus.objects.filter(puppetmachine_id__in=networkdevice_ids).delete()
+
+def fetch_ipmi_ipaddress(puppetmachine):
+    '''
+    Fetch the "ipmi_ipaddress" Puppet Fact of a PuppetMachine from PuppetDB.
+    Returns None if the fact is missing or is not a valid IPv4 address.
+    '''
+    value = puppetmachine.get_fact_value('ipmi_ipaddress')
+    try:
+        return str(IPv4Address(value))
+    except ValueError as ex:
+        return None
+
+def sync_ipmi_ipaddresses(puppetmachines, concurrency=16):
+    '''
+    Copy the "ipmi_ipaddress" Puppet Fact into PuppetMachine.ipmi_ipaddress for
+    each PuppetMachine which does not have a manually set BMC IP Address. The
+    PuppetDB queries run in parallel, at most "concurrency" at once.
+
+    A missing fact never clears a known address (the machine may simply be down).
+    Returns a dictionary with the number of machines updated, unchanged, missing
+    the fact, and the number of PuppetDB errors.
+    '''
+    puppetmachines = [puppetmachine for puppetmachine in puppetmachines if not puppetmachine.ipmi_ipaddress_manual]
+    counts = {
+        'updated': 0,
+        'unchanged': 0,
+        'missing': 0,
+        'errors': 0,
+    }
+    if len(puppetmachines) <= 0:
+        return counts
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(puppetmachines), concurrency))) as executor:
+        futures = {executor.submit(fetch_ipmi_ipaddress, puppetmachine): puppetmachine
+                   for puppetmachine in puppetmachines}
+
+        for future in as_completed(futures):
+            puppetmachine = futures[future]
+            try:
+                ipmi_ipaddress = future.result()
+            except Exception as ex:
+                logger.warning('PuppetDB query failed for PuppetMachine(pk=%s): %s', puppetmachine.pk, ex)
+                counts['errors'] += 1
+                continue
+
+            if ipmi_ipaddress is None:
+                counts['missing'] += 1
+                continue
+
+            # Update only the BMC fields, and never overwrite an address which was
+            # set manually while the PuppetDB query was in flight
+            queryset = PuppetMachine.objects.filter(pk=puppetmachine.pk, ipmi_ipaddress_manual=False)
+            queryset.update(ipmi_ipaddress=ipmi_ipaddress, ipmi_ipaddress_synced_at=timezone.now())
+
+            if ipmi_ipaddress == puppetmachine.ipmi_ipaddress:
+                counts['unchanged'] += 1
+            else:
+                counts['updated'] += 1
+
+    return counts
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
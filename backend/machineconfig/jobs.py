@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+'''
+Helpers for running long-running commands, and for streaming their output back
+to the web client line by line while they are still running.
+
+Commands which run inside of an RQ worker publish each line of output into a
+Redis list belonging to the job, where any web worker can pick them up. When a
+job asks for its output to be persisted, the complete output is moved into the
+database (gzip compressed) once the job is finished, and only kept in Redis for
+long enough to let streaming clients catch up.
+'''
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from rq import get_current_job
+
+from machineconfig.models import JobOutput
+from machineconfig.models import RemoteJob
+
+from contextlib import contextmanager
+import subprocess
+import uuid
+import gzip
+import threading
+import signal
+import json
+import time
+import os
+
+# Keep the output of a job around in Redis for this many seconds after it finishes
+JOB_OUTPUT_TTL = 3600
+
+# ... or this many seconds, when the output has also been persisted to the database
+JOB_OUTPUT_PERSISTED_TTL = 300
+
+# How often (in seconds) a streaming response checks Redis for new job output
+JOB_OUTPUT_POLL_INTERVAL = 0.5
+
+# A streaming response gives up this many seconds after the job timeout (allowing for time in the queue)
+JOB_OUTPUT_STREAM_MARGIN = 60
+
+# Job timeout assumed for jobs which have none of their own (the RQ default)
+JOB_DEFAULT_TIMEOUT = 180
+
+def job_output_key(job_id):
+    '''The Redis key of the list which holds the output lines of an RQ job'''
+    return f'machineconfig:job:{job_id}:output'
+
+def json_default(value):
+    '''JSON encoder fallback: decode command output (bytes) as text, stringify anything else'''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+
+    return str(value)
+
+def streaming_ndjson_response(generator):
+    '''
+    Return a newline-delimited JSON response which sends each item produced by
+    the generator to the client as soon as it is available.
+    '''
+    response = StreamingHttpResponse(generator, content_type='application/x-ndjson')
+    # Ask NGINX not to buffer the response, and the client not to cache it
+    response['X-Accel-Buffering'] = 'no'
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def stream_command(cmd, timeout, env=None):
+    '''
+    Run a command, capturing all output into a single stream, and yield each line
+    of output (as bytes) as soon as it is produced. The generator returns the
+    returncode of the command when it is exhausted.
+
+    The command is killed if it runs longer than the timeout (in seconds), and
+    subprocess.TimeoutExpired is raised, the same as subprocess.run() would.
+    '''
+    # Start the command in its own process group, so that any children it starts
+    # (which would also hold the output pipe open) are killed along with it
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    expired = threading.Event()
+
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError as ex:
+            pass
+
+    def expire():
+        expired.set()
+        kill()
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+
+    try:
+        for line in proc.stdout:
+            yield line
+
+        returncode = proc.wait()
+    finally:
+        # also runs when the consumer goes away early (client disconnected)
+        timer.cancel()
+        if proc.poll() is None:
+            kill()
+            proc.wait()
+
+        proc.stdout.close()
+
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    return returncode
+
+def stream_command_output(cmd, timeout, env=None):
+    '''
+    Run a command directly (not in an RQ job), and yield newline-delimited JSON
+    for its output, one object per line, as it is produced. When the command is
+    complete, a final object with the returncode is produced.
+    '''
+    generator = stream_command(cmd, timeout=timeout, env=env)
+    try:
+        while True:
+            line = next(generator)
+            yield json.dumps({'output': line.decode('utf-8', errors='replace'), }) + '\n'
+    except StopIteration as ex:
+        yield json.dumps({'returncode': ex.value, }) + '\n'
+    except subprocess.TimeoutExpired as ex:
+        yield json.dumps({'returncode': None, 'error': str(ex), }) + '\n'
+
+def run_streaming_command(cmd, timeout, env=None, persist=False):
+    '''
+    Run a command from inside of an RQ job, publishing each line of output to
+    Redis as it is produced. The output is deliberately *not* returned, so that
+    it does not get pickled into the job result. Use job_output() to fetch it.
+
+    With persist=True, the complete output is also saved into the database (see
+    JobOutput) when the command finishes, even if it timed out.
+    '''
+    job = get_current_job()
+    connection = job.connection
+    key = job_output_key(job.id)
+
+    lines = 0
+    returncode = None
+    generator = stream_command(cmd, timeout=timeout, env=env)
+    try:
+        while True:
+            line = next(generator)
+            connection.rpush(key, line)
+            lines += 1
+    except StopIteration as ex:
+        returncode = ex.value
+    finally:
+        if persist:
+            persist_job_output(connection, job.id, returncode)
+            connection.expire(key, JOB_OUTPUT_PERSISTED_TTL)
+        else:
+            connection.expire(key, JOB_OUTPUT_TTL)
+
+    data = {
+        'returncode': returncode,
+        'lines': lines,
+    }
+    return data
+
+def persist_job_output(connection, job_id, returncode):
+    '''Copy the complete output of an RQ job from Redis into the database (gzip compressed)'''
+    lines = connection.lrange(job_output_key(job_id), 0, -1)
+    output = b''.join(lines)
+    (joboutput, created) = JobOutput.objects.update_or_create(job_id=job_id, defaults={
+        'returncode': returncode,
+        'lines': len(lines),
+        'size': len(output),
+        'output': gzip.compress(output),
+    })
+    return joboutput
+
+def job_output(connection, job_id, start=0, end=-1):
+    '''
+    Return the output lines (list of bytes) published so far by an RQ job, using
+    the same (inclusive, negative from the end) indexing as Redis LRANGE. Output
+    which has already expired from Redis is read from the database instead.
+    '''
+    key = job_output_key(job_id)
+    lines = connection.lrange(key, start, end)
+    if len(lines) > 0 or connection.exists(key):
+        return lines
+
+    joboutput = JobOutput.objects.filter(job_id=job_id).first()
+    if joboutput is None:
+        return []
+
+    return joboutput.get_lines(start, None if end == -1 else end + 1)
+
+def job_output_length(connection, job_id):
+    '''Return the number of output lines published so far by an RQ job'''
+    key = job_output_key(job_id)
+    if connection.exists(key):
+        return connection.llen(key)
+
+    joboutput = JobOutput.objects.filter(job_id=job_id).only('lines').first()
+    return joboutput.lines if joboutput is not None else 0
+
+def read_job_output(connection, job_id, start=None, limit=None, tail=None):
+    '''
+    Read part of the output of an RQ job: either "limit" lines from line "start",
+    or the last "tail" lines. Returns a dictionary with the total number of lines,
+    the index of the first line returned, and the lines themselves (as text).
+    '''
+    total = job_output_length(connection, job_id)
+    if tail is not None:
+        start = max(0, total - tail)
+        end = total - 1
+    else:
+        start = start or 0
+        end = (start + limit - 1) if limit is not None else -1
+
+    lines = job_output(connection, job_id, start=start, end=end) if start < total else []
+    data = {
+        'total': total,
+        'start': start,
+        'lines': [line.decode('utf-8', errors='replace') for line in lines],
+    }
+    return data
+
+def stream_job_output(job):
+    '''
+    Yield newline-delimited JSON for the output of an RQ job, one object per line
+    of output, as the job produces it. When the job is complete, a final object
+    with the job status and result is produced.
+
+    A job which has expired from Redis (or was deleted) has no status: it counts
+    as complete. The stream also ends JOB_OUTPUT_STREAM_MARGIN seconds after the
+    job timeout, so that a lost job never ties up a web worker forever.
+    '''
+    timeout = job.timeout if job.timeout is not None and job.timeout > 0 else JOB_DEFAULT_TIMEOUT
+    deadline = time.monotonic() + timeout + JOB_OUTPUT_STREAM_MARGIN
+
+    offset = 0
+    while True:
+        # check the status *before* reading, so that no output can be missed
+        # between reading the last lines and noticing that the job is complete
+        status = job.get_status(refresh=True)
+        done = status in (None, 'finished', 'failed', 'stopped', 'canceled', )
+        expired = time.monotonic() >= deadline
+
+        lines = job_output(job.connection, job.id, start=offset)
+        offset += len(lines)
+        for line in lines:
+            yield json.dumps({'output': line.decode('utf-8', errors='replace'), }) + '\n'
+
+        if done or expired:
+            data = {
+                'status': status,
+                'result': job.result if status == 'finished' else None,
+            }
+            if status is None:
+                data['error'] = f'Job {job.id} has expired or was deleted'
+            elif not done:
+                data['error'] = f'Gave up waiting for job {job.id} after {timeout + JOB_OUTPUT_STREAM_MARGIN} seconds'
+
+            yield json.dumps(data, default=json_default) + '\n'
+            return
+
+        time.sleep(JOB_OUTPUT_POLL_INTERVAL)
+
+def create_remote_job(kind, networkdevice_id=None, requested_by=''):
+    '''
+    Create the RemoteJob history record for a job which is about to be enqueued.
+    The record carries a freshly generated job id: pass it to queue.enqueue() as
+    job_id, so that the worker can never start the job before the record exists.
+    '''
+    remotejob = RemoteJob.objects.create(
+        job_id=str(uuid.uuid4()),
+        kind=kind,
+        networkdevice_id=networkdevice_id,
+        requested_by=requested_by,
+        status='queued',
+        enqueued_at=timezone.now(),
+    )
+    return remotejob
+
+@contextmanager
+def remote_job_history(kind, networkdevice_id=None):
+    '''
+    Keep the RemoteJob history record of the current RQ job up to date. Use this
+    inside of the job function, wrapped around all of the work:
+
+    with remote_job_history('puppet_agent_test', networkdevice_id) as remotejob:
+        ...
+        remotejob.returncode = 0
+
+    The record is marked as started on entry, and as finished (or failed, if an
+    exception escapes, including the RQ job timeout) with its duration on exit.
+    '''
+    job = get_current_job()
+    started_at = timezone.now()
+    (remotejob, created) = RemoteJob.objects.get_or_create(job_id=job.id, defaults={
+        'kind': kind,
+        'networkdevice_id': networkdevice_id,
+        'enqueued_at': started_at,
+    })
+    remotejob.status = 'started'
+    remotejob.started_at = started_at
+    remotejob.save(update_fields=['status', 'started_at', ])
+
+    try:
+        yield remotejob
+        remotejob.status = 'finished'
+    except Exception as ex:
+        remotejob.status = 'failed'
+        raise
+    finally:
+        remotejob.finished_at = timezone.now()
+        remotejob.duration = (remotejob.finished_at - started_at).total_seconds()
+        remotejob.save()
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from machineconfig.renderers import FastJSONRenderer
+from machineconfig.renderers import MessagePackRenderer
+from machineconfig.renderers import msgpack
+from machineconfig.renderers import orjson
+
+import datetime
+import gzip
+import json
+import time
+
+class Command(BaseCommand):
+    help = '''Compare the render time and payload size of the API renderers on a synthetic Site'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=5000, help='Number of NetworkDevices at the synthetic Site')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of times to render (the fastest is shown)')
+
+    def synthetic_device(self, pk, now):
+        '''One NetworkDevice, shaped like the NetworkDeviceSerializer output'''
+        hostname = f'host{pk}.tst.lco.gtn'
+        ipaddress = f'10.99.{pk // 250}.{pk % 250 + 1}'
+        mac = ':'.join(f'{(pk >> shift) & 0xff:02x}' for shift in (40, 32, 24, 16, 8, 0))
+        return {
+            'id': pk,
+            'created_at': now - datetime.timedelta(days=pk),
+            'updated_at': now,
+            'site': 1,
+            'image': None,
+            'information': f'Rack {pk % 40}, unit {pk % 42}: synthetic device for the renderer benchmark',
+            'fmxurl': '',
+            'primary_mac': mac,
+            'primary_staticip': ipaddress,
+            'primary_hostname': hostname,
+            'puppetmachine': {
+                'operatingsystem': 'centos-7-x86_64',
+                'partitionscheme': 'default',
+                'partitionscheme_custom': '',
+                'boot_mode': 'local',
+                'ipmi_ipaddress': None,
+                'ipmi_ipaddress_manual': False,
+                'ipmi_ipaddress_synced_at': None,
+                'lastboot_at': now,
+                'boot_history': [],
+                'lastbuild_at': now,
+                'build_history': [],
+            },
+            'webcam': None,
+            'networkinterface_set': [{
+                'id': pk,
+                'mac': mac,
+                'description': 'eth0',
+                'networkinterfaceconfiguration_set': [{
+                    'id': pk,
+                    'ipaddress': ipaddress,
+                    'hostname_set': [{'id': pk, 'hostname': hostname, }, {'id': pk, 'hostname': f'alias{pk}.tst.lco.gtn', }],
+                }],
+            }],
+            'dnsrecords': [
+                {'hostname': hostname, 'record_type': 'A', 'target': ipaddress, 'reverse_pointer': None, },
+                {'hostname': f'alias{pk}.tst.lco.gtn', 'record_type': 'CNAME', 'target': hostname, 'reverse_pointer': None, },
+            ],
+            'dhcprecords': [
+                {'macaddress': mac, 'ipaddress': ipaddress, 'hostname': hostname, },
+            ],
+        }
+
+    def handle(self, *args, **options):
+        devices = options['devices']
+        repeat = options['repeat']
+        if devices <= 0 or repeat <= 0:
+            raise CommandError('--devices and --repeat must be positive')
+
+        now = timezone.now()
+        data = {
+            'id': 1,
+            'code': 'tst',
+            'domain': 'tst.lco.gtn',
+            'devices': [self.synthetic_device(pk, now) for pk in range(1, devices + 1)],
+        }
+
+        renderers = [
+            ('DRF JSONRenderer', JSONRenderer(), ),
+            ('FastJSONRenderer' + (' (orjson)' if orjson is not None else ' (orjson not installed)'),
+                FastJSONRenderer(), ),
+        ]
+        if msgpack is not None:
+            renderers.append(('MessagePackRenderer', MessagePackRenderer(), ))
+        else:
+            self.stdout.write(self.style.WARNING('msgpack is not installed: skipping MessagePackRenderer'))
+
+        self.stdout.write(f'Synthetic Site with {devices} NetworkDevices, best of {repeat} renders')
+        self.stdout.write(f'{"renderer":40s} {"time":>10s} {"size":>14s} {"gzip size":>12s}  same data')
+
+        baseline = None
+        for (name, renderer) in renderers:
+            timings = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                content = renderer.render(data, renderer.media_type)
+                timings.append(time.perf_counter() - start)
+
+            # every renderer must produce the same data as the DRF JSONRenderer
+            decoded = msgpack.unpackb(content) if renderer.format == 'msgpack' else json.loads(content)
+            if baseline is None:
+                baseline = decoded
+
+            self.stdout.write(f'{name:40s} {min(timings) * 1000:8.1f}ms {len(content):>14,} '
+                              f'{len(gzip.compress(content)):>12,}  {"yes" if decoded == baseline else "NO"}')
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from machineconfig.models import Site
+from machineconfig.resolver import check_dns_records
+
+class Command(BaseCommand):
+    help = '''Compare the DNS records generated for a Site against a live nameserver'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', help='Site code (for example: lsc)')
+        parser.add_argument('--nameserver', default=None, help='Nameserver to check (default: first Site DNS server)')
+        parser.add_argument('--port', type=int, default=53, help='Nameserver port (default: 53)')
+        parser.add_argument('--concurrency', type=int, default=64, help='Maximum DNS queries in flight (default: 64)')
+        parser.add_argument('--timeout', type=float, default=2.0, help='Timeout per DNS query attempt (seconds)')
+        parser.add_argument('--verbose', action='store_true', default=False, help='Also print the correct records')
+
+    def handle(self, *args, **options):
+        try:
+            site = Site.objects.filter(code__iexact=options['site']).get()
+        except Site.DoesNotExist as ex:
+            raise CommandError(f'No Site object found for code={options["site"]}')
+
+        nameserver = options['nameserver']
+        if nameserver is None and len(site.dnsservers) > 0:
+            nameserver = site.dnsservers[0]
+
+        data = check_dns_records(site.drf_dnsrecords, nameserver=nameserver, port=options['port'],
+                                 timeout=options['timeout'], concurrency=options['concurrency'])
+
+        for record in data['records']:
+            message = f'{record["status"].upper():8} {record["record_type"]:5} {record["hostname"]} ' \
+                      f'expected={record["expected"]} actual={",".join(record["actual"]) or "-"}'
+            if record['status'] == 'ok':
+                if options['verbose']:
+                    self.stdout.write(self.style.SUCCESS(message))
+            elif record['status'] == 'error':
+                self.stdout.write(self.style.ERROR(f'{message} error={record["error"]}'))
+            else:
+                self.stdout.write(self.style.WARNING(message))
+
+        counts = ' '.join(f'{name}={count}' for (name, count) in data['counts'].items())
+        self.stdout.write(f'Checked {data["total"]} records against nameserver {data["nameserver"]}: {counts}')
+
+        if data['counts']['ok'] != data['total']:
+            raise CommandError(f'DNS for Site {site.code} does not match the generated records')
@@ -0,0 +1,123 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import OutputWrapper
+
+from machineconfig.models import Site
+from machineconfig.resolver import CLASS_IN
+from machineconfig.resolver import RECORD_TYPES
+from machineconfig.resolver import decode_name
+from machineconfig.resolver import encode_name
+
+import asyncio
+import socket
+import struct
+import sys
+
+class StandInDNSProtocol(asyncio.DatagramProtocol):
+    '''
+    A minimal authoritative DNS server, which answers A, PTR and CNAME queries
+    from a fixed set of records. It is only good enough to test against.
+    '''
+    def __init__(self, records, ttl, stderr=None):
+        self.records = records
+        self.ttl = ttl
+        self.stderr = stderr if stderr is not None else OutputWrapper(sys.stderr)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = self.answer(data)
+        except (IndexError, struct.error) as ex:
+            self.stderr.write(f'Ignoring malformed query from {addr}: {ex}')
+            return
+
+        self.transport.sendto(response, addr)
+
+    def answer(self, query):
+        (query_id, flags) = struct.unpack_from('!HH', query, 0)
+        (name, offset) = decode_name(query, 12)
+        (qtype, qclass) = struct.unpack_from('!HH', query, offset)
+        question = query[12:offset + 4]
+
+        answers = []
+        known = any(key[0] == name for key in self.records)
+        for (record_type, target) in self.records.get((name, qtype), []):
+            answers.append((record_type, target))
+
+        # like a real nameserver, an address query for an alias returns the CNAME
+        if len(answers) <= 0 and qtype == RECORD_TYPES['A']:
+            for (record_type, target) in self.records.get((name, RECORD_TYPES['CNAME']), []):
+                answers.append((record_type, target))
+
+        # QR + AA, copy RD from the query, NXDOMAIN if the name is not known at all
+        rcode = 0 if known else 3
+        flags = 0x8400 | (flags & 0x0100) | rcode
+        header = struct.pack('!HHHHHH', query_id, flags, 1, len(answers), 0, 0)
+
+        message = header + question
+        for (record_type, target) in answers:
+            if record_type == RECORD_TYPES['A']:
+                rdata = socket.inet_aton(target)
+            else:
+                rdata = encode_name(target)
+
+            # the answer name is a compression pointer to the name in the question
+            message += struct.pack('!HHHIH', 0xc00c, record_type, CLASS_IN, self.ttl, len(rdata)) + rdata
+
+        return message
+
+def standin_records(dnsrecords, omit=()):
+    '''
+    The records served by the stand-in nameserver, from the records of a Site (in
+    the format produced by Site.drf_dnsrecords), keyed by (hostname, record type).
+    Hostnames in omit are left out.
+    '''
+    omit = set(hostname.rstrip('.').lower() for hostname in omit)
+
+    records = {}
+    for record in dnsrecords:
+        if record['record_type'] not in ('A', 'PTR', 'CNAME', ) or record['target'] is None:
+            continue
+
+        hostname = record['hostname'].rstrip('.').lower()
+        if hostname in omit:
+            continue
+
+        key = (hostname, RECORD_TYPES[record['record_type']])
+        records.setdefault(key, []).append((RECORD_TYPES[record['record_type']], str(record['target'])))
+
+    return records
+
+class Command(BaseCommand):
+    help = '''Serve the generated DNS records for a Site from a stand-in nameserver (for testing)'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', help='Site code (for example: lsc)')
+        parser.add_argument('--address', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=5353, help='UDP port to listen on (default: 5353)')
+        parser.add_argument('--ttl', type=int, default=60, help='TTL of the records served (default: 60)')
+        parser.add_argument('--omit', action='append', default=[], help='Hostname to leave out (may be repeated)')
+
+    def handle(self, *args, **options):
+        try:
+            site = Site.objects.filter(code__iexact=options['site']).get()
+        except Site.DoesNotExist as ex:
+            raise CommandError(f'No Site object found for code={options["site"]}')
+
+        records = standin_records(site.drf_dnsrecords, omit=options['omit'])
+        self.stdout.write(f'Serving {len(records)} DNS names for Site {site.code} on {options["address"]}:{options["port"]}')
+        asyncio.run(self.serve(records, options['address'], options['port'], options['ttl']))
+
+    async def serve(self, records, address, port, ttl):
+        loop = asyncio.get_running_loop()
+        (transport, protocol) = await loop.create_datagram_endpoint(
+            lambda: StandInDNSProtocol(records, ttl, stderr=self.stderr),
+            local_addr=(address, port),
+        )
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
@@ -9,6 +9,7 @@ from machineconfig.models import PuppetMachine
 from machineconfig.models import NetworkDevice
 from machineconfig.models import NetworkInterface
 from machineconfig.models import NetworkInterfaceConfiguration
+from machineconfig.nested import refresh_primary_fields
 
 class IntentionalAbortError(Exception):
     pass
@@ -66,6 +67,9 @@ class Command(BaseCommand):
             hostname.hostname = machine.hostname
             hostname.save()
 
+            # NetworkDevice.primary_* (denormalized from the objects above)
+            refresh_primary_fields([networkdevice, ])
+
             # ABORT in non-destructive mode
             if not destructive:
                 raise IntentionalAbortError('Intentional abort on --destructive=False')
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from machineconfig.models import NetworkDevice
+from machineconfig.ipmi import refresh_ipmi_status
+
+import time
+
+class Command(BaseCommand):
+    help = '''Refresh the cached IPMI chassis status of all NetworkDevices with a known BMC IP Address'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', default=None, help='Only poll devices at this Site code (default: all Sites)')
+        parser.add_argument('--interval', type=int, default=0, help='Poll forever, every INTERVAL seconds (default: poll once)')
+        parser.add_argument('--concurrency', type=int, default=16, help='Maximum BMCs queried at once (default: 16)')
+        parser.add_argument('--timeout', type=int, default=15, help='Timeout for each BMC, in seconds (default: 15)')
+
+    def poll_once(self, options):
+        queryset = NetworkDevice.objects.filter(puppetmachine__ipmi_ipaddress__isnull=False)
+        queryset = queryset.select_related('site', 'puppetmachine')
+        if options['site'] is not None:
+            queryset = queryset.filter(site__code__iexact=options['site'])
+
+        start = time.monotonic()
+        statuses = refresh_ipmi_status(queryset, timeout=options['timeout'], concurrency=options['concurrency'])
+        elapsed = time.monotonic() - start
+
+        errors = 0
+        for (pk, ipmistatus) in sorted(statuses.items()):
+            if ipmistatus.error:
+                errors += 1
+                self.stdout.write(self.style.WARNING(f'NetworkDevice(pk={pk}): {ipmistatus.error}'))
+            elif ipmistatus.faults:
+                self.stdout.write(self.style.WARNING(f'NetworkDevice(pk={pk}): faults: {", ".join(ipmistatus.faults)}'))
+
+        self.stdout.write(f'Polled {len(statuses)} BMCs in {elapsed:.1f} seconds ({errors} errors)')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        while True:
+            close_old_connections()
+            start = time.monotonic()
+            self.poll_once(options)
+
+            if options['interval'] <= 0:
+                break
+
+            time.sleep(max(0, options['interval'] - (time.monotonic() - start)))
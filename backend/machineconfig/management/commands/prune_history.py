@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from machineconfig.retention import RETENTION_TABLES
+from machineconfig.retention import prune_table
+from machineconfig.retention import retention_cutoff
+
+import time
+
+class Command(BaseCommand):
+    help = '''Delete history older than its retention period (settings.HISTORY_RETENTION_DAYS)'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', choices=sorted(RETENTION_TABLES), action='append', default=None, help='Only prune this table (may be repeated, default: all)')
+        parser.add_argument('--interval', type=int, default=0, help='Prune forever, every INTERVAL seconds (default: prune once)')
+        parser.add_argument('--batch-size', type=int, default=None, help='Maximum rows deleted per transaction (default: settings.HISTORY_RETENTION_BATCH_SIZE)')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches (default: 0.1)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be deleted')
+
+    def prune_once(self, tables, options):
+        for name in tables:
+            cutoff = retention_cutoff(name)
+            if cutoff is None:
+                self.stdout.write(f'{name}: kept forever')
+                continue
+
+            start = time.monotonic()
+            count = prune_table(name, cutoff=cutoff, batch_size=options['batch_size'], pause=options['pause'],
+                                dry_run=options['dry_run'])
+            elapsed = time.monotonic() - start
+
+            verb = 'Would delete' if options['dry_run'] else 'Deleted'
+            self.stdout.write(f'{name}: {verb} {count} rows older than {cutoff:%Y-%m-%d %H:%M} in {elapsed:.1f} seconds')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        tables = options['table'] if options['table'] is not None else sorted(RETENTION_TABLES)
+
+        while True:
+            close_old_connections()
+            start = time.monotonic()
+            self.prune_once(tables, options)
+
+            if options['interval'] <= 0:
+                break
+
+            time.sleep(max(0, options['interval'] - (time.monotonic() - start)))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from machineconfig.models import HistoryRollup
+from machineconfig.rollups import ROLLUP_SOURCES
+from machineconfig.rollups import update_rollups
+
+import time
+
+class Command(BaseCommand):
+    help = '''Incrementally update the hourly/daily rollups of the boot and build history'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=sorted(ROLLUP_SOURCES), default=None, help='Only update this kind of history (default: all)')
+        parser.add_argument('--interval', type=int, default=0, help='Update forever, every INTERVAL seconds (default: update once)')
+        parser.add_argument('--rebuild', action='store_true', help='Throw away all existing rollups and recompute them from scratch (counts for pruned history are lost)')
+
+    def update_once(self, kinds):
+        for kind in kinds:
+            start = time.monotonic()
+            count = update_rollups(kind)
+            elapsed = time.monotonic() - start
+            self.stdout.write(f'Updated {count} hourly {kind} history rollups in {elapsed:.1f} seconds')
+
+    def handle(self, *args, **options):
+        kinds = [options['kind'], ] if options['kind'] is not None else sorted(ROLLUP_SOURCES)
+
+        if options['rebuild']:
+            if options['interval'] > 0:
+                raise CommandError('--rebuild cannot be combined with --interval')
+
+            HistoryRollup.objects.filter(kind__in=kinds).delete()
+
+        while True:
+            close_old_connections()
+            start = time.monotonic()
+            self.update_once(kinds)
+
+            if options['interval'] <= 0:
+                break
+
+            time.sleep(max(0, options['interval'] - (time.monotonic() - start)))
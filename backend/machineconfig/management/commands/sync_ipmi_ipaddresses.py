@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from machineconfig.models import PuppetMachine
+from machineconfig.ipmi import sync_ipmi_ipaddresses
+
+import time
+
+class Command(BaseCommand):
+    help = '''Sync PuppetMachine BMC IP Addresses from the "ipmi_ipaddress" PuppetDB Fact'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', default=None, help='Only sync machines at this Site code (default: all Sites)')
+        parser.add_argument('--interval', type=int, default=0, help='Sync forever, every INTERVAL seconds (default: sync once)')
+        parser.add_argument('--concurrency', type=int, default=16, help='Maximum PuppetDB queries at once (default: 16)')
+
+    def sync_once(self, options):
+        # machines with a manually set BMC IP Address are never synced
+        queryset = PuppetMachine.objects.filter(ipmi_ipaddress_manual=False)
+        queryset = queryset.select_related('networkdevice')
+        if options['site'] is not None:
+            queryset = queryset.filter(networkdevice__site__code__iexact=options['site'])
+
+        start = time.monotonic()
+        counts = sync_ipmi_ipaddresses(queryset, concurrency=options['concurrency'])
+        elapsed = time.monotonic() - start
+
+        counts = ' '.join(f'{name}={count}' for (name, count) in counts.items())
+        self.stdout.write(f'Synced BMC IP Addresses in {elapsed:.1f} seconds: {counts}')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        while True:
+            close_old_connections()
+            start = time.monotonic()
+            self.sync_once(options)
+
+            if options['interval'] <= 0:
+                break
+
+            time.sleep(max(0, options['interval'] - (time.monotonic() - start)))
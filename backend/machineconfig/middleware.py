@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+from django.utils.deprecation import MiddlewareMixin
+
+from machineconfig.compression import compress_response
+
+class CompressionMiddleware(MiddlewareMixin):
+    '''
+    Replaces the standard Django GZip middleware: compresses responses with the best
+    encoding the client accepts (zstd, br or gzip), but only responses which are
+    worth it. Streaming responses are never compressed, because the compressor
+    buffers its output, which would hold back each line of a streamed response
+    until many kilobytes had accumulated. See machineconfig.compression.
+    '''
+    def process_response(self, request, response):
+        return compress_response(request, response)
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:23
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0071_auto_20201006_1910'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IPMIStatus',
+            fields=[
+                ('puppetmachine', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='machineconfig.puppetmachine', verbose_name='Puppet Machine')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bmc', models.CharField(blank=True, max_length=255, verbose_name='BMC Address')),
+                ('power_on', models.BooleanField(null=True, verbose_name='Is the Chassis Power on?')),
+                ('faults', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=64), blank=True, default=list, size=None, verbose_name='Active Faults')),
+                ('returncode', models.IntegerField(null=True, verbose_name='ipmitool returncode')),
+                ('stdout', models.TextField(blank=True, verbose_name='ipmitool output')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+            ],
+        ),
+    ]
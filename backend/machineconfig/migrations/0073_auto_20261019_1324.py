@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0072_ipmistatus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='puppetmachine',
+            name='ipmi_ipaddress',
+            field=models.GenericIPAddressField(blank=True, null=True, protocol='ipv4', verbose_name='BMC IP Address'),
+        ),
+        migrations.AddField(
+            model_name='puppetmachine',
+            name='ipmi_ipaddress_manual',
+            field=models.BooleanField(default=False, verbose_name='BMC IP Address was set manually (do not sync from PuppetDB)'),
+        ),
+        migrations.AddField(
+            model_name='puppetmachine',
+            name='ipmi_ipaddress_synced_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='BMC IP Address last synced from PuppetDB'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0073_auto_20261019_1324'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobOutput',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64, unique=True, verbose_name='RQ Job ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('returncode', models.IntegerField(blank=True, null=True, verbose_name='Return Code')),
+                ('lines', models.IntegerField(default=0, verbose_name='Number of Lines')),
+                ('size', models.IntegerField(default=0, verbose_name='Uncompressed Size (bytes)')),
+                ('output', models.BinaryField(verbose_name='Output (gzip compressed)')),
+            ],
+        ),
+    ]
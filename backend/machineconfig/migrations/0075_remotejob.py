@@ -0,0 +1,43 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0074_joboutput'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemoteJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64, unique=True, verbose_name='RQ Job ID')),
+                ('kind', models.CharField(choices=[('puppet_agent_test', 'Puppet Agent Test'), ('puppet_batch', 'Puppet Batch')], max_length=32, verbose_name='Kind')),
+                ('requested_by', models.CharField(blank=True, max_length=256, verbose_name='Requested By')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('started', 'Started'), ('finished', 'Finished'), ('failed', 'Failed')], default='queued', max_length=32, verbose_name='Status')),
+                ('enqueued_at', models.DateTimeField(blank=True, null=True, verbose_name='Enqueued At')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('duration', models.FloatField(blank=True, null=True, verbose_name='Duration (seconds)')),
+                ('returncode', models.IntegerField(blank=True, null=True, verbose_name='Return Code')),
+                ('summary', models.JSONField(blank=True, default=dict, verbose_name='Summary')),
+                ('networkdevice', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='machineconfig.networkdevice')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='remotejob',
+            index=models.Index(fields=['kind', 'enqueued_at'], name='machineconf_kind_fc8215_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='remotejob',
+            index=models.Index(fields=['networkdevice', 'enqueued_at'], name='machineconf_network_36fc76_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='remotejob',
+            index=models.Index(fields=['status'], name='machineconf_status_fdec06_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0075_remotejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('boot', 'Boot History'), ('build', 'Build History')], max_length=16, verbose_name='Kind')),
+                ('resolution', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=16, verbose_name='Resolution')),
+                ('key', models.CharField(blank=True, max_length=32, verbose_name='Boot Mode or Build Status')),
+                ('bucket', models.DateTimeField(verbose_name='Start of the Time Bucket')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('site', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='machineconfig.site')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='historyrollup',
+            index=models.Index(fields=['kind', 'resolution', 'bucket'], name='machineconf_kind_46d4fa_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='historyrollup',
+            unique_together={('kind', 'resolution', 'site', 'key', 'bucket')},
+        ),
+    ]
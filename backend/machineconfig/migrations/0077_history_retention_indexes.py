@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0076_historyrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='history',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Timestamp'),
+        ),
+        migrations.AlterField(
+            model_name='joboutput',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='unrecognizedpxedevice',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
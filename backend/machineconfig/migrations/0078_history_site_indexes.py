@@ -0,0 +1,48 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0077_history_retention_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boothistory',
+            name='site',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='machineconfig.site'),
+        ),
+        migrations.AddField(
+            model_name='buildhistory',
+            name='site',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='machineconfig.site'),
+        ),
+        migrations.AddIndex(
+            model_name='boothistory',
+            index=models.Index(fields=['puppetmachine', '-created_at'], name='machineconf_puppetm_d15cff_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='boothistory',
+            index=models.Index(fields=['created_at', 'boot_mode'], name='machineconf_created_5b0739_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='boothistory',
+            index=models.Index(fields=['site', 'created_at'], name='machineconf_site_id_df6f9f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='buildhistory',
+            index=models.Index(fields=['puppetmachine', '-created_at'], name='machineconf_puppetm_80ad36_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='buildhistory',
+            index=models.Index(fields=['created_at', 'status'], name='machineconf_created_7e5dd3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='buildhistory',
+            index=models.Index(fields=['site', 'created_at'], name='machineconf_site_id_b98672_idx'),
+        ),
+    ]
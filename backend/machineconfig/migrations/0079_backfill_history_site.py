@@ -0,0 +1,27 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:34
+# https://docs.djangoproject.com/en/3.1/topics/migrations/#data-migrations
+
+from django.db import migrations
+
+def backfill_history_site(apps, schema_editor):
+    # We can't import the history models directly as they may be a newer
+    # version than this migration expects. We use the historical versions.
+    Site = apps.get_model('machineconfig', 'Site')
+    BootHistory = apps.get_model('machineconfig', 'BootHistory')
+    BuildHistory = apps.get_model('machineconfig', 'BuildHistory')
+
+    # one UPDATE per Site and table, rather than one per history record
+    for site in Site.objects.all():
+        for model in (BootHistory, BuildHistory, ):
+            queryset = model.objects.filter(site__isnull=True, puppetmachine__networkdevice__site=site)
+            queryset.update(site=site)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0078_history_site_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_history_site, migrations.RunPython.noop),
+    ]
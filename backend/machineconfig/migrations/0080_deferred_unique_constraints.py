@@ -0,0 +1,44 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:37
+
+from django.db import migrations, models
+import django.db.models.constraints
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0079_backfill_history_site'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='hostname',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterModelOptions(
+            name='networkinterface',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterModelOptions(
+            name='networkinterfaceconfiguration',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterField(
+            model_name='hostname',
+            name='hostname',
+            field=models.CharField(max_length=256, verbose_name='Hostname'),
+        ),
+        migrations.AlterField(
+            model_name='networkinterface',
+            name='mac',
+            field=models.CharField(max_length=17, verbose_name='MAC Address'),
+        ),
+        migrations.AddConstraint(
+            model_name='hostname',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('hostname',), name='hostname_hostname_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='networkinterface',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('mac',), name='networkinterface_mac_unique'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0080_deferred_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkdevice',
+            name='primary_hostname',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=256, null=True, verbose_name='Primary Hostname'),
+        ),
+        migrations.AddField(
+            model_name='networkdevice',
+            name='primary_mac',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17, null=True, verbose_name='Primary MAC Address'),
+        ),
+        migrations.AddField(
+            model_name='networkdevice',
+            name='primary_staticip',
+            field=models.GenericIPAddressField(blank=True, db_index=True, editable=False, null=True, protocol='IPv4', verbose_name='Primary IP Address'),
+        ),
+    ]
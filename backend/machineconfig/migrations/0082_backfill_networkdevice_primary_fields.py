@@ -0,0 +1,41 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:45
+# https://docs.djangoproject.com/en/3.1/topics/migrations/#data-migrations
+
+from django.db import migrations
+from django.db.models import OuterRef
+from django.db.models import Subquery
+
+def backfill_networkdevice_primary_fields(apps, schema_editor):
+    # We can't import the models directly as they may be a newer
+    # version than this migration expects. We use the historical versions.
+    # The same rules as machineconfig.nested.refresh_primary_fields().
+    NetworkDevice = apps.get_model('machineconfig', 'NetworkDevice')
+    NetworkInterface = apps.get_model('machineconfig', 'NetworkInterface')
+    NetworkInterfaceConfiguration = apps.get_model('machineconfig', 'NetworkInterfaceConfiguration')
+    Hostname = apps.get_model('machineconfig', 'Hostname')
+
+    interfaces = NetworkInterface.objects.filter(networkdevice=OuterRef('pk'))
+    interfaces = interfaces.order_by('pk')
+    configurations = NetworkInterfaceConfiguration.objects.filter(networkinterface__networkdevice=OuterRef('pk'))
+    configurations = configurations.order_by('networkinterface_id', 'pk')
+    hostnames = Hostname.objects.filter(networkinterfaceconfiguration__networkinterface__networkdevice=OuterRef('pk'))
+    hostnames = hostnames.exclude(hostname='')
+    hostnames = hostnames.order_by('networkinterfaceconfiguration__networkinterface_id',
+                                   'networkinterfaceconfiguration_id', 'pk')
+
+    # one UPDATE for every NetworkDevice, rather than one per device
+    NetworkDevice.objects.update(
+        primary_mac=Subquery(interfaces.values('mac')[:1]),
+        primary_staticip=Subquery(configurations.values('ipaddress')[:1]),
+        primary_hostname=Subquery(hostnames.values('hostname')[:1]),
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0081_networkdevice_primary_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_networkdevice_primary_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:47
+
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0082_backfill_networkdevice_primary_fields'),
+    ]
+
+    operations = [
+        # The pg_trgm extension provides the gin_trgm_ops operator class
+        TrigramExtension(),
+        migrations.AlterField(
+            model_name='networkinterfaceconfiguration',
+            name='ipaddress',
+            field=models.GenericIPAddressField(blank=True, db_index=True, null=True, protocol='ipv4', verbose_name='IP Address'),
+        ),
+        migrations.AlterField(
+            model_name='unrecognizedpxedevice',
+            name='ipaddress',
+            field=models.GenericIPAddressField(db_index=True, protocol='ipv4', verbose_name='IP Address'),
+        ),
+        migrations.AlterField(
+            model_name='unrecognizedpxedevice',
+            name='mac',
+            field=models.CharField(db_index=True, max_length=17, verbose_name='MAC Address'),
+        ),
+        migrations.AddIndex(
+            model_name='hostname',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['hostname'], name='hostname_hostname_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='networkdevice',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['information'], name='networkdevice_information_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='networkinterface',
+            index=models.Index(fields=['mac'], name='networkinterface_mac_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
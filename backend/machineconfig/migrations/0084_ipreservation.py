@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0083_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IPReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.GenericIPAddressField(protocol='ipv4', verbose_name='First IP Address')),
+                ('end', models.GenericIPAddressField(protocol='ipv4', verbose_name='Last IP Address')),
+                ('description', models.CharField(blank=True, max_length=256, verbose_name='Description')),
+                ('expires_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Expires At')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='machineconfig.site', verbose_name='Telescope Site')),
+            ],
+            options={
+                'ordering': ['site', 'start'],
+            },
+        ),
+    ]
@@ -0,0 +1,248 @@
+# Generated by Django 3.1.14 on 2026-10-19 13:57
+
+from django.db import migrations, models
+
+# The ChangeLog triggers (see machineconfig.models.ChangeLog).
+#
+# Every INSERT/UPDATE/DELETE of a Site, NetworkDevice, or one of the objects nested
+# within a NetworkDevice (NetworkInterface, NetworkInterfaceConfiguration, Hostname,
+# PuppetMachine, Webcam) queues the ChangeLog row of the Site/NetworkDevice with a
+# NULL version. A deferred constraint trigger assigns the versions when the
+# transaction commits, holding a transaction-level advisory lock until the COMMIT
+# has finished, so that versions become visible in increasing order.
+CHANGELOG_TRIGGERS_SQL = '''
+CREATE SEQUENCE machineconfig_changelog_version_seq OWNED BY machineconfig_changelog.version;
+
+CREATE FUNCTION machineconfig_changelog_touch(kind text, pk integer, is_deleted boolean) RETURNS void AS $$
+BEGIN
+    IF pk IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO machineconfig_changelog (object_type, object_id, version, deleted, changed_at)
+    VALUES (kind, pk, NULL, is_deleted, now())
+    ON CONFLICT (object_type, object_id)
+    DO UPDATE SET version = NULL, deleted = EXCLUDED.deleted, changed_at = EXCLUDED.changed_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A change within a Site or NetworkDevice, which is only recorded if it still exists
+CREATE FUNCTION machineconfig_changelog_touch_existing(kind text, pk integer) RETURNS void AS $$
+BEGIN
+    IF kind = 'site' AND EXISTS (SELECT 1 FROM machineconfig_site WHERE id = pk) THEN
+        PERFORM machineconfig_changelog_touch(kind, pk, false);
+    ELSIF kind = 'networkdevice' AND EXISTS (SELECT 1 FROM machineconfig_networkdevice WHERE id = pk) THEN
+        PERFORM machineconfig_changelog_touch(kind, pk, false);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION machineconfig_changelog_site() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM machineconfig_changelog_touch('site', OLD.id, true);
+    ELSE
+        PERFORM machineconfig_changelog_touch('site', NEW.id, false);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The Site is touched too when its number of devices changes (Site.device_count)
+CREATE FUNCTION machineconfig_changelog_networkdevice() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM machineconfig_changelog_touch('networkdevice', OLD.id, true);
+        PERFORM machineconfig_changelog_touch_existing('site', OLD.site_id);
+    ELSIF TG_OP = 'INSERT' THEN
+        PERFORM machineconfig_changelog_touch('networkdevice', NEW.id, false);
+        PERFORM machineconfig_changelog_touch_existing('site', NEW.site_id);
+    ELSE
+        PERFORM machineconfig_changelog_touch('networkdevice', NEW.id, false);
+        IF OLD.site_id <> NEW.site_id THEN
+            PERFORM machineconfig_changelog_touch_existing('site', OLD.site_id);
+            PERFORM machineconfig_changelog_touch_existing('site', NEW.site_id);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- NetworkInterface, PuppetMachine and Webcam: the NetworkDevice is the parent row
+CREATE FUNCTION machineconfig_changelog_networkdevice_child() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', OLD.networkdevice_id);
+    END IF;
+
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', NEW.networkdevice_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION machineconfig_changelog_networkinterfaceconfiguration() RETURNS trigger AS $$
+DECLARE
+    networkdevice integer;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        SELECT networkdevice_id INTO networkdevice FROM machineconfig_networkinterface
+        WHERE id = OLD.networkinterface_id;
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', networkdevice);
+    END IF;
+
+    IF TG_OP <> 'DELETE' THEN
+        SELECT networkdevice_id INTO networkdevice FROM machineconfig_networkinterface
+        WHERE id = NEW.networkinterface_id;
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', networkdevice);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION machineconfig_changelog_hostname() RETURNS trigger AS $$
+DECLARE
+    networkdevice integer;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        SELECT i.networkdevice_id INTO networkdevice FROM machineconfig_networkinterfaceconfiguration c
+        JOIN machineconfig_networkinterface i ON i.id = c.networkinterface_id
+        WHERE c.id = OLD.networkinterfaceconfiguration_id;
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', networkdevice);
+    END IF;
+
+    IF TG_OP <> 'DELETE' THEN
+        SELECT i.networkdevice_id INTO networkdevice FROM machineconfig_networkinterfaceconfiguration c
+        JOIN machineconfig_networkinterface i ON i.id = c.networkinterface_id
+        WHERE c.id = NEW.networkinterfaceconfiguration_id;
+        PERFORM machineconfig_changelog_touch_existing('networkdevice', networkdevice);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Runs at COMMIT: the advisory lock serializes the commits which changed anything
+CREATE FUNCTION machineconfig_changelog_version() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('machineconfig_changelog'));
+    UPDATE machineconfig_changelog SET version = nextval('machineconfig_changelog_version_seq')
+    WHERE id = NEW.id AND version IS NULL;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER machineconfig_changelog_version
+AFTER INSERT OR UPDATE ON machineconfig_changelog
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW WHEN (NEW.version IS NULL)
+EXECUTE PROCEDURE machineconfig_changelog_version();
+
+-- UPDATEs which change nothing (such as the refresh of the primary fields) are not changes
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_site
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_site();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_site
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_site();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_networkdevice
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_networkdevice();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_networkdevice
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_networkdevice();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_networkinterface
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_networkinterface
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_puppetmachine
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_puppetmachine
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_webcam
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_webcam
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_networkdevice_child();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_networkinterfaceconfiguration
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_networkinterfaceconfiguration();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_networkinterfaceconfiguration
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_networkinterfaceconfiguration();
+
+CREATE TRIGGER machineconfig_changelog_insert_delete AFTER INSERT OR DELETE ON machineconfig_hostname
+FOR EACH ROW EXECUTE PROCEDURE machineconfig_changelog_hostname();
+CREATE TRIGGER machineconfig_changelog_update AFTER UPDATE ON machineconfig_hostname
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE machineconfig_changelog_hostname();
+'''
+
+CHANGELOG_TABLES = (
+    'machineconfig_site',
+    'machineconfig_networkdevice',
+    'machineconfig_networkinterface',
+    'machineconfig_puppetmachine',
+    'machineconfig_webcam',
+    'machineconfig_networkinterfaceconfiguration',
+    'machineconfig_hostname',
+)
+
+CHANGELOG_TRIGGERS_REVERSE_SQL = ''.join(f'''
+DROP TRIGGER machineconfig_changelog_insert_delete ON {table};
+DROP TRIGGER machineconfig_changelog_update ON {table};
+''' for table in CHANGELOG_TABLES) + '''
+DROP TRIGGER machineconfig_changelog_version ON machineconfig_changelog;
+DROP FUNCTION machineconfig_changelog_version();
+DROP FUNCTION machineconfig_changelog_hostname();
+DROP FUNCTION machineconfig_changelog_networkinterfaceconfiguration();
+DROP FUNCTION machineconfig_changelog_networkdevice_child();
+DROP FUNCTION machineconfig_changelog_networkdevice();
+DROP FUNCTION machineconfig_changelog_site();
+DROP FUNCTION machineconfig_changelog_touch_existing(text, integer);
+DROP FUNCTION machineconfig_changelog_touch(text, integer, boolean);
+DROP SEQUENCE machineconfig_changelog_version_seq;
+'''
+
+# Every existing Site and NetworkDevice starts out as changed, so that "?since=0" returns everything
+CHANGELOG_BACKFILL_SQL = '''
+INSERT INTO machineconfig_changelog (object_type, object_id, version, deleted, changed_at)
+SELECT 'site', id, nextval('machineconfig_changelog_version_seq'), false, updated_at
+FROM machineconfig_site ORDER BY id;
+
+INSERT INTO machineconfig_changelog (object_type, object_id, version, deleted, changed_at)
+SELECT 'networkdevice', id, nextval('machineconfig_changelog_version_seq'), false, updated_at
+FROM machineconfig_networkdevice ORDER BY id;
+'''
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machineconfig', '0084_ipreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_type', models.CharField(choices=[('site', 'Site'), ('networkdevice', 'NetworkDevice')], max_length=32, verbose_name='Object Type')),
+                ('object_id', models.IntegerField(verbose_name='Object ID')),
+                ('version', models.BigIntegerField(editable=False, null=True, unique=True, verbose_name='Version')),
+                ('deleted', models.BooleanField(default=False, verbose_name='Deleted')),
+                ('changed_at', models.DateTimeField(verbose_name='Changed At')),
+            ],
+            options={
+                'ordering': ['version'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='changelog',
+            constraint=models.UniqueConstraint(fields=('object_type', 'object_id'), name='changelog_object_unique'),
+        ),
+        migrations.RunSQL(CHANGELOG_TRIGGERS_SQL, reverse_sql=CHANGELOG_TRIGGERS_REVERSE_SQL),
+        migrations.RunSQL(CHANGELOG_BACKFILL_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -1,11 +1,13 @@
 import re
 
 from django.contrib.postgres.fields import ArrayField
-from django.db.models.signals import post_save
+from django.contrib.postgres.indexes import GinIndex
 from django.utils.timezone import make_aware
-from django.dispatch import receiver
 from django.db import models
+from django.db.models.functions import TruncDay
+from django.db.models.functions import TruncHour
 
+from collections import Counter
 from functools import cached_property
 from urllib.parse import urlencode
 from ipaddress import ip_address
@@ -13,6 +15,18 @@ from ipaddress import ip_network
 import datetime
 import requests
 import json
+import gzip
+import io
+
+@models.GenericIPAddressField.register_lookup
+class NetContainedOrEqual(models.Lookup):
+    '''The PostgreSQL inet "is contained within or equals" operator, which can use a btree index'''
+    lookup_name = 'net_contained_or_equal'
+
+    def as_sql(self, compiler, connection):
+        (lhs, lhs_params) = self.process_lhs(compiler, connection)
+        (rhs, rhs_params) = self.process_rhs(compiler, connection)
+        return (f'{lhs} <<= {rhs}::inet', lhs_params + rhs_params)
 
 def puppetdb_facts(hostname):
     '''
@@ -190,7 +204,7 @@ class Site(models.Model):
 
         # build queryset for all boot count information since the cutoff
         queryset = BootHistory.objects.filter(created_at__gte=cutoff)
-        queryset = queryset.filter(puppetmachine__networkdevice__site__id=self.pk)
+        queryset = queryset.filter(site=self)
 
         return {
             'unrecognized_device_count': unrecognized_device_count,
@@ -247,7 +261,7 @@ class NTPServer(models.Model):
 class History(models.Model):
     '''Store the history of requests for easier troubleshooting'''
 
-    timestamp = models.DateTimeField(verbose_name='Timestamp', auto_now_add=True)
+    timestamp = models.DateTimeField(verbose_name='Timestamp', auto_now_add=True, db_index=True)
     ipaddress = models.GenericIPAddressField(verbose_name='IP Address', protocol='ipv4')
     url = models.CharField(verbose_name='Request', max_length=64)
     success = models.BooleanField(verbose_name='Success', default=False)
@@ -258,14 +272,6 @@ class History(models.Model):
     class Meta:
         ordering = ['timestamp', ]
 
-@receiver(post_save, sender=History)
-def history_post_save(sender, **kwargs):
-    # automatically remove any history items older than 7 days
-    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-    cutoff = make_aware(cutoff)
-    count = History.objects.filter(timestamp__lt=cutoff).delete()
-    print(f'DELETE {count} History objects in prune operation')
-
 class Machine(models.Model):
     SITE_CHOICES = (
         ( 'bpl', 'BPL - Santa Barbara Back Parking Lot', ),
@@ -490,6 +496,17 @@ class NetworkDevice(models.Model):
     # Optional FMX Documentation / Management URL
     fmxurl = models.URLField(max_length=4096, verbose_name='FMX URL', default='', blank=True)
 
+    # Denormalized from the NetworkInterface -> NetworkInterfaceConfiguration -> Hostname
+    # tree (the first MAC Address, static IP Address and Hostname, in primary key order),
+    # so that they can be filtered and sorted on. They are kept up to date by the nested
+    # writes, within the same transaction (see machineconfig.nested.refresh_primary_fields).
+    primary_mac = models.CharField(max_length=17, verbose_name='Primary MAC Address', blank=True, null=True,
+                                   editable=False, db_index=True)
+    primary_staticip = models.GenericIPAddressField(protocol='IPv4', verbose_name='Primary IP Address', blank=True,
+                                                    null=True, editable=False, db_index=True)
+    primary_hostname = models.CharField(max_length=256, verbose_name='Primary Hostname', blank=True, null=True,
+                                        editable=False, db_index=True)
+
     # Note implicit one-to-one field "puppetmachine"
     # Note implicit one-to-one field "webcam"
 
@@ -501,38 +518,6 @@ class NetworkDevice(models.Model):
 
         return None
 
-    # Convenience method (Python code only)
-    @cached_property
-    def primary_mac(self):
-        '''Return first configured MAC address (Ethernet hardware address), or None'''
-        for netinterface in self.networkinterface_set.all():
-            return netinterface.mac
-
-        return None
-
-    # Convenience method (Python code only)
-    @cached_property
-    def primary_staticip(self):
-        '''Return first configured static IP address (IPv4 address), or None'''
-        for netinterface in self.networkinterface_set.all():
-            for configuration in netinterface.networkinterfaceconfiguration_set.all():
-                if configuration.ipaddress != '':
-                    return configuration.ipaddress
-
-        return None
-
-    # Convenience method (Python code only)
-    @cached_property
-    def primary_hostname(self):
-        '''Return first configured hostname, or None'''
-        for netinterface in self.networkinterface_set.all():
-            for configuration in netinterface.networkinterfaceconfiguration_set.all():
-                for hostname in configuration.hostname_set.all():
-                    if hostname.hostname != '':
-                        return hostname.hostname
-
-        return None
-
     @cached_property
     def drf_dnsrecords(self):
         records = []
@@ -604,6 +589,13 @@ class NetworkDevice(models.Model):
         print(f'NetworkDevice::delete: DELETE')
         return super().delete()
 
+    class Meta:
+        indexes = [
+            # Substring search of the freeform text (see machineconfig.search)
+            GinIndex(fields=['information', ], name='networkdevice_information_trgm',
+                     opclasses=['gin_trgm_ops', ]),
+        ]
+
 class NetworkInterface(models.Model):
     '''
     Database Model representing a Network Interface
@@ -620,7 +612,8 @@ class NetworkInterface(models.Model):
 
     # Data Fields
     description = models.CharField(max_length=256, verbose_name='Description', blank=True)
-    mac = models.CharField(max_length=17, verbose_name='MAC Address', unique=True)
+    # Unique: see Meta.constraints (deferred, so that nested writes may swap values)
+    mac = models.CharField(max_length=17, verbose_name='MAC Address')
 
     # Convenience method (Python code only)
     @cached_property
@@ -654,6 +647,18 @@ class NetworkInterface(models.Model):
         print(f'NetworkInterface::delete: DELETE')
         return super().delete()
 
+    class Meta:
+        # The first interface is the primary interface: keep primary key order everywhere
+        ordering = ['id', ]
+        constraints = [
+            models.UniqueConstraint(fields=['mac', ], name='networkinterface_mac_unique',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
+        indexes = [
+            # MAC Address prefix search (LIKE 'xx:xx%', see machineconfig.search)
+            models.Index(fields=['mac', ], name='networkinterface_mac_prefix', opclasses=['varchar_pattern_ops', ]),
+        ]
+
 class NetworkInterfaceConfiguration(models.Model):
     '''
     Database Model representing an IP Address Configuration
@@ -670,7 +675,8 @@ class NetworkInterfaceConfiguration(models.Model):
     networkinterface = models.ForeignKey(NetworkInterface, on_delete=models.CASCADE, blank=False)
 
     # Data Fields
-    ipaddress = models.GenericIPAddressField(verbose_name='IP Address', protocol='ipv4', blank=True, null=True)
+    ipaddress = models.GenericIPAddressField(verbose_name='IP Address', protocol='ipv4', blank=True, null=True,
+                                             db_index=True)
     # NOTE: implicit list of Hostname objects available in the "hostname_set" member
 
     def __unicode__(self):
@@ -687,14 +693,30 @@ class NetworkInterfaceConfiguration(models.Model):
         print(f'NetworkInterfaceConfiguration::delete: DELETE')
         return super().delete()
 
+    class Meta:
+        # The first configuration is the primary configuration
+        ordering = ['id', ]
+
 class Hostname(models.Model):
     # Link to parent NetworkInterfaceConfiguration object
     networkinterfaceconfiguration = models.ForeignKey(NetworkInterfaceConfiguration, on_delete=models.CASCADE, blank=False)
-    # Unique hostname
-    hostname = models.CharField(max_length=256, verbose_name='Hostname', unique=True)
+    # Unique hostname: see Meta.constraints (deferred, so that nested writes may move values)
+    hostname = models.CharField(max_length=256, verbose_name='Hostname')
     # For ordering in database queries
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # The first hostname is the primary hostname
+        ordering = ['id', ]
+        constraints = [
+            models.UniqueConstraint(fields=['hostname', ], name='hostname_hostname_unique',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
+        indexes = [
+            # Substring search (see machineconfig.search)
+            GinIndex(fields=['hostname', ], name='hostname_hostname_trgm', opclasses=['gin_trgm_ops', ]),
+        ]
+
 class Webcam(models.Model):
     # Associated NetworkDevice
     # Note that the primary key of the NetworkDevice and corresponding
@@ -778,6 +800,16 @@ class PuppetMachine(models.Model):
     boot_mode = models.CharField(max_length=32, verbose_name='Boot Mode', blank=False,
                                  choices=BOOT_MODE_CHOICES, default='local')
 
+    # BMC (IPMI) Address
+    # Synchronized from the "ipmi_ipaddress" Puppet Fact (manage.py sync_ipmi_ipaddresses),
+    # unless it has been set manually, so that IPMI operations never need to query PuppetDB
+    ipmi_ipaddress = models.GenericIPAddressField(verbose_name='BMC IP Address', protocol='ipv4',
+                                                  blank=True, null=True)
+    ipmi_ipaddress_manual = models.BooleanField(verbose_name='BMC IP Address was set manually (do not sync from PuppetDB)',
+                                                default=False)
+    ipmi_ipaddress_synced_at = models.DateTimeField(verbose_name='BMC IP Address last synced from PuppetDB',
+                                                    blank=True, null=True)
+
     def save(self, *args, **kwargs):
         # The adding flag indicates CREATE vs. UPDATE
         adding = self._state.adding
@@ -864,26 +896,245 @@ class PuppetMachine(models.Model):
 
         return None
 
+def history_site_id(puppetmachine):
+    '''
+    The Site of a PuppetMachine, which is copied onto each history record at
+    insert time. This loads the NetworkDevice (one query), unless it is already
+    cached on the PuppetMachine: it is when the PuppetMachine was reached through
+    its NetworkDevice (networkdevice.puppetmachine), as in the PXE and kickstart
+    views. When a NetworkDevice moves to another Site, its existing history follows
+    it (see update_history_site()).
+    '''
+    return puppetmachine.networkdevice.site_id
+
 class BootHistory(models.Model):
     puppetmachine = models.ForeignKey(PuppetMachine, on_delete=models.CASCADE, blank=False)
+    # Denormalized copy of puppetmachine.networkdevice.site, so that per-Site
+    # history queries do not need to join through three tables
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, blank=True, null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     boot_mode = models.CharField(max_length=32, verbose_name='Boot Mode', blank=False,
                                  choices=PuppetMachine.BOOT_MODE_CHOICES, default='local')
 
+    def save(self, *args, **kwargs):
+        if self.site_id is None:
+            self.site_id = history_site_id(self.puppetmachine)
+
+        return super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            # PuppetMachine.lastboot_at and PuppetMachine.boot_history
+            models.Index(fields=['puppetmachine', '-created_at', ]),
+            # time range queries, optionally by boot mode (dashboard, rollups, retention)
+            models.Index(fields=['created_at', 'boot_mode', ]),
+            # per-Site time range queries
+            models.Index(fields=['site', 'created_at', ]),
+        ]
+
 class BuildHistory(models.Model):
     puppetmachine = models.ForeignKey(PuppetMachine, on_delete=models.CASCADE, blank=False)
+    # Denormalized copy of puppetmachine.networkdevice.site (see BootHistory)
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, blank=True, null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=32, verbose_name='Status', blank=True)
 
+    def save(self, *args, **kwargs):
+        if self.site_id is None:
+            self.site_id = history_site_id(self.puppetmachine)
+
+        return super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            # PuppetMachine.lastbuild_at and PuppetMachine.build_history
+            models.Index(fields=['puppetmachine', '-created_at', ]),
+            # time range queries, optionally by status (rollups, retention)
+            models.Index(fields=['created_at', 'status', ]),
+            # per-Site time range queries
+            models.Index(fields=['site', 'created_at', ]),
+        ]
+
+def update_history_site(networkdevices):
+    '''
+    Copy the (new) Site of each NetworkDevice onto all of its existing BootHistory
+    and BuildHistory records, with one UPDATE per Site and table, and move their
+    rolled up counts along (see move_history_rollups()). Call this in the same
+    transaction which moved the NetworkDevices to another Site.
+    '''
+    networkdevice_ids = {}
+    for networkdevice in networkdevices:
+        networkdevice_ids.setdefault(networkdevice.site_id, []).append(networkdevice.pk)
+
+    # the rolled up counts must move first, while the records still have their old Site
+    move_history_rollups(networkdevice_ids)
+
+    for (site_id, pks) in networkdevice_ids.items():
+        for model in (BootHistory, BuildHistory, ):
+            model.objects.filter(puppetmachine__networkdevice__in=pks).update(site=site_id)
+
+def move_history_rollups(networkdevice_ids):
+    '''
+    Move the HistoryRollup counts of the history records which are about to follow
+    their NetworkDevice to another Site (networkdevice_ids maps the new Site pk to
+    the NetworkDevice pks), with a few queries per kind of history. Only the buckets
+    before the latest hourly bucket are adjusted: "manage.py rollup_history"
+    recomputes the rest from the raw history anyway (see machineconfig.rollups).
+    '''
+    sources = (
+        ('boot', BootHistory, 'boot_mode', ),
+        ('build', BuildHistory, 'status', ),
+    )
+    for (kind, model, field, ) in sources:
+        latest = HistoryRollup.objects.filter(kind=kind, resolution='hour').aggregate(models.Max('bucket'))
+        latest = latest['bucket__max']
+        if latest is None:
+            continue
+
+        resolutions = (
+            ('hour', TruncHour, latest, ),
+            ('day', TruncDay, latest.replace(hour=0), ),
+        )
+
+        # (resolution, site pk, key, bucket) -> change in count
+        deltas = Counter()
+        for (site_id, pks) in networkdevice_ids.items():
+            queryset = model.objects.filter(puppetmachine__networkdevice__in=pks).exclude(site=site_id)
+            for (resolution, trunc, end, ) in resolutions:
+                rows = queryset.filter(created_at__lt=end).annotate(rollup_bucket=trunc('created_at'))
+                rows = rows.values('rollup_bucket', 'site', field).annotate(rollup_count=models.Count('id'))
+                for row in rows:
+                    deltas[(resolution, row['site'], row[field], row['rollup_bucket'], )] -= row['rollup_count']
+                    deltas[(resolution, site_id, row[field], row['rollup_bucket'], )] += row['rollup_count']
+
+        if len(deltas) <= 0:
+            continue
+
+        buckets = {bucket for (resolution, site_id, key, bucket, ) in deltas.keys()}
+        rollups = {}
+        for rollup in HistoryRollup.objects.filter(kind=kind, bucket__in=buckets):
+            rollups[(rollup.resolution, rollup.site_id, rollup.key, rollup.bucket, )] = rollup
+
+        creates = []
+        updates = []
+        deletes = []
+        for (identity, delta) in deltas.items():
+            rollup = rollups.get(identity)
+            if rollup is None:
+                if delta > 0:
+                    (resolution, site_id, key, bucket, ) = identity
+                    creates.append(HistoryRollup(kind=kind, resolution=resolution, site_id=site_id, key=key,
+                                                 bucket=bucket, count=delta))
+                continue
+
+            if delta == 0:
+                continue
+
+            rollup.count += delta
+            if rollup.count > 0:
+                updates.append(rollup)
+            else:
+                deletes.append(rollup.pk)
+
+        HistoryRollup.objects.filter(pk__in=deletes).delete()
+        HistoryRollup.objects.bulk_update(updates, fields=['count', ])
+        HistoryRollup.objects.bulk_create(creates)
+
+class HistoryRollup(models.Model):
+    '''
+    Pre-aggregated counts of BootHistory (by boot mode) and BuildHistory (by
+    status) rows, per Site, per hour and per day. Maintained incrementally by
+    "manage.py rollup_history", so that trend charts never scan the raw history.
+    '''
+    KIND_CHOICES = (
+        ('boot', 'Boot History'),
+        ('build', 'Build History'),
+    )
+    RESOLUTION_CHOICES = (
+        ('hour', 'Hourly'),
+        ('day', 'Daily'),
+    )
+
+    kind = models.CharField(max_length=16, verbose_name='Kind', choices=KIND_CHOICES)
+    resolution = models.CharField(max_length=16, verbose_name='Resolution', choices=RESOLUTION_CHOICES)
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, blank=True, null=True)
+    key = models.CharField(max_length=32, verbose_name='Boot Mode or Build Status', blank=True)
+    bucket = models.DateTimeField(verbose_name='Start of the Time Bucket')
+    count = models.IntegerField(verbose_name='Count', default=0)
+
+    class Meta:
+        unique_together = (
+            ('kind', 'resolution', 'site', 'key', 'bucket', ),
+        )
+        indexes = [
+            models.Index(fields=['kind', 'resolution', 'bucket', ]),
+        ]
+
+class RemoteJob(models.Model):
+    '''
+    The permanent history of a remote operation (such as "puppet agent --test")
+    which ran as an RQ job. RQ forgets about jobs once their results expire; this
+    record does not, so that we can tell who ran what, when, and how long it took.
+    '''
+    KIND_CHOICES = (
+        ('puppet_agent_test', 'Puppet Agent Test'),
+        ('puppet_batch', 'Puppet Batch'),
+    )
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('started', 'Started'),
+        ('finished', 'Finished'),
+        ('failed', 'Failed'),
+    )
+
+    job_id = models.CharField(max_length=64, verbose_name='RQ Job ID', unique=True)
+    kind = models.CharField(max_length=32, verbose_name='Kind', choices=KIND_CHOICES)
+    networkdevice = models.ForeignKey(NetworkDevice, on_delete=models.CASCADE, blank=True, null=True)
+    requested_by = models.CharField(max_length=256, verbose_name='Requested By', blank=True)
+    status = models.CharField(max_length=32, verbose_name='Status', choices=STATUS_CHOICES, default='queued')
+    enqueued_at = models.DateTimeField(verbose_name='Enqueued At', blank=True, null=True)
+    started_at = models.DateTimeField(verbose_name='Started At', blank=True, null=True)
+    finished_at = models.DateTimeField(verbose_name='Finished At', blank=True, null=True)
+    duration = models.FloatField(verbose_name='Duration (seconds)', blank=True, null=True)
+    returncode = models.IntegerField(verbose_name='Return Code', blank=True, null=True)
+    summary = models.JSONField(verbose_name='Summary', default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'enqueued_at', ]),
+            models.Index(fields=['networkdevice', 'enqueued_at', ]),
+            models.Index(fields=['status', ]),
+        ]
+
+class IPMIStatus(models.Model):
+    '''
+    The most recent IPMI chassis status of a PuppetMachine. This is refreshed in
+    the background (manage.py poll_ipmi_status), so that the API does not need to
+    talk to a slow BMC every time someone looks at the dashboard.
+    '''
+    puppetmachine = models.OneToOneField(
+        PuppetMachine,
+        on_delete=models.CASCADE,
+        verbose_name='Puppet Machine',
+        primary_key=True,
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+    bmc = models.CharField(max_length=255, verbose_name='BMC Address', blank=True)
+    power_on = models.BooleanField(verbose_name='Is the Chassis Power on?', null=True)
+    faults = ArrayField(models.CharField(max_length=64), verbose_name='Active Faults', default=list, blank=True)
+    returncode = models.IntegerField(verbose_name='ipmitool returncode', null=True)
+    stdout = models.TextField(verbose_name='ipmitool output', blank=True)
+    error = models.TextField(verbose_name='Error', blank=True)
+
 class UnrecognizedPXEDevice(models.Model):
     '''
     An Unrecognized PXE Device booted up, we need to keep a record of this so
     that we can onboard it into the system semi-automatically for the user.
     '''
-    mac = models.CharField(max_length=17, verbose_name='MAC Address')
-    ipaddress = models.GenericIPAddressField(verbose_name='IP Address', protocol='ipv4')
+    mac = models.CharField(max_length=17, verbose_name='MAC Address', db_index=True)
+    ipaddress = models.GenericIPAddressField(verbose_name='IP Address', protocol='ipv4', db_index=True)
     data = models.TextField(max_length=(128 * 1024), verbose_name='Data', blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     @cached_property
     def site(self):
@@ -906,4 +1157,75 @@ class UnrecognizedPXEDevice(models.Model):
 
         return netinterface.networkdevice.id
 
+class JobOutput(models.Model):
+    '''
+    The complete output of a finished RQ job (for example "puppet agent --test"),
+    stored gzip compressed. While the job runs, its output lives in Redis; once
+    it finishes, the output is moved here so that Redis memory stays bounded.
+    '''
+    job_id = models.CharField(max_length=64, verbose_name='RQ Job ID', unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    returncode = models.IntegerField(verbose_name='Return Code', blank=True, null=True)
+    lines = models.IntegerField(verbose_name='Number of Lines', default=0)
+    size = models.IntegerField(verbose_name='Uncompressed Size (bytes)', default=0)
+    output = models.BinaryField(verbose_name='Output (gzip compressed)')
+
+    def get_lines(self, start=0, end=None):
+        '''
+        Return the output lines (list of bytes) in the range [start, end). Lines end
+        at b'\\n' only, exactly as they were read from the command (and published to
+        Redis), so that the line numbers are the same in both places.
+        '''
+        return io.BytesIO(gzip.decompress(self.output)).readlines()[start:end]
+
+class IPReservation(models.Model):
+    '''
+    A range of IP Addresses within a Site network which must not be allocated to
+    NetworkDevices by the IPAM endpoints (see machineconfig.ipam). Reservations
+    are either permanent, or temporary holds on addresses which were handed out
+    by the allocator but have not been saved onto a NetworkDevice yet.
+    '''
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, verbose_name='Telescope Site', blank=False)
+    start = models.GenericIPAddressField(verbose_name='First IP Address', protocol='ipv4')
+    end = models.GenericIPAddressField(verbose_name='Last IP Address', protocol='ipv4')
+    description = models.CharField(max_length=256, verbose_name='Description', blank=True)
+    # Only set for temporary holds
+    expires_at = models.DateTimeField(verbose_name='Expires At', blank=True, null=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['site', 'start', ]
+
+class ChangeLog(models.Model):
+    '''
+    The latest change of every Site and NetworkDevice, for the delta sync API
+    (GET /api/changes/?since=<version>). There is one row per object, whose
+    version is bumped each time the object (or one of the nested objects which
+    are part of its API representation) changes. Deleted objects keep their row
+    as a tombstone.
+
+    Rows are written by database triggers (see migration 0085), so that every
+    write is recorded, including the bulk queries of the nested writes. The
+    version is assigned when the transaction commits, so that versions become
+    visible in increasing order, and a client which has seen version N never
+    misses a change with a version below N.
+    '''
+    OBJECT_TYPE_CHOICES = (
+        ('site', 'Site'),
+        ('networkdevice', 'NetworkDevice'),
+    )
+
+    object_type = models.CharField(max_length=32, verbose_name='Object Type', choices=OBJECT_TYPE_CHOICES)
+    object_id = models.IntegerField(verbose_name='Object ID')
+    # NULL only until the transaction which changed the object commits
+    version = models.BigIntegerField(verbose_name='Version', unique=True, null=True, editable=False)
+    deleted = models.BooleanField(verbose_name='Deleted', default=False)
+    changed_at = models.DateTimeField(verbose_name='Changed At')
+
+    class Meta:
+        ordering = ['version', ]
+        constraints = [
+            models.UniqueConstraint(fields=['object_type', 'object_id', ], name='changelog_object_unique'),
+        ]
+
 # vim: set ts=4 sts=4 sw=4 et tw=112:
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+'''
+Diff-based nested writes of the NetworkInterface -> NetworkInterfaceConfiguration
+-> Hostname tree which belongs to a NetworkDevice.
+
+Rather than deleting the whole tree and re-creating it one row at a time, the
+incoming (validated) data is matched against the existing rows, and only the
+rows which actually changed are written, using one bulk query per model and
+operation (DELETE, UPDATE, INSERT).
+
+Incoming items match an existing row by "id" when given, or else by natural key:
+the MAC Address of a NetworkInterface, the position of a NetworkInterfaceConfiguration
+within its NetworkInterface, and the name of a Hostname.
+
+Ordering matters: the primary interface, configuration and hostname are the ones
+with the lowest primary key (see NetworkDevice.drf_dnsrecords), so the rows must
+end up in the same primary key order as the incoming data. New rows always get
+larger primary keys than existing ones, so an existing row is only reused while
+the primary keys stay in increasing order, and only until the first new row;
+everything after that is re-created.
+
+The MAC Address and Hostname UNIQUE constraints are DEFERRABLE INITIALLY DEFERRED,
+so that values may move between the rows of one NetworkDevice within a single
+transaction (for example: swapping the MAC Addresses of two interfaces).
+'''
+
+from django.db import IntegrityError
+from django.db import connection
+from django.db.models import OuterRef
+from django.db.models import Prefetch
+from django.db.models import Subquery
+from rest_framework import serializers
+
+from machineconfig.models import Hostname
+from machineconfig.models import NetworkDevice
+from machineconfig.models import NetworkInterface
+from machineconfig.models import NetworkInterfaceConfiguration
+
+from collections import Counter
+
+# The UNIQUE constraints which are deferred until the end of the transaction
+DEFERRED_UNIQUE_CONSTRAINTS = (
+    'networkinterface_mac_unique',
+    'hostname_hostname_unique',
+)
+
+# The NetworkDevice columns which are denormalized from its NetworkInterface tree
+PRIMARY_FIELDS = ('primary_mac', 'primary_staticip', 'primary_hostname', )
+
+def match_rows(existing, incoming, item_key, row_key):
+    '''
+    Pair each incoming item with the existing row which it updates, or with None
+    when a new row must be inserted (see the module docstring for the rules).
+    The existing rows must be in primary key order. Returns (pairs, unused rows).
+    '''
+    by_id = {row.pk: row for row in existing}
+    by_key = {}
+    for (index, row) in enumerate(existing):
+        by_key.setdefault(row_key(index, row), row)
+
+    used = set()
+    pairs = []
+    last_pk = None
+    inserting = False
+    for (index, item) in enumerate(incoming):
+        row = by_id.get(item.get('id', None), None)
+        if row is None:
+            row = by_key.get(item_key(index, item), None)
+
+        # an existing row can only be reused if it keeps the primary keys in order
+        if row is not None and (inserting or row.pk in used or (last_pk is not None and row.pk < last_pk)):
+            row = None
+
+        if row is None:
+            inserting = True
+        else:
+            used.add(row.pk)
+            last_pk = row.pk
+
+        pairs.append((item, row, ))
+
+    unused = [row for row in existing if row.pk not in used]
+    return (pairs, unused)
+
+def bulk_unique_conflicts(entries):
+    '''
+    Check every MAC Address and Hostname in the incoming data of many NetworkDevices
+    for uniqueness: both within the data itself, and against the rows in the database.
+    Uses one query per field, no matter how many devices and values there are.
+
+    The entries are (networkdevice, networkinterface_set data) pairs, where the
+    networkdevice is None for a device which does not exist yet. Each existing
+    device replaces its whole tree, so the values it holds now are free for reuse.
+
+    Returns a list with one item per entry: a dictionary of errors shaped like the
+    nested data (suitable for a ValidationError), or None if there are no conflicts.
+    '''
+    macs = {}
+    hostnames = {}
+    for (e, (networkdevice, networkinterface_set_data)) in enumerate(entries):
+        for (i, interface_data) in enumerate(networkinterface_set_data):
+            macs.setdefault(interface_data['mac'], []).append((e, i, ))
+            for (j, configuration_data) in enumerate(interface_data.get('networkinterfaceconfiguration_set', [])):
+                for (k, hostname_data) in enumerate(configuration_data.get('hostname_set', [])):
+                    hostnames.setdefault(hostname_data['hostname'], []).append((e, i, j, k, ))
+
+    replaced = [networkdevice.pk for (networkdevice, data) in entries
+                if networkdevice is not None and networkdevice.pk is not None]
+
+    queryset = NetworkInterface.objects.filter(mac__in=macs.keys())
+    queryset = queryset.exclude(networkdevice__in=replaced)
+    taken_macs = set(queryset.values_list('mac', flat=True))
+
+    queryset = Hostname.objects.filter(hostname__in=hostnames.keys())
+    queryset = queryset.exclude(networkinterfaceconfiguration__networkinterface__networkdevice__in=replaced)
+    taken_hostnames = set(queryset.values_list('hostname', flat=True))
+
+    errors = [None for entry in entries]
+
+    def add_error(path, field, message):
+        (e, i, *rest) = path
+        networkinterface_set_data = entries[e][1]
+        if errors[e] is None:
+            errors[e] = {'networkinterface_set': [{} for elem in networkinterface_set_data]}
+
+        node = errors[e]['networkinterface_set'][i]
+        if len(rest) > 0:
+            (j, k) = rest
+            configurations = networkinterface_set_data[i]['networkinterfaceconfiguration_set']
+            node = node.setdefault('networkinterfaceconfiguration_set', [{} for elem in configurations])[j]
+            node = node.setdefault('hostname_set', [{} for elem in configurations[j]['hostname_set']])[k]
+
+        node.setdefault(field, []).append(message)
+
+    for (values, taken, field, verbose_name, model_name) in (
+            (macs, taken_macs, 'mac', 'MAC Address', 'network interface', ),
+            (hostnames, taken_hostnames, 'hostname', 'Hostname', 'hostname', ), ):
+        for (value, paths) in values.items():
+            if value in taken:
+                for path in paths:
+                    add_error(path, field, f'{model_name} with this {verbose_name} already exists.')
+            elif len(paths) > 1:
+                for path in paths:
+                    add_error(path, field, f'{verbose_name} "{value}" is used more than once.')
+
+    return errors
+
+def unique_conflicts(networkinterface_set_data, networkdevice=None):
+    '''The bulk_unique_conflicts() check, for a single NetworkDevice'''
+    return bulk_unique_conflicts([(networkdevice, networkinterface_set_data), ])[0]
+
+class NestedWrite:
+    '''Accumulate the DELETEs, UPDATEs and INSERTs of a nested write, then run them in bulk'''
+
+    MODELS = (NetworkInterface, NetworkInterfaceConfiguration, Hostname, )
+
+    def __init__(self):
+        self.deletes = {model: [] for model in self.MODELS}
+        self.updates = {model: {} for model in self.MODELS}
+        self.update_fields = {model: set() for model in self.MODELS}
+        self.inserts = {model: [] for model in self.MODELS}
+
+    def delete(self, rows):
+        for row in rows:
+            self.deletes[type(row)].append(row.pk)
+
+    def update(self, row, **values):
+        '''Update the fields of an existing row, if (and only if) they changed'''
+        model = type(row)
+        for (field, value) in values.items():
+            if getattr(row, field) != value:
+                setattr(row, field, value)
+                self.updates[model][row.pk] = row
+                self.update_fields[model].add(field)
+
+    def insert(self, row, parent=None, parent_field=None):
+        '''Insert a new row, whose parent (foreign key) row may not have been inserted yet'''
+        self.inserts[type(row)].append((row, parent, parent_field, ))
+
+    def execute(self):
+        '''Run every operation, and return the number of rows deleted/updated/inserted'''
+        counts = {
+            'deleted': 0,
+            'updated': 0,
+            'inserted': 0,
+        }
+
+        for model in reversed(self.MODELS):
+            if len(self.deletes[model]) > 0:
+                (count, per_model) = model.objects.filter(pk__in=self.deletes[model]).delete()
+                counts['deleted'] += count
+
+        for model in self.MODELS:
+            if len(self.updates[model]) > 0:
+                model.objects.bulk_update(self.updates[model].values(), fields=sorted(self.update_fields[model]))
+                counts['updated'] += len(self.updates[model])
+
+        # parents first, so that the children can reference their new primary keys
+        for model in self.MODELS:
+            rows = []
+            for (row, parent, parent_field) in self.inserts[model]:
+                if parent is not None:
+                    setattr(row, f'{parent_field}_id', parent.pk)
+
+                rows.append(row)
+
+            if len(rows) > 0:
+                model.objects.bulk_create(rows)
+                counts['inserted'] += len(rows)
+
+        return counts
+
+def ipaddress_value(value):
+    '''The API accepts "" for "no IP Address", which is stored as NULL'''
+    return value if value else None
+
+def write_hostnames(write, configuration, hostname_set_data, existing):
+    (pairs, unused) = match_rows(
+        existing,
+        hostname_set_data,
+        item_key=lambda index, item: item['hostname'],
+        row_key=lambda index, row: row.hostname,
+    )
+    write.delete(unused)
+
+    for (hostname_data, hostname) in pairs:
+        if hostname is not None:
+            write.update(hostname, hostname=hostname_data['hostname'])
+        else:
+            hostname = Hostname(hostname=hostname_data['hostname'])
+            write.insert(hostname, configuration, 'networkinterfaceconfiguration')
+
+def hostname_conflicts(hostname_set_data, configuration=None):
+    '''
+    The unique_conflicts() check, for the Hostnames of a single NetworkInterfaceConfiguration
+    (whose own Hostnames are replaced, and so do not count as conflicts).
+    '''
+    hostnames = [hostname_data['hostname'] for hostname_data in hostname_set_data]
+    queryset = Hostname.objects.filter(hostname__in=hostnames)
+    if configuration is not None:
+        queryset = queryset.exclude(networkinterfaceconfiguration=configuration)
+
+    taken = set(queryset.values_list('hostname', flat=True))
+    counts = Counter(hostnames)
+
+    errors = []
+    for hostname in hostnames:
+        if hostname in taken:
+            errors.append({'hostname': ['hostname with this Hostname already exists.', ], })
+        elif counts[hostname] > 1:
+            errors.append({'hostname': [f'Hostname "{hostname}" is used more than once.', ], })
+        else:
+            errors.append({})
+
+    if any(errors):
+        return {'hostname_set': errors}
+
+    return None
+
+def write_hostname_set(configuration, hostname_set_data):
+    '''
+    Make the Hostnames of one (existing) NetworkInterfaceConfiguration match the
+    (validated, see hostname_conflicts()) nested hostname_set data, writing only
+    what changed.
+    '''
+    write = NestedWrite()
+    write_hostnames(write, configuration, hostname_set_data, list(configuration.hostname_set.order_by('pk')))
+    counts = write.execute()
+    refresh_primary_fields([configuration.networkinterface.networkdevice, ])
+    return counts
+
+def write_configurations(write, interface, configuration_set_data, existing):
+    (pairs, unused) = match_rows(
+        existing,
+        configuration_set_data,
+        item_key=lambda index, item: index,
+        row_key=lambda index, row: index,
+    )
+    write.delete(unused)
+
+    for (configuration_data, configuration) in pairs:
+        ipaddress = ipaddress_value(configuration_data.get('ipaddress', None))
+        if configuration is not None:
+            write.update(configuration, ipaddress=ipaddress)
+            existing_hostnames = list(configuration.hostname_set.all())
+        else:
+            configuration = NetworkInterfaceConfiguration(ipaddress=ipaddress)
+            write.insert(configuration, interface, 'networkinterface')
+            existing_hostnames = []
+
+        write_hostnames(write, configuration, configuration_data.get('hostname_set', []), existing_hostnames)
+
+def existing_networkinterfaces(networkdevices):
+    '''
+    Load the NetworkInterface trees of many NetworkDevices (in primary key order)
+    in three queries. Returns a dictionary of lists, keyed by NetworkDevice pk.
+    '''
+    pks = [networkdevice.pk for networkdevice in networkdevices if networkdevice.pk is not None]
+    existing = {pk: [] for pk in pks}
+    if len(pks) <= 0:
+        return existing
+
+    queryset = NetworkInterface.objects.filter(networkdevice__in=pks).order_by('pk')
+    queryset = queryset.prefetch_related(Prefetch(
+        'networkinterfaceconfiguration_set',
+        queryset=NetworkInterfaceConfiguration.objects.order_by('pk'),
+    ))
+    queryset = queryset.prefetch_related(Prefetch(
+        'networkinterfaceconfiguration_set__hostname_set',
+        queryset=Hostname.objects.order_by('pk'),
+    ))
+    for interface in queryset:
+        existing[interface.networkdevice_id].append(interface)
+
+    return existing
+
+def plan_networkinterfaces(write, networkdevice, networkinterface_set_data, existing):
+    '''
+    Add the operations which make the (existing) NetworkInterface tree of a
+    NetworkDevice match the (validated) nested networkinterface_set data to the
+    NestedWrite. The NetworkDevice itself may not have been inserted yet.
+    '''
+    (pairs, unused) = match_rows(
+        existing,
+        networkinterface_set_data,
+        item_key=lambda index, item: item['mac'],
+        row_key=lambda index, row: row.mac,
+    )
+    write.delete(unused)
+
+    for (interface_data, interface) in pairs:
+        if interface is not None:
+            write.update(interface, mac=interface_data['mac'], description=interface_data.get('description', ''))
+            existing_configurations = list(interface.networkinterfaceconfiguration_set.all())
+        else:
+            interface = NetworkInterface(mac=interface_data['mac'], description=interface_data.get('description', ''))
+            write.insert(interface, networkdevice, 'networkdevice')
+            existing_configurations = []
+
+        write_configurations(write, interface, interface_data.get('networkinterfaceconfiguration_set', []),
+                             existing_configurations)
+
+def check_deferred_constraints():
+    '''
+    Check the deferred UNIQUE constraints now, rather than at COMMIT, so that a
+    conflict which slipped past the uniqueness checks (a concurrent write) fails
+    the request cleanly with a ValidationError. The constraints are deferred again
+    afterwards, so that later writes in the same transaction may move values too.
+    '''
+    constraints = ', '.join(DEFERRED_UNIQUE_CONSTRAINTS)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SET CONSTRAINTS {constraints} IMMEDIATE')
+            cursor.execute(f'SET CONSTRAINTS {constraints} DEFERRED')
+    except IntegrityError as ex:
+        raise serializers.ValidationError({'networkinterface_set': str(ex)}) from ex
+
+def refresh_primary_fields(networkdevices):
+    '''
+    Recompute the denormalized primary_mac, primary_staticip and primary_hostname
+    columns of many NetworkDevices from their NetworkInterface trees: the first
+    interface's MAC Address, the first configuration's IP Address, and the first
+    non-empty Hostname (in primary key order). Uses one UPDATE and one SELECT, no
+    matter how many devices there are, and copies the new values onto the given
+    instances (so that a later save() does not overwrite them). Must be called
+    within the transaction which changed the trees.
+    '''
+    pks = [networkdevice.pk for networkdevice in networkdevices]
+    if len(pks) <= 0:
+        return
+
+    interfaces = NetworkInterface.objects.filter(networkdevice=OuterRef('pk'))
+    interfaces = interfaces.order_by('pk')
+    configurations = NetworkInterfaceConfiguration.objects.filter(networkinterface__networkdevice=OuterRef('pk'))
+    configurations = configurations.order_by('networkinterface_id', 'pk')
+    hostnames = Hostname.objects.filter(networkinterfaceconfiguration__networkinterface__networkdevice=OuterRef('pk'))
+    hostnames = hostnames.exclude(hostname='')
+    hostnames = hostnames.order_by('networkinterfaceconfiguration__networkinterface_id',
+                                   'networkinterfaceconfiguration_id', 'pk')
+
+    queryset = NetworkDevice.objects.filter(pk__in=pks)
+    queryset.update(
+        primary_mac=Subquery(interfaces.values('mac')[:1]),
+        primary_staticip=Subquery(configurations.values('ipaddress')[:1]),
+        primary_hostname=Subquery(hostnames.values('hostname')[:1]),
+    )
+
+    values = {row['pk']: row for row in queryset.values('pk', *PRIMARY_FIELDS)}
+    for networkdevice in networkdevices:
+        for field in PRIMARY_FIELDS:
+            setattr(networkdevice, field, values[networkdevice.pk][field])
+
+def write_networkinterfaces(networkdevice, networkinterface_set_data):
+    '''
+    Make the NetworkInterface tree of a NetworkDevice match the (validated) nested
+    networkinterface_set data, writing only what changed. The data must already have
+    been checked with unique_conflicts() (see NetworkDeviceSerializer.validate). Must
+    be called within a database transaction.
+    '''
+    existing = existing_networkinterfaces([networkdevice, ])
+    write = NestedWrite()
+    plan_networkinterfaces(write, networkdevice, networkinterface_set_data, existing.get(networkdevice.pk, []))
+    counts = write.execute()
+    check_deferred_constraints()
+    refresh_primary_fields([networkdevice, ])
+
+    return counts
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
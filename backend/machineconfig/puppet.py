@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+'''
+RQ jobs which run "puppet agent --test" on NetworkDevices: a single run on one
+device, and a batch coordinator which rolls a Puppet change out to many devices
+(canaries first, bounded parallelism, abort when too many runs fail).
+
+The batch coordinator runs on its own "puppet_batch" queue, so that it never
+occupies the worker which is needed to run the individual Puppet jobs.
+'''
+
+from rq import get_current_job
+
+import django_rq
+
+from machineconfig.jobs import create_remote_job
+from machineconfig.jobs import job_output
+from machineconfig.jobs import remote_job_history
+from machineconfig.models import NetworkDevice
+from machineconfig.remote import run_remote_command
+
+import time
+import re
+
+# "puppet agent --test" implies --detailed-exitcodes: 0 means no changes, and 2
+# means changes were applied successfully. Anything else (1, 4, 6) is a failure.
+PUPPET_SUCCESS_RETURNCODES = (0, 2, )
+
+# How often (in seconds) the batch coordinator checks on its Puppet jobs
+PUPPET_BATCH_POLL_INTERVAL = 2
+
+# Timeout (in seconds) for each individual "puppet agent --test" run
+PUPPET_AGENT_TEST_TIMEOUT = 3600
+
+# Puppet colors its output when it runs on a terminal
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+# Values from the "puppet agent --summarize" report which end up in the job result
+PUPPET_SUMMARY_FIELDS = {
+    ('resources', 'changed'): 'resources_changed',
+    ('resources', 'failed'): 'resources_failed',
+    ('resources', 'total'): 'resources_total',
+    ('events', 'failure'): 'events_failed',
+    ('time', 'total'): 'runtime',
+}
+
+def parse_puppet_summary(lines):
+    '''
+    Parse the output (list of bytes) of "puppet agent --test --summarize" into
+    a small summary: the number of resources changed/failed, the total runtime
+    in seconds, and the number of Error/Warning messages.
+    '''
+    summary = {value: None for value in PUPPET_SUMMARY_FIELDS.values()}
+    summary['errors'] = 0
+    summary['warnings'] = 0
+
+    section = None
+    for line in lines:
+        line = ANSI_ESCAPE_RE.sub('', line.decode('utf-8', errors='replace')).rstrip()
+
+        if line.startswith('Error:'):
+            summary['errors'] += 1
+        elif line.startswith('Warning:'):
+            summary['warnings'] += 1
+
+        # the report is a set of unindented section headers ("Resources:") each
+        # followed by indented "Name: value" lines
+        if not line.startswith(' '):
+            section = line[:-1].lower() if line.endswith(':') else None
+            continue
+
+        (key, sep, value) = line.strip().partition(':')
+        field = PUPPET_SUMMARY_FIELDS.get((section, key.lower()), None)
+        if section is None or not sep or field is None:
+            continue
+
+        try:
+            summary[field] = float(value) if field == 'runtime' else int(value)
+        except ValueError as ex:
+            pass
+
+    return summary
+
+def run_puppet_agent_test(networkdevice_id, timeout=PUPPET_AGENT_TEST_TIMEOUT):
+    print(f'run_puppet_agent_test: networkdevice_id={networkdevice_id}')
+    with remote_job_history('puppet_agent_test', networkdevice_id=networkdevice_id) as remotejob:
+        networkdevice = NetworkDevice.objects.get(pk=networkdevice_id)
+        puppet_command = '/usr/bin/sudo /opt/puppetlabs/bin/puppet agent --test --summarize'
+        env = {
+            'LANG': 'C',
+            'LC_ALL': 'C',
+        }
+        # The output is published line by line while Puppet runs, and then stored in
+        # the database (compressed), rather than being returned in the (pickled) RQ job
+        # result. The SSH connection to the host is multiplexed, so repeated runs on
+        # the same host skip the SSH handshake.
+        result = run_remote_command(networkdevice.primary_hostname, puppet_command, timeout=timeout, env=env,
+                                    tty=True, persist=True)
+
+        job = get_current_job()
+        summary = parse_puppet_summary(job_output(job.connection, job.id))
+
+        remotejob.returncode = result['returncode']
+        remotejob.summary = summary
+
+    data = {
+        'command': puppet_command,
+        'returncode': result['returncode'],
+        'lines': result['lines'],
+        'summary': summary,
+    }
+    return data
+
+def puppet_batch_deadline(count, max_parallel, canaries, timeout=PUPPET_AGENT_TEST_TIMEOUT):
+    '''
+    How long (in seconds) a batch coordinator waits for its Puppet runs before it
+    gives up (worst case: every run takes the full timeout). The canaries run at
+    most max_parallel at a time too, before any other device starts.
+    '''
+    canaries = min(canaries, count)
+    rounds = -(-canaries // max_parallel) + -(-(count - canaries) // max_parallel)
+    return rounds * (timeout + 60)
+
+def puppet_batch_timeout(count, max_parallel, canaries, timeout=PUPPET_AGENT_TEST_TIMEOUT):
+    '''The RQ job_timeout needed by a batch coordinator: its deadline, plus time to record the outcome'''
+    return puppet_batch_deadline(count, max_parallel, canaries, timeout=timeout) + 300
+
+def run_puppet_batch(networkdevice_ids, max_parallel=4, canaries=1, max_failure_rate=0.25):
+    '''
+    Run "puppet agent --test" on many NetworkDevices, in the given order. This is
+    an RQ job, which enqueues one run_puppet_agent_test job per device.
+
+    The first "canaries" devices run first. If any canary fails, the batch is
+    aborted. Afterwards, at most "max_parallel" runs happen at once, and the batch
+    is aborted as soon as the fraction of failed runs exceeds "max_failure_rate".
+    When a batch is aborted, runs which already started are allowed to finish, and
+    the remaining devices are skipped. A run whose job has expired or was deleted
+    counts as failed. Once the deadline (see puppet_batch_deadline()) has passed,
+    the batch is aborted, and runs which are still going count as failed.
+
+    Progress is published in job.meta['batch'] after every change, so that it can
+    be polled while the batch runs.
+    '''
+    with remote_job_history('puppet_batch') as remotejob:
+        job = get_current_job()
+        queue = django_rq.get_queue()
+
+        networkdevice_ids = list(networkdevice_ids)
+        deadline = time.monotonic() + puppet_batch_deadline(len(networkdevice_ids), max_parallel, canaries)
+        canary_ids = set(networkdevice_ids[:canaries])
+        pending = list(networkdevice_ids)
+        running = {}
+
+        batch = {
+            'state': 'canary' if len(canary_ids) > 0 else 'running',
+            'total': len(networkdevice_ids),
+            'max_parallel': max_parallel,
+            'canaries': sorted(canary_ids),
+            'max_failure_rate': max_failure_rate,
+            'succeeded': 0,
+            'failed': 0,
+            'skipped': 0,
+            'abort_reason': None,
+            'devices': {
+                pk: {'status': 'pending', 'job_id': None, 'returncode': None, 'error': None, } for pk in networkdevice_ids
+            },
+        }
+
+        def publish():
+            job.meta['batch'] = batch
+            job.save_meta()
+
+        def abort(reason):
+            print(f'run_puppet_batch: ABORT: {reason}')
+            batch['state'] = 'aborting'
+            batch['abort_reason'] = reason
+            for pk in pending:
+                batch['devices'][pk]['status'] = 'skipped'
+                batch['skipped'] += 1
+
+            pending.clear()
+
+        def complete(pk, returncode, error=None):
+            succeeded = returncode in PUPPET_SUCCESS_RETURNCODES
+
+            batch['devices'][pk]['status'] = 'succeeded' if succeeded else 'failed'
+            batch['devices'][pk]['returncode'] = returncode
+            batch['devices'][pk]['error'] = error
+            batch['succeeded' if succeeded else 'failed'] += 1
+
+            if not succeeded and pk in canary_ids and len(pending) > 0:
+                abort(f'Canary NetworkDevice(pk={pk}) failed')
+
+        publish()
+        while len(pending) > 0 or len(running) > 0:
+            # start new runs: only the canaries until they have all succeeded
+            while len(pending) > 0 and len(running) < max_parallel:
+                if batch['state'] == 'canary' and pending[0] not in canary_ids:
+                    break
+
+                pk = pending.pop(0)
+                child_remotejob = create_remote_job('puppet_agent_test', networkdevice_id=pk,
+                                                    requested_by=remotejob.requested_by)
+                child = queue.enqueue(run_puppet_agent_test, networkdevice_id=pk, job_id=child_remotejob.job_id,
+                                      job_timeout=PUPPET_AGENT_TEST_TIMEOUT)
+                running[pk] = child
+                batch['devices'][pk]['status'] = 'running'
+                batch['devices'][pk]['job_id'] = child.id
+
+            publish()
+            time.sleep(PUPPET_BATCH_POLL_INTERVAL)
+
+            # collect the runs which have completed (a job which has expired from
+            # Redis, or was deleted, has no status at all)
+            for (pk, child) in list(running.items()):
+                status = child.get_status(refresh=True)
+                if status is None:
+                    del running[pk]
+                    complete(pk, None, error=f'Job {child.id} has expired or was deleted')
+                    continue
+
+                if status not in ('finished', 'failed', 'stopped', 'canceled', ):
+                    continue
+
+                del running[pk]
+                result = child.result if status == 'finished' else None
+                complete(pk, result['returncode'] if result is not None else None)
+
+            # the runs are stuck (or the workers are gone): give up on the whole batch
+            if time.monotonic() >= deadline and (len(pending) > 0 or len(running) > 0):
+                abort(f'Deadline of {puppet_batch_deadline(batch["total"], max_parallel, canaries)} seconds exceeded')
+                for (pk, child) in list(running.items()):
+                    del running[pk]
+                    complete(pk, None, error=f'Job {child.id} did not finish before the deadline')
+
+            if batch['state'] == 'canary' and all(batch['devices'][pk]['status'] == 'succeeded' for pk in canary_ids):
+                batch['state'] = 'running'
+
+            completed = batch['succeeded'] + batch['failed']
+            if len(pending) > 0 and completed > 0 and (batch['failed'] / completed) > max_failure_rate:
+                abort(f'Failure rate {batch["failed"]}/{completed} exceeds {max_failure_rate:.0%}')
+
+        batch['state'] = 'aborted' if batch['abort_reason'] is not None else 'finished'
+        publish()
+
+        data = {
+            'state': batch['state'],
+            'total': batch['total'],
+            'succeeded': batch['succeeded'],
+            'failed': batch['failed'],
+            'skipped': batch['skipped'],
+            'abort_reason': batch['abort_reason'],
+        }
+        remotejob.summary = data
+
+    return data
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
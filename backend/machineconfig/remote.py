@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+'''
+Remote command execution over SSH, for RQ jobs.
+
+Every command to the same host shares one persistent, multiplexed SSH connection
+(OpenSSH ControlMaster), so only the first command pays for the full SSH handshake.
+The master connection is closed by SSH itself once it has been idle for
+settings.SSH_CONTROL_PERSIST seconds.
+
+The master is started on its own (ssh -M -N -f), with none of its standard streams
+connected to ours. Commands never start a master themselves (ControlMaster=no):
+a master forked from the command would inherit the pipe which carries the command
+output, and hold it open until ControlPersist expires, long after the command is
+done. When no master can be started, commands use a direct connection instead.
+'''
+
+from django.conf import settings
+
+from machineconfig.jobs import run_streaming_command
+
+import subprocess
+import fcntl
+import os
+
+def ssh_control_dir():
+    '''Return the directory which holds the SSH control sockets, creating it if needed'''
+    path = settings.SSH_CONTROL_DIR
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def ssh_options(multiplex=True):
+    '''
+    The SSH options common to every connection. With multiplex=False, the control
+    socket is not used at all (a direct connection).
+    '''
+    # %C is a hash of the connection parameters: it keeps the socket path short
+    # enough for a UNIX socket, no matter how long the hostname is
+    control_path = os.path.join(ssh_control_dir(), '%C') if multiplex else 'none'
+    options = [
+        'StrictHostKeyChecking=no',
+        'BatchMode=yes',
+        f'ConnectTimeout={settings.SSH_CONNECT_TIMEOUT}',
+        'ServerAliveInterval=15',
+        'ServerAliveCountMax=4',
+        f'ControlPath={control_path}',
+    ]
+
+    cmd = []
+    for option in options:
+        cmd += ['-o', option, ]
+
+    return cmd
+
+def ssh_command(hostname, remote_command, tty=False, multiplex=True):
+    '''
+    Build the command line to run remote_command on hostname, over the multiplexed
+    SSH connection (see ssh_start_master()), or over a direct connection with
+    multiplex=False. Use tty=True for commands which need a terminal (sudo).
+    '''
+    cmd = [
+        '/usr/bin/ssh',
+        '-x',
+        '-4',
+    ] + ssh_options(multiplex=multiplex) + [
+        '-o',
+        'ControlMaster=no',
+    ]
+
+    if tty:
+        cmd += ['-t', '-t', ]
+
+    cmd += [
+        '-i',
+        settings.SSH_IDENTITY_FILE,
+        f'{settings.SSH_USER}@{hostname}',
+        remote_command,
+    ]
+    return cmd
+
+def ssh_start_master(hostname):
+    '''
+    Make sure that an SSH master connection to the host is running, starting one
+    in the background if needed. Returns True if the master is running.
+    '''
+    # one lock per host, so that concurrent jobs never start two masters, the second
+    # of which would find the socket taken and linger as an unshared connection
+    lock_path = os.path.join(ssh_control_dir(), f'{hostname}.lock')
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if ssh_control(hostname, 'check'):
+            return True
+
+        cmd = [
+            '/usr/bin/ssh',
+            '-x',
+            '-4',
+        ] + ssh_options() + [
+            '-o',
+            'ControlMaster=yes',
+            '-o',
+            f'ControlPersist={settings.SSH_CONTROL_PERSIST}',
+            '-M',
+            '-N',
+            '-f',
+            '-i',
+            settings.SSH_IDENTITY_FILE,
+            f'{settings.SSH_USER}@{hostname}',
+        ]
+
+        # with -f, ssh exits as soon as the connection is up, leaving the master running
+        try:
+            proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, timeout=(settings.SSH_CONNECT_TIMEOUT + 5), check=False)
+        except subprocess.TimeoutExpired as ex:
+            return False
+
+        return proc.returncode == 0
+
+def run_remote_command(hostname, remote_command, timeout, env=None, tty=False, persist=False):
+    '''
+    Run a command on a remote host from inside of an RQ job, publishing each line
+    of output as it is produced (see machineconfig.jobs.run_streaming_command).
+    '''
+    multiplex = ssh_start_master(hostname)
+    if not multiplex:
+        print(f'run_remote_command: no SSH master connection to {hostname}, connecting directly')
+
+    cmd = ssh_command(hostname, remote_command, tty=tty, multiplex=multiplex)
+    return run_streaming_command(cmd, timeout=timeout, env=env, persist=persist)
+
+def ssh_control(hostname, operation, timeout=10):
+    '''
+    Send a control command ("check" or "exit") to the SSH master connection for a
+    host. Returns True if the command succeeded (for "check": the master is running).
+    '''
+    cmd = [
+        '/usr/bin/ssh',
+        '-4',
+    ] + ssh_options() + [
+        '-O',
+        operation,
+        f'{settings.SSH_USER}@{hostname}',
+    ]
+
+    try:
+        proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=timeout, check=False)
+    except subprocess.TimeoutExpired as ex:
+        return False
+
+    return proc.returncode == 0
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+'''
+Fast renderers for large API responses (for example: /api/site/?expand=devices).
+
+FastJSONRenderer is a drop-in replacement for the DRF JSONRenderer, which uses
+orjson when it is installed (falling back to the standard library encoder).
+MessagePackRenderer produces the same data as compact binary MessagePack, for
+clients which ask for it with "Accept: application/msgpack" or ?format=msgpack.
+
+Both encode the values which are not native JSON types the same way as the DRF
+JSONEncoder does (dates and times as ISO 8601 strings, Decimals as numbers, and
+so on), and additionally handle IP Address/Network objects, and bytes (such as
+command output) which are not valid UTF-8. MessagePack keeps bytes as binary.
+
+The benchmark_renderers management command compares them.
+'''
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+import ipaddress
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+IPADDRESS_TYPES = (
+    ipaddress.IPv4Address,
+    ipaddress.IPv6Address,
+    ipaddress.IPv4Network,
+    ipaddress.IPv6Network,
+    ipaddress.IPv4Interface,
+    ipaddress.IPv6Interface,
+)
+
+class APIJSONEncoder(encoders.JSONEncoder):
+    '''The DRF JSONEncoder, plus IP Addresses and (possibly invalid UTF-8) bytes'''
+
+    def default(self, obj):
+        if isinstance(obj, bytes):
+            return obj.decode('utf-8', errors='replace')
+
+        if isinstance(obj, IPADDRESS_TYPES):
+            return str(obj)
+
+        return super().default(obj)
+
+# orjson and msgpack call this for every value which they do not support natively
+api_default = APIJSONEncoder().default
+
+class FastJSONRenderer(JSONRenderer):
+    '''The DRF JSONRenderer, using orjson (when installed) to encode the data'''
+    encoder_class = APIJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(data, accepted_media_type=accepted_media_type, renderer_context=renderer_context)
+
+        if data is None:
+            return b''
+
+        # datetimes are passed to api_default(), so that they are formatted the same as DRF formats them
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            option |= orjson.OPT_INDENT_2
+
+        ret = orjson.dumps(data, default=api_default, option=option)
+
+        # Same as DRF: escape the characters which are valid in JSON but not in JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+class MessagePackRenderer(BaseRenderer):
+    '''MessagePack (https://msgpack.org/), for clients which ask for it. Requires the msgpack package.'''
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        return msgpack.packb(data, default=api_default, use_bin_type=True)
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+'''
+A small in-process DNS client, used to validate our DNS records without forking
+/usr/bin/host or /usr/bin/dig for every single lookup.
+
+All of the queries in a batch are sent from a single UDP socket, with a bounded
+number of queries outstanding at once. Answers are cached (per process) for as
+long as their TTL allows. Truncated answers are retried over TCP.
+'''
+
+from django.conf import settings
+
+from ipaddress import ip_address
+import asyncio
+import random
+import struct
+import socket
+import threading
+import time
+
+# DNS Record Types (the ones we know how to decode)
+RECORD_TYPES = {
+    'A': 1,
+    'NS': 2,
+    'CNAME': 5,
+    'SOA': 6,
+    'PTR': 12,
+    'MX': 15,
+    'TXT': 16,
+    'AAAA': 28,
+    'SRV': 33,
+    'ANY': 255,
+}
+RECORD_TYPE_NAMES = {value: name for (name, value) in RECORD_TYPES.items()}
+
+# DNS Response Codes
+RCODE_NAMES = {
+    0: 'NOERROR',
+    1: 'FORMERR',
+    2: 'SERVFAIL',
+    3: 'NXDOMAIN',
+    4: 'NOTIMP',
+    5: 'REFUSED',
+}
+
+# DNS Class: Internet
+CLASS_IN = 1
+
+# Cache negative answers (NXDOMAIN / no records) for at most this many seconds
+NEGATIVE_CACHE_TTL = 30
+
+# Overall deadline (in seconds) of a batch resolved inside of a web request: without
+# it, a batch against a nameserver which never answers ties up a web worker for
+# timeout * (retries + 1) seconds per round of "concurrency" queries
+RESOLVE_DEADLINE = 30
+
+class DNSError(Exception):
+    pass
+
+def default_nameserver():
+    '''
+    The nameserver used when none is given: settings.DNS_RESOLVER_NAMESERVER if
+    configured, otherwise the first nameserver from /etc/resolv.conf.
+    '''
+    nameserver = getattr(settings, 'DNS_RESOLVER_NAMESERVER', None)
+    if nameserver:
+        return nameserver
+
+    try:
+        with open('/etc/resolv.conf', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1]
+    except OSError as ex:
+        pass
+
+    return '127.0.0.1'
+
+def make_query(target, record_type=None):
+    '''
+    Turn a user-supplied target into a (name, record_type) query. IP addresses
+    become a reverse (PTR) lookup, just like "dig -x" does. Everything else is an
+    "A" record lookup unless another record type is requested.
+    '''
+    try:
+        addr = ip_address(target)
+        return (addr.reverse_pointer, 'PTR')
+    except ValueError as ex:
+        pass
+
+    record_type = (record_type or 'A').upper()
+    if record_type not in RECORD_TYPES:
+        raise DNSError(f'Unsupported DNS record type "{record_type}" (choose from: {",".join(RECORD_TYPES)})')
+
+    return (str(target).rstrip('.').lower(), record_type)
+
+################################################################################
+# DNS Wire Format
+################################################################################
+
+def encode_name(name):
+    '''Encode a domain name into DNS wire format (sequence of length-prefixed labels)'''
+    data = b''
+    for label in name.rstrip('.').split('.'):
+        if len(label) <= 0:
+            continue
+
+        label = label.encode('idna')
+        if len(label) > 63:
+            raise DNSError(f'DNS label too long in name "{name}"')
+
+        data += bytes([len(label)]) + label
+
+    return data + b'\x00'
+
+def encode_query(query_id, name, record_type):
+    '''Encode a DNS query message (Recursion Desired) for a single question'''
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    question = encode_name(name) + struct.pack('!HH', RECORD_TYPES[record_type], CLASS_IN)
+    return header + question
+
+def decode_name(message, offset):
+    '''
+    Decode a (possibly compressed) domain name starting at offset. Returns the
+    name and the offset of the first byte after the name.
+    '''
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        length = message[offset]
+
+        # compression pointer: continue reading at another offset in the message
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+
+            jumps += 1
+            if jumps > 64:
+                raise DNSError('DNS name compression loop detected')
+
+            offset = struct.unpack_from('!H', message, offset)[0] & 0x3fff
+            continue
+
+        offset += 1
+        if length == 0:
+            break
+
+        labels.append(message[offset:offset + length].decode('ascii', errors='replace'))
+        offset += length
+
+    if end is None:
+        end = offset
+
+    return ('.'.join(labels).lower(), end)
+
+def decode_rdata(message, offset, rdlength, rtype):
+    '''Decode the RDATA of a single resource record into a human-readable string'''
+    rdata = message[offset:offset + rdlength]
+
+    if rtype == RECORD_TYPES['A']:
+        return socket.inet_ntop(socket.AF_INET, rdata)
+
+    if rtype == RECORD_TYPES['AAAA']:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+
+    if rtype in (RECORD_TYPES['NS'], RECORD_TYPES['CNAME'], RECORD_TYPES['PTR'], ):
+        return decode_name(message, offset)[0]
+
+    if rtype == RECORD_TYPES['MX']:
+        preference = struct.unpack_from('!H', message, offset)[0]
+        exchange = decode_name(message, offset + 2)[0]
+        return f'{preference} {exchange}'
+
+    if rtype == RECORD_TYPES['SRV']:
+        (priority, weight, port) = struct.unpack_from('!HHH', message, offset)
+        target = decode_name(message, offset + 6)[0]
+        return f'{priority} {weight} {port} {target}'
+
+    if rtype == RECORD_TYPES['SOA']:
+        (mname, pos) = decode_name(message, offset)
+        (rname, pos) = decode_name(message, pos)
+        (serial, refresh, retry, expire, minimum) = struct.unpack_from('!IIIII', message, pos)
+        return f'{mname} {rname} {serial} {refresh} {retry} {expire} {minimum}'
+
+    if rtype == RECORD_TYPES['TXT']:
+        strings = []
+        pos = 0
+        while pos < len(rdata):
+            length = rdata[pos]
+            strings.append(rdata[pos + 1:pos + 1 + length].decode('utf-8', errors='replace'))
+            pos += 1 + length
+
+        return ' '.join(f'"{string}"' for string in strings)
+
+    return rdata.hex()
+
+def decode_response(message):
+    '''
+    Decode a DNS response message. Returns a dictionary with the query id, the
+    truncated flag, the response code and the decoded answer records.
+    '''
+    if len(message) < 12:
+        raise DNSError('DNS response too short')
+
+    (query_id, flags, qdcount, ancount, nscount, arcount) = struct.unpack_from('!HHHHHH', message, 0)
+    offset = 12
+
+    # skip over the question section
+    for i in range(qdcount):
+        offset = decode_name(message, offset)[1] + 4
+
+    sections = {
+        'answers': [],
+        'authority': [],
+    }
+    for (section, count) in (('answers', ancount), ('authority', nscount), ):
+        for i in range(count):
+            (name, offset) = decode_name(message, offset)
+            (rtype, rclass, ttl, rdlength) = struct.unpack_from('!HHIH', message, offset)
+            offset += 10
+            sections[section].append({
+                'name': name,
+                'type': RECORD_TYPE_NAMES.get(rtype, str(rtype)),
+                'ttl': ttl,
+                'data': decode_rdata(message, offset, rdlength, rtype),
+            })
+            offset += rdlength
+
+    rcode = flags & 0x000f
+    return {
+        'id': query_id,
+        'truncated': bool(flags & 0x0200),
+        'status': RCODE_NAMES.get(rcode, str(rcode)),
+        'answers': sections['answers'],
+        'authority': sections['authority'],
+    }
+
+################################################################################
+# Answer Cache
+################################################################################
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def cache_ttl(response):
+    '''How long may this response be cached? Honours the record TTLs (and SOA for negative answers)'''
+    if response['status'] == 'NOERROR' and len(response['answers']) > 0:
+        return min(answer['ttl'] for answer in response['answers'])
+
+    ttl = NEGATIVE_CACHE_TTL
+    for record in response['authority']:
+        if record['type'] == 'SOA':
+            minimum = int(record['data'].split()[-1])
+            ttl = min(ttl, record['ttl'], minimum)
+
+    return ttl
+
+def cache_get(key):
+    with _cache_lock:
+        entry = _cache.get(key, None)
+        if entry is None:
+            return None
+
+        (expires_at, response) = entry
+        if expires_at <= time.monotonic():
+            del _cache[key]
+            return None
+
+        return response
+
+def cache_put(key, response):
+    ttl = cache_ttl(response)
+    if ttl <= 0:
+        return
+
+    with _cache_lock:
+        _cache[key] = (time.monotonic() + ttl, response)
+
+def cache_clear():
+    with _cache_lock:
+        _cache.clear()
+
+################################################################################
+# Asynchronous Batch Resolver
+################################################################################
+
+class _DNSClientProtocol(asyncio.DatagramProtocol):
+    '''One UDP socket shared by every query in a batch, with replies matched up by query id'''
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = decode_response(data)
+        except Exception as ex:
+            return
+
+        future = self.pending.pop(response['id'], None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        # ICMP port unreachable and friends: fail everything which is outstanding
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+        self.pending.clear()
+
+    def connection_lost(self, exc):
+        self.error_received(exc or ConnectionError('DNS client socket closed'))
+
+    def allocate_id(self):
+        while True:
+            query_id = random.randint(0, 0xffff)
+            if query_id not in self.pending:
+                return query_id
+
+async def _query_tcp(nameserver, port, name, record_type, timeout):
+    '''Repeat a (truncated) query over TCP'''
+    (reader, writer) = await asyncio.wait_for(asyncio.open_connection(nameserver, port), timeout)
+    try:
+        query = encode_query(random.randint(0, 0xffff), name, record_type)
+        writer.write(struct.pack('!H', len(query)) + query)
+        await writer.drain()
+
+        length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+        message = await asyncio.wait_for(reader.readexactly(length), timeout)
+        return decode_response(message)
+    finally:
+        writer.close()
+
+async def _query(protocol, semaphore, nameserver, port, name, record_type, timeout, retries):
+    '''Resolve a single query (with retries), using the shared UDP socket'''
+    key = (nameserver, port, name, record_type)
+    response = cache_get(key)
+    if response is not None:
+        return dict(response, cached=True)
+
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(retries + 1):
+            query_id = protocol.allocate_id()
+            future = loop.create_future()
+            protocol.pending[query_id] = future
+            protocol.transport.sendto(encode_query(query_id, name, record_type))
+
+            try:
+                response = await asyncio.wait_for(future, timeout)
+                break
+            except asyncio.TimeoutError as ex:
+                protocol.pending.pop(query_id, None)
+        else:
+            raise DNSError(f'No response from nameserver {nameserver} after {retries + 1} attempts')
+
+        if response['truncated']:
+            response = await _query_tcp(nameserver, port, name, record_type, timeout)
+
+    cache_put(key, response)
+    return dict(response, cached=False)
+
+async def resolve_async(queries, nameserver=None, port=53, timeout=2.0, retries=2, concurrency=64, deadline=None):
+    '''
+    Resolve a list of (name, record_type) queries against a single nameserver, with
+    at most "concurrency" queries outstanding at any time. Returns one result per
+    query, in the same order as the queries.
+
+    With a deadline (in seconds), the whole batch gives up after that long: queries
+    which have not been answered by then are reported with the ERROR status.
+    '''
+    nameserver = nameserver or default_nameserver()
+    loop = asyncio.get_running_loop()
+    (transport, protocol) = await loop.create_datagram_endpoint(_DNSClientProtocol, remote_addr=(nameserver, port))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    tasks = []
+    try:
+        for (name, record_type) in queries:
+            coroutine = _query(protocol, semaphore, nameserver, port, name, record_type, timeout, retries)
+            tasks.append(asyncio.ensure_future(coroutine))
+
+        if len(tasks) > 0:
+            (done, pending) = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+
+            await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        transport.close()
+
+    results = []
+    for ((name, record_type), task) in zip(queries, tasks):
+        result = {
+            'name': name,
+            'type': record_type,
+        }
+
+        if task.cancelled():
+            result.update({
+                'status': 'ERROR',
+                'answers': [],
+                'error': f'No answer within the deadline of {deadline} seconds',
+            })
+        elif task.exception() is not None:
+            response = task.exception()
+            result.update({
+                'status': 'ERROR',
+                'answers': [],
+                'error': str(response) or response.__class__.__name__,
+            })
+        else:
+            response = task.result()
+            result.update({
+                'status': response['status'],
+                'answers': response['answers'],
+                'cached': response['cached'],
+            })
+
+        results.append(result)
+
+    return results
+
+def resolve(queries, nameserver=None, port=53, timeout=2.0, retries=2, concurrency=64, deadline=None):
+    '''
+    Synchronous wrapper around resolve_async(), for use in views and management
+    commands. Views must pass a deadline (see RESOLVE_DEADLINE).
+    '''
+    coroutine = resolve_async(queries, nameserver=nameserver, port=port, timeout=timeout, retries=retries,
+                              concurrency=concurrency, deadline=deadline)
+    return asyncio.run(coroutine)
+
+################################################################################
+# Zone Consistency Checker
+################################################################################
+
+def check_dns_records(records, nameserver=None, port=53, timeout=2.0, retries=2, concurrency=64, deadline=None):
+    '''
+    Check that a nameserver actually serves the given DNS records (in the format
+    produced by Site.drf_dnsrecords). Every A, PTR and CNAME record is looked up
+    concurrently, and each one is reported with one of the following statuses:
+
+    ok       - the nameserver returned the expected target
+    missing  - the nameserver has no record of this type for the hostname
+    mismatch - the nameserver returned record(s), but not the expected target
+    error    - the lookup failed (timeout, SERVFAIL, REFUSED, etc.)
+    '''
+    records = [record for record in records if record['record_type'] in ('A', 'PTR', 'CNAME', )]
+    records = [record for record in records if record['target'] is not None]
+
+    # each distinct (name, type) pair is only looked up once
+    queries = sorted(set((record['hostname'].rstrip('.').lower(), record['record_type']) for record in records))
+    results = resolve(queries, nameserver=nameserver, port=port, timeout=timeout, retries=retries,
+                      concurrency=concurrency, deadline=deadline)
+    results = dict(zip(queries, results))
+
+    checked = []
+    for record in records:
+        name = record['hostname'].rstrip('.').lower()
+        record_type = record['record_type']
+        expected = str(record['target']).rstrip('.').lower()
+        result = results[(name, record_type)]
+
+        actual = [answer['data'].rstrip('.').lower() for answer in result['answers'] if answer['type'] == record_type]
+        if result['status'] not in ('NOERROR', 'NXDOMAIN', ):
+            status = 'error'
+        elif expected in actual:
+            status = 'ok'
+        elif len(actual) <= 0:
+            status = 'missing'
+        else:
+            status = 'mismatch'
+
+        checked.append({
+            'hostname': name,
+            'record_type': record_type,
+            'expected': expected,
+            'actual': actual,
+            'status': status,
+            'error': result.get('error', result['status'] if status == 'error' else None),
+        })
+
+    counts = {status: 0 for status in ('ok', 'missing', 'mismatch', 'error', )}
+    for record in checked:
+        counts[record['status']] += 1
+
+    data = {
+        'nameserver': nameserver or default_nameserver(),
+        'total': len(checked),
+        'counts': counts,
+        'records': checked,
+    }
+    return data
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+'''
+Retention of the history tables: rows older than the configured number of days
+(settings.HISTORY_RETENTION_DAYS) are deleted by a scheduled job ("manage.py
+prune_history"), rather than on every insert.
+
+Rows are deleted in small batches (settings.HISTORY_RETENTION_BATCH_SIZE), each
+in its own short transaction, so that pruning a large backlog never holds locks
+for long and never blocks the PXE/boot endpoints which insert new history.
+'''
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from machineconfig.models import BootHistory
+from machineconfig.models import BuildHistory
+from machineconfig.models import History
+from machineconfig.models import HistoryRollup
+from machineconfig.models import JobOutput
+from machineconfig.models import RemoteJob
+from machineconfig.models import UnrecognizedPXEDevice
+
+import datetime
+import time
+
+# For each retention setting: the model, the timestamp field which is compared
+# against the cutoff, and any extra filter which selects the rows it applies to
+RETENTION_TABLES = {
+    'history': (History, 'timestamp', {}, ),
+    'boot_history': (BootHistory, 'created_at', {}, ),
+    'build_history': (BuildHistory, 'created_at', {}, ),
+    'unrecognized_pxe_device': (UnrecognizedPXEDevice, 'created_at', {}, ),
+    'remote_job': (RemoteJob, 'enqueued_at', {}, ),
+    'job_output': (JobOutput, 'created_at', {}, ),
+    # the daily rollups are tiny, and are kept forever
+    'history_rollup_hourly': (HistoryRollup, 'bucket', {'resolution': 'hour', }, ),
+}
+
+def retention_cutoff(name, now=None):
+    '''The time before which rows of this table are pruned, or None to keep them forever'''
+    days = settings.HISTORY_RETENTION_DAYS.get(name, 0)
+    if days <= 0:
+        return None
+
+    if now is None:
+        now = timezone.now()
+
+    return now - datetime.timedelta(days=days)
+
+def expired_rows(name, cutoff):
+    '''A queryset of every row of this table which is older than the cutoff'''
+    (model, field, extra) = RETENTION_TABLES[name]
+    return model.objects.filter(**{f'{field}__lt': cutoff}, **extra)
+
+def prune_table(name, cutoff=None, batch_size=None, pause=0.0, dry_run=False):
+    '''
+    Delete every row of this table which is older than the cutoff (default: see
+    retention_cutoff()), at most batch_size rows per transaction, sleeping for
+    "pause" seconds between batches. Returns the number of rows deleted (or
+    which would be deleted, for a dry run).
+    '''
+    if cutoff is None:
+        cutoff = retention_cutoff(name)
+        if cutoff is None:
+            return 0
+
+    if batch_size is None:
+        batch_size = settings.HISTORY_RETENTION_BATCH_SIZE
+
+    if dry_run:
+        return expired_rows(name, cutoff).count()
+
+    (model, field, extra) = RETENTION_TABLES[name]
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            # oldest first, so that an interrupted prune still makes progress
+            pks = list(expired_rows(name, cutoff).order_by(field).values_list('pk', flat=True)[:batch_size])
+            if len(pks) <= 0:
+                break
+
+            (count, per_model) = model.objects.filter(pk__in=pks).delete()
+            deleted += per_model.get(model._meta.label, 0)
+
+        if len(pks) < batch_size:
+            break
+
+        time.sleep(pause)
+
+    return deleted
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+'''
+Hourly and daily rollups of the BootHistory and BuildHistory tables.
+
+The rollups are maintained incrementally: each update only recomputes the hours
+since the latest hourly bucket (which may have been incomplete last time), and
+the days which contain those hours. Statistics over arbitrary time ranges are
+then served from the (small) rollup table, never from the raw history.
+'''
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Sum
+from django.db.models.functions import TruncDay
+from django.db.models.functions import TruncHour
+from django.db.models.functions import TruncMonth
+from django.db.models.functions import TruncWeek
+
+from machineconfig.models import BootHistory
+from machineconfig.models import BuildHistory
+from machineconfig.models import HistoryRollup
+
+# The raw history model, and the field which the counts are broken down by
+ROLLUP_SOURCES = {
+    'boot': (BootHistory, 'boot_mode', ),
+    'build': (BuildHistory, 'status', ),
+}
+
+# Statistics bucket sizes: the rollup resolution to read, and how to group it
+STATS_BUCKETS = {
+    'hour': ('hour', TruncHour, ),
+    'day': ('day', TruncDay, ),
+    'week': ('day', TruncWeek, ),
+    'month': ('day', TruncMonth, ),
+}
+
+def truncate_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def rollup_start(kind):
+    '''
+    Return the first hour which needs to be (re)computed for this kind of history:
+    the latest hourly bucket (it may have been incomplete when it was computed), or
+    the very first history record if there are no rollups yet. None if no history.
+    '''
+    latest = HistoryRollup.objects.filter(kind=kind, resolution='hour').aggregate(Max('bucket'))['bucket__max']
+    if latest is not None:
+        return latest
+
+    (model, field) = ROLLUP_SOURCES[kind]
+    earliest = model.objects.aggregate(Min('created_at'))['created_at__min']
+    if earliest is not None:
+        return truncate_hour(earliest)
+
+    return None
+
+@transaction.atomic
+def update_rollups(kind, start=None):
+    '''
+    Recompute the hourly rollups from the given hour (default: see rollup_start())
+    onwards, and the daily rollups for every day which contains those hours.
+    Returns the number of hourly rollup rows written.
+    '''
+    (model, field) = ROLLUP_SOURCES[kind]
+    if start is None:
+        start = rollup_start(kind)
+        if start is None:
+            return 0
+
+    start = truncate_hour(start)
+    day_start = start.replace(hour=0)
+
+    # hourly rollups: aggregated directly from the raw history since the start
+    queryset = model.objects.filter(created_at__gte=start)
+    queryset = queryset.annotate(rollup_bucket=TruncHour('created_at'))
+    queryset = queryset.values('rollup_bucket', 'site', field)
+    queryset = queryset.annotate(rollup_count=Count('id'))
+    hourly = [HistoryRollup(
+        kind=kind,
+        resolution='hour',
+        site_id=row['site'],
+        key=row[field],
+        bucket=row['rollup_bucket'],
+        count=row['rollup_count'],
+    ) for row in queryset]
+
+    HistoryRollup.objects.filter(kind=kind, resolution='hour', bucket__gte=start).delete()
+    HistoryRollup.objects.bulk_create(hourly)
+
+    # daily rollups: aggregated from the hourly rollups, for every affected day
+    queryset = HistoryRollup.objects.filter(kind=kind, resolution='hour', bucket__gte=day_start)
+    queryset = queryset.annotate(rollup_bucket=TruncDay('bucket'))
+    queryset = queryset.values('rollup_bucket', 'site', 'key')
+    queryset = queryset.annotate(rollup_count=Sum('count'))
+    daily = [HistoryRollup(
+        kind=kind,
+        resolution='day',
+        site_id=row['site'],
+        key=row['key'],
+        bucket=row['rollup_bucket'],
+        count=row['rollup_count'],
+    ) for row in queryset]
+
+    HistoryRollup.objects.filter(kind=kind, resolution='day', bucket__gte=day_start).delete()
+    HistoryRollup.objects.bulk_create(daily)
+
+    return len(hourly)
+
+def rollup_stats(kind, start, end, bucket='day', site=None):
+    '''
+    Return the history counts between start and end (a half-open range), grouped
+    into buckets of the given size (hour, day, week or month), and broken down by
+    boot mode (boot history) or status (build history). Optionally for one Site
+    code only. Buckets without any history are omitted.
+    '''
+    (resolution, trunc) = STATS_BUCKETS[bucket]
+    start = truncate_hour(start)
+    if resolution == 'day':
+        start = start.replace(hour=0)
+
+    queryset = HistoryRollup.objects.filter(kind=kind, resolution=resolution, bucket__gte=start, bucket__lt=end)
+    if site is not None:
+        queryset = queryset.filter(site__code__iexact=site)
+
+    queryset = queryset.annotate(stats_bucket=trunc('bucket'))
+    queryset = queryset.values('stats_bucket', 'key')
+    queryset = queryset.annotate(stats_count=Sum('count'))
+    queryset = queryset.order_by('stats_bucket', 'key')
+
+    results = []
+    for row in queryset:
+        if len(results) <= 0 or results[-1]['bucket'] != row['stats_bucket']:
+            results.append({
+                'bucket': row['stats_bucket'],
+                'total': 0,
+                'counts': {},
+            })
+
+        results[-1]['counts'][row['key']] = row['stats_count']
+        results[-1]['total'] += row['stats_count']
+
+    return results
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+'''
+Global search (GET /api/search/?q=) across NetworkDevices, UnrecognizedPXEDevices
+and Sites, so that finding a device does not mean downloading the whole fleet.
+
+The query is matched in every way which makes sense for it, and every match is
+served by an index:
+
+- Hostnames and NetworkDevice information: substring match (pg_trgm GIN indexes),
+  ranked by trigram similarity
+- MAC Addresses: prefix match, in any separator format ("00:11:22", "00-11-22",
+  "0011.22" or "001122")
+- IP Addresses: containment within an IP Address or CIDR network ("10.5.0.15",
+  "10.5.0.0/16", or a partial address such as "10.5")
+- Sites: code, description and domain (a handful of rows, matched in Python)
+
+Several matches on the same object are merged into a single hit, which keeps the
+best score. Hits are ranked by score (1.0 for an exact match).
+'''
+
+from django.contrib.postgres.search import TrigramSimilarity
+
+from machineconfig.models import Hostname
+from machineconfig.models import NetworkDevice
+from machineconfig.models import NetworkInterface
+from machineconfig.models import NetworkInterfaceConfiguration
+from machineconfig.models import Site
+from machineconfig.models import UnrecognizedPXEDevice
+
+from ipaddress import ip_address
+from ipaddress import ip_network
+import re
+
+# Maximum number of matches read from the database, per kind of match
+SEARCH_MAX_MATCHES = 1000
+
+# Shortest query which is used for substring matching (trigrams are 3 characters)
+SEARCH_MIN_SUBSTRING = 3
+
+# Longest query accepted
+SEARCH_MAX_LENGTH = 256
+
+# Hit types, in the order used to break ties between equal scores
+SEARCH_TYPES = ('site', 'networkdevice', 'unrecognizedpxedevice', )
+
+# Score of a match within the (long, freeform) NetworkDevice information text
+INFORMATION_SCORE = 0.25
+
+# Characters of context shown on either side of an information match
+INFORMATION_CONTEXT = 40
+
+MAC_SEPARATORS_RE = re.compile(r'[\s:.\-]')
+MAC_DIGITS_RE = re.compile(r'^[0-9a-f]{2,12}$')
+PARTIAL_IPV4_RE = re.compile(r'^\d{1,3}(\.\d{1,3}){0,2}\.?$')
+
+def mac_prefix(q):
+    '''
+    Normalize a (partial) MAC Address in any separator format to the stored format
+    ("0011.22" -> "00:11:22"). Returns None if the query is not a MAC Address prefix.
+    '''
+    digits = MAC_SEPARATORS_RE.sub('', q.lower())
+    if not MAC_DIGITS_RE.match(digits):
+        return None
+
+    return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+def ip_network_query(q):
+    '''
+    Parse an IPv4 Address, CIDR network, or partial address ("10.5" -> 10.5.0.0/16)
+    from the query. Returns an IPv4Network, or None if the query is none of these.
+    '''
+    try:
+        network = ip_network(q, strict=False)
+        return network if network.version == 4 else None
+    except ValueError as ex:
+        pass
+
+    if not PARTIAL_IPV4_RE.match(q):
+        return None
+
+    octets = [int(octet) for octet in q.split('.') if octet]
+    if any(octet > 255 for octet in octets):
+        return None
+
+    address = '.'.join(str(octet) for octet in octets + [0, ] * (4 - len(octets)))
+    return ip_network(f'{address}/{8 * len(octets)}')
+
+def information_excerpt(information, q):
+    '''The part of the information text around the (first) match'''
+    index = information.lower().find(q.lower())
+    if index < 0:
+        return information[:2 * INFORMATION_CONTEXT]
+
+    start = max(0, index - INFORMATION_CONTEXT)
+    end = index + len(q) + INFORMATION_CONTEXT
+    return information[start:end]
+
+class SearchHits:
+    '''Merge matches into one hit per object, keeping the best score'''
+
+    def __init__(self):
+        self.hits = {}
+
+    def add(self, kind, pk, score, field, value):
+        hit = self.hits.setdefault((kind, pk), {'type': kind, 'id': pk, 'score': 0.0, 'matches': [], })
+        hit['score'] = max(hit['score'], round(float(score), 3))
+        hit['matches'].append({'field': field, 'value': str(value), })
+
+    def ranked(self):
+        return sorted(self.hits.values(), key=lambda hit: (-hit['score'], SEARCH_TYPES.index(hit['type']), hit['id']))
+
+def search_hostnames(hits, q):
+    hostname = q.lower()
+    queryset = Hostname.objects.all()
+    if len(hostname) >= SEARCH_MIN_SUBSTRING:
+        queryset = queryset.filter(hostname__contains=hostname)
+    else:
+        queryset = queryset.filter(hostname=hostname)
+
+    queryset = queryset.annotate(search_score=TrigramSimilarity('hostname', hostname))
+    queryset = queryset.order_by('-search_score')
+    queryset = queryset.values_list('networkinterfaceconfiguration__networkinterface__networkdevice', 'hostname',
+                                    'search_score')
+    for (pk, value, score) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('networkdevice', pk, 1.0 if value == hostname else score, 'hostname', value)
+
+def search_information(hits, q):
+    if len(q) < SEARCH_MIN_SUBSTRING:
+        return
+
+    # a case-insensitive regular expression (rather than UPPER() LIKE) can use the trigram index
+    queryset = NetworkDevice.objects.filter(information__iregex=re.escape(q))
+    queryset = queryset.values_list('pk', 'information')
+    for (pk, information) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('networkdevice', pk, INFORMATION_SCORE, 'information', information_excerpt(information, q))
+
+def search_macs(hits, q):
+    prefix = mac_prefix(q)
+    if prefix is None:
+        return
+
+    # a full MAC Address is an exact match
+    score = len(prefix.replace(':', '')) / 12
+
+    queryset = NetworkInterface.objects.filter(mac__startswith=prefix)
+    queryset = queryset.values_list('networkdevice', 'mac')
+    for (pk, mac) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('networkdevice', pk, score, 'mac', mac)
+
+    queryset = UnrecognizedPXEDevice.objects.filter(mac__startswith=prefix)
+    queryset = queryset.values_list('pk', 'mac')
+    for (pk, mac) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('unrecognizedpxedevice', pk, score, 'mac', mac)
+
+def search_ipaddresses(hits, q, sites):
+    network = ip_network_query(q)
+    if network is None:
+        return
+
+    # a single IP Address (/32) is an exact match
+    score = network.prefixlen / 32
+
+    queryset = NetworkInterfaceConfiguration.objects.filter(ipaddress__net_contained_or_equal=str(network))
+    queryset = queryset.values_list('networkinterface__networkdevice', 'ipaddress')
+    for (pk, ipaddress) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('networkdevice', pk, score, 'ipaddress', ipaddress)
+
+    queryset = UnrecognizedPXEDevice.objects.filter(ipaddress__net_contained_or_equal=str(network))
+    queryset = queryset.values_list('pk', 'ipaddress')
+    for (pk, ipaddress) in queryset[:SEARCH_MAX_MATCHES]:
+        hits.add('unrecognizedpxedevice', pk, score, 'ipaddress', ipaddress)
+
+    # the Site whose network contains the address (or network)
+    for site in sites:
+        site_network = ip_network(f'{site.networkip}/{site.networkcidr}', strict=False)
+        if network.subnet_of(site_network):
+            hits.add('site', site.pk, 0.5, 'network', site_network)
+
+def search_sites(hits, q, sites):
+    value = q.lower()
+    for site in sites:
+        if site.code.lower() == value:
+            hits.add('site', site.pk, 1.0, 'code', site.code)
+            continue
+
+        for field in ('code', 'shortdescription', 'domain', ):
+            if value in getattr(site, field).lower():
+                hits.add('site', site.pk, 0.5, field, getattr(site, field))
+
+def search(q):
+    '''Run every kind of match for the query, and return the merged hits, best first'''
+    q = q.strip()
+    sites = list(Site.objects.all())
+
+    hits = SearchHits()
+    search_sites(hits, q, sites)
+    search_hostnames(hits, q)
+    search_information(hits, q)
+    search_macs(hits, q)
+    search_ipaddresses(hits, q, sites)
+    return hits.ranked()
+
+def describe_hits(hits):
+    '''
+    Add a title and Site code to each hit (normally a single page of them), with
+    one query per hit type
+    '''
+    pks = {kind: [hit['id'] for hit in hits if hit['type'] == kind] for kind in SEARCH_TYPES}
+    sites = {site.pk: site for site in Site.objects.all()}
+
+    queryset = NetworkDevice.objects.filter(pk__in=pks['networkdevice'])
+    queryset = queryset.values('pk', 'site', 'primary_hostname', 'primary_mac')
+    networkdevices = {row['pk']: row for row in queryset}
+
+    queryset = UnrecognizedPXEDevice.objects.filter(pk__in=pks['unrecognizedpxedevice'])
+    queryset = queryset.values('pk', 'mac', 'ipaddress')
+    pxedevices = {row['pk']: row for row in queryset}
+
+    def pxedevice_site(ipaddress):
+        for site in sites.values():
+            if ip_address(ipaddress) in ip_network(f'{site.networkip}/{site.networkcidr}', strict=False):
+                return site
+
+        return None
+
+    for hit in hits:
+        if hit['type'] == 'site':
+            site = sites[hit['id']]
+            hit['title'] = site.shortdescription
+        elif hit['type'] == 'networkdevice':
+            row = networkdevices[hit['id']]
+            site = sites[row['site']]
+            hit['title'] = row['primary_hostname'] or row['primary_mac'] or f'NetworkDevice {hit["id"]}'
+        else:
+            row = pxedevices[hit['id']]
+            site = pxedevice_site(row['ipaddress'])
+            hit['title'] = f'{row["mac"]} ({row["ipaddress"]})'
+
+        hit['site'] = site.code if site is not None else None
+
+    return hits
+
+# vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -4,7 +4,6 @@ from rest_framework import serializers
 from rest_flex_fields import FlexFieldsModelSerializer
 
 from drf_writable_nested import WritableNestedModelSerializer
-from drf_writable_nested import UniqueFieldsMixin
 
 from machineconfig.models import Site
 from machineconfig.models import Hostname
@@ -16,12 +15,27 @@ from machineconfig.models import NetworkInterfaceConfiguration
 from machineconfig.models import UnrecognizedPXEDevice
 from machineconfig.models import BootHistory
 from machineconfig.models import BuildHistory
+from machineconfig.models import update_history_site
+from machineconfig.models import IPMIStatus
+from machineconfig.models import RemoteJob
 from machineconfig.models import NTPServer
+from machineconfig.models import IPReservation
+from machineconfig.ipam import site_network
+from machineconfig.nested import hostname_conflicts
+from machineconfig.nested import unique_conflicts
+from machineconfig.nested import write_hostname_set
+from machineconfig.nested import write_networkinterfaces
 
 from contextlib import ContextDecorator
-import validators
+import ipaddress
 import re
 
+# A single label of a hostname: http://stackoverflow.com/questions/2532053/validate-a-hostname-string
+HOSTNAME_LABEL_RE = re.compile(r'(?!-)[A-Z\d-]{1,63}(?<!-)$', re.IGNORECASE)
+
+# A MAC Address, in our canonical format (lowercase, colon separated)
+MAC_ADDRESS_RE = re.compile(r'^(?:[0-9a-f]{2}:){5}[0-9a-f]{2}$')
+
 class mycontext(ContextDecorator):
     def __init__(self, message):
         self.message = message
@@ -58,6 +72,7 @@ class BootHistorySerializer(FlexFieldsModelSerializer):
         exclude = (
             'id',
             'puppetmachine',
+            'site',
         )
         expandable_fields = {
             'puppetmachine': (
@@ -90,6 +105,7 @@ class BuildHistorySerializer(FlexFieldsModelSerializer):
         exclude = (
             'id',
             'puppetmachine',
+            'site',
         )
         expandable_fields = {
             'puppetmachine': (
@@ -113,6 +129,31 @@ class BuildHistorySerializer(FlexFieldsModelSerializer):
             ),
         }
 
+class RemoteJobSerializer(FlexFieldsModelSerializer):
+    class Meta:
+        model = RemoteJob
+        exclude = (
+            'id',
+        )
+        expandable_fields = {
+            'networkdevice': (
+                'machineconfig.NetworkDeviceSerializer',
+                {
+                    'many': False,
+                    'read_only': True,
+                    'required': False,
+                    'allow_null': True,
+                },
+            ),
+        }
+
+class IPMIStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IPMIStatus
+        exclude = (
+            'puppetmachine',
+        )
+
 class NTPServerSerializer(serializers.ModelSerializer):
     class Meta:
         model = NTPServer
@@ -123,12 +164,13 @@ class NTPServerSerializer(serializers.ModelSerializer):
         )
 
 # Serializers define the API representation.
-class HostnameSerializer(UniqueFieldsMixin, serializers.ModelSerializer):
+class HostnameSerializer(serializers.ModelSerializer):
+    # Optional: identifies the existing Hostname to update in nested writes
+    id = serializers.IntegerField(required=False)
+
     def validate_hostname(self, value):
         # check for the other standard hostname rules
-        # http://stackoverflow.com/questions/2532053/validate-a-hostname-string
-        allowed = re.compile(r'(?!-)[A-Z\d-]{1,63}(?<!-)$', re.IGNORECASE)
-        if not all(allowed.match(x) for x in value.split('.')):
+        if not all(HOSTNAME_LABEL_RE.match(x) for x in value.split('.')):
             raise serializers.ValidationError('Hostname contains invalid characters')
 
         return value.lower()
@@ -141,7 +183,9 @@ class HostnameSerializer(UniqueFieldsMixin, serializers.ModelSerializer):
         )
 
 # Serializers define the API representation.
-class NetworkInterfaceConfigurationSerializer(UniqueFieldsMixin, WritableNestedModelSerializer):
+class NetworkInterfaceConfigurationSerializer(WritableNestedModelSerializer):
+    # Optional: identifies the existing NetworkInterfaceConfiguration to update in nested writes
+    id = serializers.IntegerField(required=False)
     ipaddress = serializers.IPAddressField(required=True, allow_null=True, allow_blank=True)
     hostname_set = HostnameSerializer(many=True, read_only=False)
 
@@ -156,6 +200,14 @@ class NetworkInterfaceConfigurationSerializer(UniqueFieldsMixin, WritableNestedM
     @mycontext('NetworkInterfaceConfigurationSerializer::validate')
     def validate(self, data):
         print(f'NetworkInterfaceConfigurationSerializer::validate: {data}')
+
+        # Uniqueness of the Hostnames (when this is the top-level serializer), in one query
+        hostname_set_data = data.get('hostname_set', None)
+        if self.parent is None and hostname_set_data is not None:
+            errors = hostname_conflicts(hostname_set_data, configuration=self.instance)
+            if errors is not None:
+                raise serializers.ValidationError(errors)
+
         return data
 
     @mycontext('NetworkInterfaceConfigurationSerializer::create')
@@ -166,13 +218,19 @@ class NetworkInterfaceConfigurationSerializer(UniqueFieldsMixin, WritableNestedM
     @mycontext('NetworkInterfaceConfigurationSerializer::update')
     def update(self, instance, validated_data):
         print(f'NetworkInterfaceConfigurationSerializer::update: UPDATE')
-        # Remove our child objects from the database before we update
+        # Match our child objects against the existing rows, and only write what changed
         # We're within a transaction thanks to the ViewSet::perform_update call
-        instance.hostname_set.all().delete()
-        return super().update(instance=instance, validated_data=validated_data)
+        hostname_set_data = validated_data.pop('hostname_set', None)
+        instance = super().update(instance=instance, validated_data=validated_data)
+        if hostname_set_data is not None:
+            write_hostname_set(instance, hostname_set_data)
+
+        return instance
 
 # Serializers define the API representation.
-class NetworkInterfaceSerializer(UniqueFieldsMixin, WritableNestedModelSerializer):
+class NetworkInterfaceSerializer(WritableNestedModelSerializer):
+    # Optional: identifies the existing NetworkInterface to update in nested writes
+    id = serializers.IntegerField(required=False)
     networkinterfaceconfiguration_set = NetworkInterfaceConfigurationSerializer(
         many=True,
         read_only=False,
@@ -188,7 +246,7 @@ class NetworkInterfaceSerializer(UniqueFieldsMixin, WritableNestedModelSerialize
         value = value.lower()
         value = value.replace('-', ':')
 
-        if not validators.mac_address(value):
+        if not MAC_ADDRESS_RE.match(value):
             raise serializers.ValidationError('MAC Address is invalid')
 
         # Ethernet reserved address is not allowed
@@ -274,6 +332,9 @@ class PuppetMachineSerializer(FlexFieldsModelSerializer):
 
     class Meta:
         model = PuppetMachine
+        read_only_fields = (
+            'ipmi_ipaddress_synced_at',
+        )
         fields = (
             #'facts',
             #'lcogtinstruments',
@@ -281,6 +342,9 @@ class PuppetMachineSerializer(FlexFieldsModelSerializer):
             'partitionscheme',
             'partitionscheme_custom',
             'boot_mode',
+            'ipmi_ipaddress',
+            'ipmi_ipaddress_manual',
+            'ipmi_ipaddress_synced_at',
             'lastboot_at',
             'boot_history',
             'lastbuild_at',
@@ -399,6 +463,9 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
             'image',
             'information',
             'fmxurl',
+            'primary_mac',
+            'primary_staticip',
+            'primary_hostname',
             'puppetmachine',
             'webcam',
             'networkinterface_set',
@@ -430,6 +497,16 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
     @mycontext('NetworkDeviceSerializer::validate')
     def validate(self, data):
         print(f'NetworkDeviceSerializer::validate: {data}')
+
+        # Uniqueness of every MAC Address and Hostname in the nested data, checked with one
+        # query per field (rows which this update replaces do not count as conflicts). The
+        # bulk API checks all of its items together instead, see machineconfig.bulk.
+        networkinterface_set_data = data.get('networkinterface_set', None)
+        if networkinterface_set_data is not None and not self.context.get('bulk_unique_validation', False):
+            errors = unique_conflicts(networkinterface_set_data, networkdevice=self.instance)
+            if errors is not None:
+                raise serializers.ValidationError(errors)
+
         return data
 
     @mycontext('NetworkDeviceSerializer::create')
@@ -465,22 +542,8 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
         except serializers.ValidationError as ex:
             raise serializers.ValidationError({'webcam': ex.detail}) from ex
 
-        # create NetworkInterface sub-objects
-        errors = []
-        for interface_data in networkinterface_set_data:
-            serializer = NetworkInterfaceSerializer(data=interface_data, context=self.context)
-            try:
-                if not serializer.is_valid():
-                    raise serializers.ValidationError(serializer.errors)
-
-                serializer.save(networkdevice=instance)
-                errors.append({})
-            except serializers.ValidationError as ex:
-                errors.append(ex.detail)
-
-        # handle any errors encountered while validating reverse foreign-key relation
-        if any(errors):
-            raise serializers.ValidationError({'networkinterface_set': errors})
+        # create NetworkInterface sub-objects (and their sub-objects) in bulk
+        write_networkinterfaces(instance, networkinterface_set_data)
 
         # return NetworkDevice instance
         return instance
@@ -488,6 +551,7 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
     @mycontext('NetworkDeviceSerializer::update')
     def update(self, instance, validated_data):
         print(f'NetworkDeviceSerializer::update: UPDATE validated_data={validated_data}')
+        site_id = instance.site_id
 
         # Update fields within PuppetMachine sub-object
         puppetmachine_data = validated_data.pop('puppetmachine', None)
@@ -514,33 +578,13 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
                     raise serializers.ValidationError({'webcam': ex.detail})
 
         # Our DB transaction is locked thanks to perform_update(), so we don't have anything
-        # to worry about in that regard. Now we need to avoid the DB from crashing because
-        # our NetworkInterface sub-objects must have UNIQUE MAC Address fields.
-        #
-        # So we DELETE our NetworkInterface sub-objects (within the DB transaction) so
-        # that the database uniqueness validation will work. :-)
-        instance.networkinterface_set.all().delete()
-
-        # And now we go through and create all of the objects again. Note that you MUST pop
-        # the sub-object's validated data before creating the current object.
-        networkinterface_set_data = validated_data.pop('networkinterface_set', [])
-
-        # create all of the NetworkInterface sub-objects again, since they were DELETE-ed up above
-        errors = []
-        for interface_data in networkinterface_set_data:
-            serializer = NetworkInterfaceSerializer(data=interface_data, context=self.context)
-            try:
-                if not serializer.is_valid():
-                    raise serializers.ValidationError(serializer.errors)
-
-                serializer.save(networkdevice=instance)
-                errors.append({})
-            except serializers.ValidationError as ex:
-                errors.append(ex.detail)
-
-        # handle any errors encountered while validating reverse foreign-key relation
-        if any(errors):
-            raise serializers.ValidationError({'networkinterface_set': errors})
+        # to worry about in that regard. Match the NetworkInterface sub-objects (and their
+        # sub-objects) against the existing rows, and only write what changed. The MAC Address
+        # and Hostname UNIQUE constraints are deferred, so values may move between rows.
+        # Note that you MUST pop the sub-object's validated data before saving the current object.
+        networkinterface_set_data = validated_data.pop('networkinterface_set', None)
+        if networkinterface_set_data is not None:
+            write_networkinterfaces(instance, networkinterface_set_data)
 
         # Now set the updated field values (normal fields, rather than nested ForeignKey relationships)
         for attr, value in validated_data.items():
@@ -556,6 +600,10 @@ class NetworkDeviceSerializer(FlexFieldsModelSerializer):
 
         # Save the record and return to the user
         instance.save()
+
+        # The history records carry a copy of the Site: move them along with the device
+        if instance.site_id != site_id:
+            update_history_site([instance, ])
         return instance
 
 class SiteDashboardDataSerializer(serializers.Serializer):
@@ -678,4 +726,33 @@ class UnrecognizedPXEDeviceSerializer(FlexFieldsModelSerializer):
             ),
         }
 
+class IPReservationSerializer(FlexFieldsModelSerializer):
+
+    class Meta:
+        model = IPReservation
+        fields = '__all__'
+        expandable_fields = {
+            'site': (
+                'machineconfig.SiteSerializer',
+                {
+                    'read_only': True,
+                }
+            ),
+        }
+
+    def validate(self, data):
+        site = data.get('site', getattr(self.instance, 'site', None))
+        start = ipaddress.ip_address(data.get('start', getattr(self.instance, 'start', None)))
+        end = ipaddress.ip_address(data.get('end', getattr(self.instance, 'end', None)))
+
+        if start > end:
+            raise serializers.ValidationError({'end': 'The last IP Address must not be before the first'})
+
+        network = site_network(site)
+        for (name, value) in (('start', start, ), ('end', end, ), ):
+            if value not in network:
+                raise serializers.ValidationError({name: f'IP Address {value} is outside of the Site network {network}'})
+
+        return data
+
 # vim: set ts=4 sts=4 sw=4 et tw=120:
@@ -1,3 +1,1250 @@
+from django.db import connection
+from django.db import transaction
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from machineconfig.models import Site
+from machineconfig.models import NetworkDevice
+from machineconfig.models import NetworkInterface
+from machineconfig.models import NetworkInterfaceConfiguration
+from machineconfig.models import Hostname
+from machineconfig.models import PuppetMachine
+from machineconfig.models import IPMIStatus
+from machineconfig.models import JobOutput
+from machineconfig.models import BootHistory
+from machineconfig.models import BuildHistory
+from machineconfig.models import HistoryRollup
+from machineconfig.models import IPReservation
+from machineconfig.models import UnrecognizedPXEDevice
+
+from machineconfig.bulk import bulk_upsert_networkdevices
+from machineconfig.compression import COMPRESSION_MIN_SIZE
+from machineconfig.compression import compress_response
+from machineconfig.compression import precompressed_clear
+from machineconfig.management.commands.dns_standin import StandInDNSProtocol
+from machineconfig.management.commands.dns_standin import standin_records
+from machineconfig.ipmi import sync_ipmi_ipaddresses
+from machineconfig.jobs import job_output
+from machineconfig.jobs import persist_job_output
+from machineconfig.jobs import stream_job_output
+from machineconfig.nested import check_deferred_constraints
+from machineconfig.puppet import puppet_batch_timeout
+from machineconfig.puppet import run_puppet_batch
+from machineconfig.remote import run_remote_command
+from machineconfig.resolver import RECORD_TYPES
+from machineconfig.retention import RETENTION_TABLES
+from machineconfig.retention import retention_cutoff
+from machineconfig.resolver import cache_clear
+from machineconfig.resolver import check_dns_records
+from machineconfig.resolver import resolve
+from machineconfig.rollups import truncate_hour
+from machineconfig.rollups import update_rollups
+from machineconfig.search import search
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from unittest import mock
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+def quietly(function, *args, **kwargs):
+    '''Call the function with its print() logging discarded'''
+    with redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+def make_site(code='tst', networkip='10.99.0.0'):
+    return Site.objects.create(
+        code=code,
+        shortdescription=f'Test Site {code}',
+        domain=f'{code}.lco.gtn',
+        networkip=networkip,
+        networkcidr=16,
+        gateway=networkip.replace('.0.0', '.0.254'),
+        dnsservers=[networkip.replace('.0.0', '.0.15'), ],
+        mirrorbase='http://mirror.example.com/',
+        mirrorbasealt='http://mirror-alt.example.com/',
+    )
+
+def make_networkdevice(site, index, interfaces=1, puppetmachine=True):
+    '''A NetworkDevice with one configuration and one Hostname per NetworkInterface'''
+    networkdevice = NetworkDevice.objects.create(site=site, information=f'device {index}')
+    if puppetmachine:
+        PuppetMachine.objects.create(networkdevice=networkdevice)
+
+    for interface in range(interfaces):
+        networkinterface = NetworkInterface.objects.create(
+            networkdevice=networkdevice,
+            mac=f'00:11:22:{index // 256:02x}:{index % 256:02x}:{interface:02x}',
+        )
+        configuration = NetworkInterfaceConfiguration.objects.create(
+            networkinterface=networkinterface,
+            ipaddress=f'10.99.{index // 250}.{index % 250 + 1}' if interface == 0 else None,
+        )
+        hostname = f'host{index}.{site.domain}' if interface == 0 else f'host{index}-{interface}.{site.domain}'
+        Hostname.objects.create(networkinterfaceconfiguration=configuration, hostname=hostname)
+
+    return networkdevice
+
+class AliveManyTestCase(TestCase):
+    '''POST /api/networkdevice/alive/: every device is pinged at once'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        NetworkDevice.objects.bulk_create([
+            NetworkDevice(site=self.site, information=f'device {index}', primary_staticip=f'10.99.1.{index}')
+            for index in range(1, 201)
+        ])
+
+    def test_all_devices_answer_within_one_deadline(self):
+        def slow_ping(target, deadline):
+            time.sleep(1.0)
+            return True
+
+        start = time.monotonic()
+        with mock.patch('machineconfig.viewsets.ping_alive', side_effect=slow_ping):
+            response = self.client.post('/api/networkdevice/alive/?site=tst&deadline=5', {}, format='json')
+            results = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual(len(results), 200)
+        self.assertTrue(all(result['alive'] is True for result in results))
+        # one wave of pings, rather than one wave per ALIVE_MAX_WORKERS devices
+        self.assertLess(time.monotonic() - start, 2.0)
+
+    @override_settings(ALIVE_MAX_WORKERS=50)
+    def test_pool_is_bounded_by_setting(self):
+        with mock.patch('machineconfig.viewsets.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as executor:
+            with mock.patch('machineconfig.viewsets.ping_alive', return_value=True):
+                response = self.client.post('/api/networkdevice/alive/?site=tst', {}, format='json')
+                b''.join(response.streaming_content)
+
+        self.assertEqual(executor.call_args.kwargs['max_workers'], 50)
+
+class StreamJobOutputTestCase(TestCase):
+    '''machineconfig.jobs.stream_job_output() always terminates'''
+
+    def make_job(self, statuses, timeout=60):
+        job = mock.Mock(id='test-job', timeout=timeout, result=None)
+        job.get_status.side_effect = statuses
+        job.connection.lrange.return_value = []
+        job.connection.exists.return_value = True
+        return job
+
+    def stream(self, job):
+        return [json.loads(line) for line in stream_job_output(job)]
+
+    def test_expired_job_is_done(self):
+        with mock.patch('machineconfig.jobs.JOB_OUTPUT_POLL_INTERVAL', 0.01):
+            results = self.stream(self.make_job(['started', None]))
+
+        self.assertIsNone(results[-1]['status'])
+        self.assertIn('expired', results[-1]['error'])
+
+    def test_gives_up_after_job_timeout(self):
+        job = self.make_job(lambda refresh: 'started', timeout=0.1)
+        with mock.patch('machineconfig.jobs.JOB_OUTPUT_STREAM_MARGIN', 0.1):
+            with mock.patch('machineconfig.jobs.JOB_OUTPUT_POLL_INTERVAL', 0.01):
+                start = time.monotonic()
+                results = self.stream(job)
+
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(results[-1]['status'], 'started')
+        self.assertIn('Gave up', results[-1]['error'])
+
+class CheckDNSTestCase(TestCase):
+    '''check_dns_records() against the stand-in nameserver (see the dns_standin management command)'''
+
+    def setUp(self):
+        cache_clear()
+        self.site = make_site()
+        for index in range(1, 4):
+            make_networkdevice(self.site, index)
+
+        self.dnsrecords = [record for record in self.site.drf_dnsrecords if record['target'] is not None]
+
+    def serve(self, records):
+        '''Start the stand-in nameserver on a background thread, and return its port'''
+        loop = asyncio.new_event_loop()
+        coroutine = loop.create_datagram_endpoint(lambda: StandInDNSProtocol(records, 60), local_addr=('127.0.0.1', 0))
+        (transport, protocol) = loop.run_until_complete(coroutine)
+
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            transport.close()
+            loop.close()
+
+        self.addCleanup(stop)
+        return transport.get_extra_info('sockname')[1]
+
+    def check(self, records):
+        port = self.serve(records)
+        data = check_dns_records(self.dnsrecords, nameserver='127.0.0.1', port=port, timeout=0.5, retries=0)
+        return {(record['hostname'], record['record_type']): record for record in data['records']}
+
+    def test_all_records_match(self):
+        results = self.check(standin_records(self.dnsrecords))
+
+        self.assertEqual(len(results), len(self.dnsrecords))
+        self.assertTrue(all(record['status'] == 'ok' for record in results.values()))
+        self.assertEqual(results[('host1.tst.lco.gtn', 'A')]['actual'], ['10.99.0.2'])
+
+    def test_mismatched_record(self):
+        records = standin_records(self.dnsrecords)
+        records[('host2.tst.lco.gtn', RECORD_TYPES['A'])] = [(RECORD_TYPES['A'], '10.99.9.9')]
+        results = self.check(records)
+
+        self.assertEqual(results[('host2.tst.lco.gtn', 'A')]['status'], 'mismatch')
+        self.assertEqual(results[('host2.tst.lco.gtn', 'A')]['actual'], ['10.99.9.9'])
+        self.assertEqual(results[('host1.tst.lco.gtn', 'A')]['status'], 'ok')
+
+    def test_missing_record(self):
+        results = self.check(standin_records(self.dnsrecords, omit=['host3.tst.lco.gtn']))
+
+        self.assertEqual(results[('host3.tst.lco.gtn', 'A')]['status'], 'missing')
+        self.assertEqual(results[('host3.tst.lco.gtn', 'A')]['actual'], [])
+        self.assertEqual(results[('host2.tst.lco.gtn', 'A')]['status'], 'ok')
+
+class SiteIPMITestCase(TestCase):
+    '''POST /api/site/<pk>/ipmi/: one operation fanned out to many BMCs'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevices = [make_networkdevice(self.site, index) for index in range(1, 5)]
+
+        # the last device has no BMC IP Address
+        for (index, networkdevice) in enumerate(self.networkdevices[:3], start=1):
+            PuppetMachine.objects.filter(pk=networkdevice.pk).update(ipmi_ipaddress=f'10.98.0.{index}')
+
+    def fake_ipmitool(self, hostname, username, password, command, timeout=15):
+        time.sleep(0.5)
+        if hostname == '10.98.0.2':
+            raise subprocess.TimeoutExpired(cmd=['ipmitool'], timeout=timeout)
+
+        if hostname == '10.98.0.3':
+            return {'stdout': b'Error: Unable to establish IPMI v2 / RMCP+ session\n', 'returncode': 1, }
+
+        return {'stdout': b'Chassis Power is on\n', 'returncode': 0, }
+
+    def post(self, data):
+        with mock.patch('machineconfig.viewsets.ipmitool', side_effect=self.fake_ipmitool) as ipmitool:
+            response = self.client.post(f'/api/site/{self.site.pk}/ipmi/', data, format='json')
+            results = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        return ({result['id']: result for result in results}, ipmitool)
+
+    def test_default_targets_devices_with_bmc(self):
+        (results, ipmitool) = self.post({'operation': 'power_status', })
+
+        self.assertEqual(sorted(results), [networkdevice.pk for networkdevice in self.networkdevices[:3]])
+        self.assertEqual(ipmitool.call_count, 3)
+
+    def test_results_and_errors_per_device(self):
+        ids = [networkdevice.pk for networkdevice in self.networkdevices]
+        start = time.monotonic()
+        (results, ipmitool) = self.post({'operation': 'power_status', 'ids': ids, 'timeout': 5, })
+
+        # every BMC is queried at once
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result['operation'] == 'power_status' for result in results.values()))
+
+        ok = results[ids[0]]
+        self.assertEqual((ok['returncode'], ok['stdout'], ok['bmc']), (0, 'Chassis Power is on\n', '10.98.0.1'))
+        self.assertNotIn('error', ok)
+
+        timedout = results[ids[1]]
+        self.assertIsNone(timedout['returncode'])
+        self.assertEqual(timedout['error'], 'BMC did not answer within 5 seconds')
+
+        failed = results[ids[2]]
+        self.assertEqual(failed['returncode'], 1)
+        self.assertIn('Unable to establish', failed['stdout'])
+
+        nobmc = results[ids[3]]
+        self.assertIsNone(nobmc['returncode'])
+        self.assertIn('No BMC IP Address known', nobmc['error'])
+
+    def test_power_on_invalidates_cached_status(self):
+        networkdevice = self.networkdevices[0]
+        IPMIStatus.objects.create(puppetmachine_id=networkdevice.pk, bmc='10.98.0.1', power_on=False)
+
+        (results, ipmitool) = self.post({'operation': 'power_on', 'ids': [networkdevice.pk, ], 'stagger': 0, })
+
+        self.assertEqual(results[networkdevice.pk]['returncode'], 0)
+        self.assertFalse(IPMIStatus.objects.filter(puppetmachine_id=networkdevice.pk).exists())
+
+    def test_invalid_operation(self):
+        response = self.client.post(f'/api/site/{self.site.pk}/ipmi/', {'operation': 'reboot', }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+class SyncIPMIAddressesTestCase(TestCase):
+    '''sync_ipmi_ipaddresses(): PuppetDB failures are counted and logged, never raised'''
+
+    def test_errors_are_counted(self):
+        site = make_site()
+        puppetmachines = [make_networkdevice(site, index).puppetmachine for index in range(1, 4)]
+        addresses = {
+            puppetmachines[0].pk: '10.98.0.1',
+            puppetmachines[1].pk: None,
+        }
+
+        def fake_fetch(puppetmachine):
+            if puppetmachine.pk not in addresses:
+                raise ConnectionError('PuppetDB is down')
+
+            return addresses[puppetmachine.pk]
+
+        with mock.patch('machineconfig.ipmi.fetch_ipmi_ipaddress', side_effect=fake_fetch):
+            with self.assertLogs('machineconfig.ipmi', level='WARNING') as logs:
+                counts = sync_ipmi_ipaddresses(puppetmachines)
+
+        self.assertEqual(counts, {'updated': 1, 'unchanged': 0, 'missing': 1, 'errors': 1, })
+        self.assertIn('PuppetDB is down', logs.output[0])
+        self.assertEqual(PuppetMachine.objects.get(pk=puppetmachines[0].pk).ipmi_ipaddress, '10.98.0.1')
+
+class IPMIStatusTestCase(TestCase):
+    '''GET /api/networkdevice/<pk>/ipmi_power_status/ and ipmi_chassis_status/ (cached chassis status)'''
+
+    CHASSIS_STATUS = b'System Power         : on\nPower Overload       : false\nCooling/Fan Fault    : true\n'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevice = make_networkdevice(self.site, 1)
+        PuppetMachine.objects.filter(pk=self.networkdevice.pk).update(ipmi_ipaddress='10.98.0.1')
+
+    def get(self, url):
+        result = {'stdout': self.CHASSIS_STATUS, 'returncode': 0, }
+        with mock.patch('machineconfig.ipmi.ipmitool', return_value=result) as ipmitool:
+            response = self.client.get(url)
+
+        return (response, ipmitool)
+
+    def test_power_status_shape(self):
+        (response, ipmitool) = self.get(f'/api/networkdevice/{self.networkdevice.pk}/ipmi_power_status/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stdout'], 'Chassis Power is on\n')
+        self.assertEqual(response.data['returncode'], 0)
+        self.assertEqual(response.data['faults'], ['Cooling/Fan Fault', ])
+        self.assertFalse(response.data['cached'])
+
+    def test_chassis_status_is_cached(self):
+        url = f'/api/networkdevice/{self.networkdevice.pk}/ipmi_chassis_status/'
+        self.get(url)
+        (response, ipmitool) = self.get(url)
+
+        self.assertEqual(response.data['stdout'], self.CHASSIS_STATUS.decode('utf-8'))
+        self.assertTrue(response.data['cached'])
+        self.assertEqual(ipmitool.call_count, 0)
+
+        (response, ipmitool) = self.get(url + '?refresh=true')
+        self.assertFalse(response.data['cached'])
+        self.assertEqual(ipmitool.call_count, 1)
+
+    def test_no_bmc(self):
+        PuppetMachine.objects.filter(pk=self.networkdevice.pk).update(ipmi_ipaddress=None)
+        (response, ipmitool) = self.get(f'/api/networkdevice/{self.networkdevice.pk}/ipmi_power_status/')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('No BMC IP Address known', response.data['error'])
+        self.assertEqual(ipmitool.call_count, 0)
+
+class PuppetBatchTestCase(TestCase):
+    '''run_puppet_batch(), with the RQ queue and the child jobs faked'''
+
+    def setUp(self):
+        self.site = make_site()
+        self.ids = [make_networkdevice(self.site, index).pk for index in range(1, 5)]
+
+    def run_batch(self, statuses, **kwargs):
+        '''Run a batch where the child job of each device reports statuses[index] forever'''
+        children = []
+
+        def enqueue(function, networkdevice_id, job_id, job_timeout):
+            child = mock.Mock(id=job_id, result={'returncode': 0, })
+            child.get_status.return_value = statuses[self.ids.index(networkdevice_id)]
+            children.append(child)
+            return child
+
+        job = mock.Mock(id='batch-job', meta={})
+        with mock.patch('machineconfig.puppet.get_current_job', return_value=job), \
+             mock.patch('machineconfig.jobs.get_current_job', return_value=job), \
+             mock.patch('machineconfig.puppet.django_rq.get_queue') as get_queue, \
+             mock.patch('machineconfig.puppet.PUPPET_BATCH_POLL_INTERVAL', 0):
+            get_queue.return_value.enqueue.side_effect = enqueue
+            data = quietly(run_puppet_batch, self.ids, **kwargs)
+
+        return (data, job.meta['batch'], children)
+
+    def test_timeout_counts_canary_rounds(self):
+        # 8 canaries 4 at a time (2 rounds), then 12 devices 4 at a time (3 rounds)
+        self.assertEqual(puppet_batch_timeout(20, max_parallel=4, canaries=8, timeout=100), (5 * 160) + 300)
+        self.assertEqual(puppet_batch_timeout(20, max_parallel=4, canaries=0, timeout=100), (5 * 160) + 300)
+        self.assertEqual(puppet_batch_timeout(3, max_parallel=4, canaries=1, timeout=100), (2 * 160) + 300)
+
+    def test_all_finished(self):
+        (data, batch, children) = self.run_batch(['finished'] * 4, max_parallel=2)
+
+        self.assertEqual(data['state'], 'finished')
+        self.assertEqual(data['succeeded'], 4)
+        self.assertEqual(len(children), 4)
+
+    def test_expired_job_counts_as_failed(self):
+        (data, batch, children) = self.run_batch(['finished', None, 'finished', 'finished'], max_parallel=4,
+                                                 max_failure_rate=0.5)
+
+        self.assertEqual(data['state'], 'finished')
+        self.assertEqual((data['succeeded'], data['failed']), (3, 1))
+        self.assertEqual(batch['devices'][self.ids[1]]['status'], 'failed')
+        self.assertIn('expired', batch['devices'][self.ids[1]]['error'])
+
+    def test_expired_canary_aborts(self):
+        (data, batch, children) = self.run_batch([None, 'finished', 'finished', 'finished'])
+
+        self.assertEqual(data['state'], 'aborted')
+        self.assertEqual((data['failed'], data['skipped']), (1, 3))
+        self.assertEqual(len(children), 1)
+
+    def test_deadline(self):
+        with mock.patch('machineconfig.puppet.puppet_batch_deadline', return_value=0.1):
+            start = time.monotonic()
+            (data, batch, children) = self.run_batch(['started'] * 4, max_parallel=2, canaries=0)
+
+        self.assertLess(time.monotonic() - start, 5.0)
+        self.assertEqual(data['state'], 'aborted')
+        self.assertIn('Deadline', data['abort_reason'])
+        self.assertEqual((data['failed'], data['skipped']), (2, 2))
+        self.assertIn('deadline', batch['devices'][self.ids[0]]['error'])
+
+class RemoteCommandTestCase(TestCase):
+    '''run_remote_command(): the SSH master is started on its own, and never by the command'''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings = override_settings(SSH_CONTROL_DIR=directory.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def run_command(self, returncodes):
+        '''Run a remote command, where the ssh calls before the command itself exit with returncodes'''
+        with mock.patch('machineconfig.remote.subprocess.run') as run, \
+             mock.patch('machineconfig.remote.run_streaming_command') as run_streaming_command:
+            run.side_effect = [mock.Mock(returncode=returncode) for returncode in returncodes]
+            quietly(run_remote_command, 'host1.tst.lco.gtn', 'uptime', timeout=60)
+
+        return ([call.args[0] for call in run.call_args_list], run.call_args_list, run_streaming_command.call_args.args[0])
+
+    def test_master_is_started_detached(self):
+        (cmds, calls, command) = self.run_command([255, 0, ])
+
+        # "ssh -O check" found no master, so one is started in the background
+        self.assertIn('check', cmds[0])
+        self.assertIn('-f', cmds[1])
+        self.assertIn('ControlPersist=300', cmds[1])
+        for stream in ('stdin', 'stdout', 'stderr', ):
+            self.assertEqual(calls[1].kwargs[stream], subprocess.DEVNULL)
+
+        self.assertIn('ControlMaster=no', command)
+        self.assertFalse(any(option.startswith('ControlPersist') for option in command))
+        self.assertIn('ControlPath=' + self.settings.options['SSH_CONTROL_DIR'] + '/%C', command)
+
+    def test_running_master_is_reused(self):
+        (cmds, calls, command) = self.run_command([0, ])
+
+        self.assertEqual(len(cmds), 1)
+        self.assertIn('ControlMaster=no', command)
+
+    def test_direct_connection_without_master(self):
+        (cmds, calls, command) = self.run_command([255, 255, ])
+
+        self.assertIn('ControlPath=none', command)
+        self.assertIn('ControlMaster=no', command)
+
+class JobOutputTestCase(TestCase):
+    '''Persisted job output has the same line numbers as the Redis list it was copied from'''
+
+    def test_lines_match_redis(self):
+        # as read from a tty: carriage returns, a form feed, and an unterminated last line
+        published = [b'Info: Applying\r\n', b'progress 50%\rprogress 100%\n', b'page\x0cbreak\n', b'\n', b'done', ]
+        connection = mock.Mock()
+        connection.lrange.side_effect = lambda key, start, end: published[start:(None if end == -1 else end + 1)]
+        joboutput = persist_job_output(connection, 'test-job', 0)
+
+        self.assertEqual(joboutput.lines, len(published))
+        self.assertEqual(JobOutput.objects.get(job_id='test-job').get_lines(), published)
+
+        # once Redis has expired the output, it is read from the database with the same indexes
+        connection.lrange.side_effect = None
+        connection.lrange.return_value = []
+        connection.exists.return_value = False
+        self.assertEqual(job_output(connection, 'test-job', start=1, end=2), published[1:3])
+        self.assertEqual(job_output(connection, 'test-job', start=4), published[4:])
+
+class RetentionTestCase(TestCase):
+    '''Retention is opt-in: by default only the History table is pruned'''
+
+    def test_default_retention(self):
+        now = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(retention_cutoff('history', now=now), now - datetime.timedelta(days=7))
+
+        for name in RETENTION_TABLES:
+            if name != 'history':
+                self.assertIsNone(retention_cutoff(name, now=now), name)
+
+class HistoryQueryPlanTestCase(TestCase):
+    '''Every common history query (API, dashboard, rollups, retention) is served by an index'''
+
+    def setUp(self):
+        self.site = make_site()
+        self.puppetmachine = make_networkdevice(self.site, 1).puppetmachine
+
+    def history_queries(self):
+        cutoff = timezone.now() - datetime.timedelta(days=1)
+        pk = self.puppetmachine.pk
+
+        queries = []
+        for (model, field, value) in ((BootHistory, 'boot_mode', 'local'), (BuildHistory, 'status', 'COMPLETE'), ):
+            name = model._meta.model_name
+            queries += [
+                (f'{name}: latest for one PuppetMachine',
+                    model.objects.filter(puppetmachine_id=pk).order_by('-created_at')[:1]),
+                (f'{name}: time range',
+                    model.objects.filter(created_at__gte=cutoff)),
+                (f'{name}: time range and {field}',
+                    model.objects.filter(created_at__gte=cutoff, **{field: value})),
+                (f'{name}: time range for one Site',
+                    model.objects.filter(site_id=self.site.pk, created_at__gte=cutoff)),
+                (f'{name}: expired rows, oldest first',
+                    model.objects.filter(created_at__lt=cutoff).order_by('created_at').values('pk')[:1000]),
+            ]
+
+        return queries
+
+    def test_no_sequential_scans(self):
+        for (description, queryset) in self.history_queries():
+            table = queryset.model._meta.db_table
+            with self.subTest(description), transaction.atomic():
+                # The test tables are tiny, where a sequential scan is always cheapest:
+                # make it prohibitively expensive, so that the plan shows whether an
+                # index *can* serve the query.
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+                plan = queryset.explain()
+                self.assertNotIn(f'Seq Scan on {table}', plan)
+
+class HistorySiteTestCase(TestCase):
+    '''The Site copied onto history records follows the NetworkDevice to another Site'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.other = make_site(code='oth', networkip='10.97.0.0')
+        self.networkdevice = make_networkdevice(self.site, 1)
+
+        puppetmachine = self.networkdevice.puppetmachine
+        BootHistory.objects.create(puppetmachine=puppetmachine, boot_mode='local')
+        BuildHistory.objects.create(puppetmachine=puppetmachine, status='BEGIN')
+
+    def assertHistorySite(self, site):
+        for model in (BootHistory, BuildHistory, ):
+            sites = set(model.objects.filter(puppetmachine_id=self.networkdevice.pk).values_list('site', flat=True))
+            self.assertEqual(sites, {site.pk, }, model.__name__)
+
+    def test_history_records_site_on_insert(self):
+        self.assertHistorySite(self.site)
+
+    def test_update_moves_history(self):
+        url = f'/api/networkdevice/{self.networkdevice.pk}/'
+        response = quietly(self.client.patch, url, {'site': self.other.pk, }, format='json')
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertHistorySite(self.other)
+
+    def test_bulk_update_moves_history(self):
+        data = quietly(bulk_upsert_networkdevices, [{'id': self.networkdevice.pk, 'site': self.other.pk, }, ])
+
+        self.assertTrue(data['ok'], data)
+        self.assertHistorySite(self.other)
+
+    def rollups(self):
+        queryset = HistoryRollup.objects.values_list('kind', 'resolution', 'site', 'key', 'bucket', 'count')
+        return set(queryset)
+
+    def test_update_moves_rollups(self):
+        # older history for both devices, so that it is rolled up before the move
+        stay = make_networkdevice(self.site, 2)
+        created_at = timezone.now() - datetime.timedelta(days=3)
+        for puppetmachine in (self.networkdevice.puppetmachine, stay.puppetmachine, ):
+            pk = BootHistory.objects.create(puppetmachine=puppetmachine, boot_mode='rebuild').pk
+            BootHistory.objects.filter(pk=pk).update(created_at=created_at)
+            pk = BuildHistory.objects.create(puppetmachine=puppetmachine, status='END').pk
+            BuildHistory.objects.filter(pk=pk).update(created_at=created_at)
+
+        for kind in ('boot', 'build', ):
+            update_rollups(kind)
+
+        before = self.rollups()
+        self.assertIn(('boot', 'day', self.site.pk), {rollup[:3] for rollup in before})
+
+        url = f'/api/networkdevice/{self.networkdevice.pk}/'
+        response = quietly(self.client.patch, url, {'site': self.other.pk, }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+        # the old buckets moved: both devices had one record each in them
+        moved = {rollup for rollup in self.rollups() if rollup[4] < truncate_hour(timezone.now())}
+        self.assertTrue(moved)
+        for (kind, resolution, site, key, bucket, count) in moved:
+            self.assertIn(site, (self.site.pk, self.other.pk, ))
+            self.assertEqual(count, 1)
+
+        # and an incremental update agrees with rolling up everything again
+        for kind in ('boot', 'build', ):
+            update_rollups(kind)
+
+        incremental = self.rollups()
+        HistoryRollup.objects.all().delete()
+        for kind in ('boot', 'build', ):
+            update_rollups(kind)
+
+        self.assertEqual(incremental, self.rollups())
+
+class NestedWriteTestCase(TestCase):
+    '''PATCH /api/networkdevice/<pk>/ with a networkinterface_set: only what changed is written'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevice = make_networkdevice(self.site, 1, interfaces=2)
+
+    def tree(self):
+        '''The NetworkInterface tree, in primary key order, as nested (pk, value, children) tuples'''
+        interfaces = []
+        for interface in self.networkdevice.networkinterface_set.order_by('pk'):
+            configurations = []
+            for configuration in interface.networkinterfaceconfiguration_set.order_by('pk'):
+                hostnames = [(hostname.pk, hostname.hostname, ) for hostname in configuration.hostname_set.order_by('pk')]
+                configurations.append((configuration.pk, configuration.ipaddress, hostnames, ))
+
+            interfaces.append((interface.pk, interface.mac, interface.description, configurations, ))
+
+        return interfaces
+
+    def data(self, tree):
+        '''The networkinterface_set data for a tree (without ids, so rows match by natural key)'''
+        return [{
+            'mac': mac,
+            'description': description,
+            'networkinterfaceconfiguration_set': [{
+                'ipaddress': ipaddress or '',
+                'hostname_set': [{'hostname': hostname, } for (pk, hostname) in hostnames],
+            } for (pk, ipaddress, hostnames) in configurations],
+        } for (pk, mac, description, configurations) in tree]
+
+    def patch(self, networkinterface_set):
+        url = f'/api/networkdevice/{self.networkdevice.pk}/'
+        response = quietly(self.client.patch, url, {'networkinterface_set': networkinterface_set, }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.networkdevice.refresh_from_db()
+        return response
+
+    def test_description_only_keeps_ids(self):
+        before = self.tree()
+        data = self.data(before)
+        data[1]['description'] = 'Management'
+        self.patch(data)
+
+        after = self.tree()
+        self.assertEqual(after[1][2], 'Management')
+        self.assertEqual([interface[0] for interface in after], [interface[0] for interface in before])
+        self.assertEqual([interface[3] for interface in after], [interface[3] for interface in before])
+
+    def test_mac_swap_between_interfaces(self):
+        before = self.tree()
+        data = self.data(before)
+        for (item, interface) in zip(data, before):
+            item['id'] = interface[0]
+
+        (data[0]['mac'], data[1]['mac']) = (data[1]['mac'], data[0]['mac'])
+        self.patch(data)
+
+        after = self.tree()
+        self.assertEqual([interface[0] for interface in after], [interface[0] for interface in before])
+        self.assertEqual([interface[1] for interface in after], [before[1][1], before[0][1]])
+        self.assertEqual(self.networkdevice.primary_mac, before[1][1])
+
+    def test_reordering(self):
+        before = self.tree()
+        data = self.data(before)
+        data.reverse()
+        self.patch(data)
+
+        # the primary interface is the one with the lowest primary key, so the order of the rows follows the data
+        after = self.tree()
+        self.assertEqual([interface[1] for interface in after], [before[1][1], before[0][1]])
+        self.assertEqual(self.networkdevice.primary_mac, before[1][1])
+        self.assertEqual(self.networkdevice.primary_hostname, 'host1-1.tst.lco.gtn')
+
+    def test_hostname_moves_between_configurations(self):
+        before = self.tree()
+        data = self.data(before)
+        moved = data[1]['networkinterfaceconfiguration_set'][0]['hostname_set'][0]['hostname']
+        data[0]['networkinterfaceconfiguration_set'][0]['hostname_set'].append({'hostname': moved, })
+        data[1]['networkinterfaceconfiguration_set'][0]['hostname_set'] = [{'hostname': 'host1-new.tst.lco.gtn', }, ]
+        self.patch(data)
+
+        after = self.tree()
+        self.assertEqual([interface[0] for interface in after], [interface[0] for interface in before])
+        self.assertEqual([hostname for (pk, hostname) in after[0][3][0][2]], ['host1.tst.lco.gtn', moved, ])
+        self.assertEqual([hostname for (pk, hostname) in after[1][3][0][2]], ['host1-new.tst.lco.gtn', ])
+        # the primary hostname row is untouched
+        self.assertEqual(after[0][3][0][2][0], before[0][3][0][2][0])
+
+    def test_constraints_deferred_after_check(self):
+        (first, second) = self.networkdevice.networkinterface_set.order_by('pk')
+        with transaction.atomic():
+            check_deferred_constraints()
+
+            # two statements, with a duplicate MAC Address in between
+            NetworkInterface.objects.filter(pk=first.pk).update(mac=second.mac)
+            NetworkInterface.objects.filter(pk=second.pk).update(mac=first.mac)
+            check_deferred_constraints()
+
+        self.assertEqual(NetworkInterface.objects.get(pk=first.pk).mac, second.mac)
+
+class BulkUpsertTestCase(TestCase):
+    '''bulk_upsert_networkdevices(): item ids, and what counts as a change to a device'''
+
+    def setUp(self):
+        self.site = make_site()
+
+    def test_duplicate_ids(self):
+        site = self.site
+        (first, second) = [make_networkdevice(site, index) for index in range(1, 3)]
+        items = [
+            {'id': first.pk, 'information': 'one', },
+            {'id': second.pk, 'information': 'two', },
+            {'id': first.pk, 'information': 'three', },
+        ]
+        data = quietly(bulk_upsert_networkdevices, items)
+
+        self.assertFalse(data['ok'])
+        self.assertEqual(data['results'][0]['errors'], {'id': [f'Duplicate id {first.pk} in payload', ], })
+        self.assertNotIn('errors', data['results'][1])
+        self.assertEqual(data['results'][2]['errors'], {'id': [f'Duplicate id {first.pk} in payload', ], })
+        self.assertEqual(NetworkDevice.objects.get(pk=first.pk).information, 'device 1')
+
+    def test_invalid_ids(self):
+        networkdevice = make_networkdevice(self.site, 1)
+        items = [
+            {'id': str(networkdevice.pk), 'information': 'one', },
+            {'id': [networkdevice.pk, ], },
+            {'id': {}, },
+            {'id': True, },
+            {'id': 'one', },
+        ]
+        data = quietly(bulk_upsert_networkdevices, items)
+
+        self.assertFalse(data['ok'])
+        self.assertNotIn('errors', data['results'][0])
+        for (index, value) in enumerate((f'[{networkdevice.pk}]', '{}', 'true', '"one"', ), start=1):
+            self.assertEqual(data['results'][index]['errors'], {
+                'id': [f'Invalid id {value}: a valid integer is required', ],
+            })
+
+        data = quietly(bulk_upsert_networkdevices, items[:1])
+        self.assertTrue(data['ok'], data)
+        self.assertEqual(NetworkDevice.objects.get(pk=networkdevice.pk).information, 'one')
+
+    def test_nested_change_updates_serialno(self):
+        networkdevice = make_networkdevice(self.site, 1)
+        yesterday = timezone.now() - datetime.timedelta(days=1)
+        Site.objects.filter(pk=self.site.pk).update(updated_at=yesterday)
+        NetworkDevice.objects.filter(pk=networkdevice.pk).update(updated_at=yesterday)
+        before = Site.objects.get(pk=self.site.pk).dns_serialno
+
+        interface = networkdevice.networkinterface_set.get()
+        configuration = interface.networkinterfaceconfiguration_set.get()
+        items = [{
+            'id': networkdevice.pk,
+            'networkinterface_set': [{
+                'mac': interface.mac,
+                'description': 'Changed',
+                'networkinterfaceconfiguration_set': [{
+                    'ipaddress': configuration.ipaddress,
+                    'hostname_set': [{'hostname': hostname.hostname, }
+                                     for hostname in configuration.hostname_set.order_by('pk')],
+                }, ],
+            }, ],
+        }, ]
+        data = quietly(bulk_upsert_networkdevices, items)
+
+        self.assertTrue(data['ok'], data)
+        self.assertGreater(NetworkDevice.objects.get(pk=networkdevice.pk).updated_at, yesterday)
+        self.assertNotEqual(Site.objects.get(pk=self.site.pk).dns_serialno, before)
+
+class POSTDataTestCase(TestCase):
+    '''Endpoints which read parameters from the POST data reject a body which is not a JSON object'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+
+    def test_not_an_object(self):
+        urls = (
+            '/api/networkdevice/alive/?site=tst',
+            '/api/networkdevice/puppet_batch/?site=tst',
+            f'/api/site/{self.site.pk}/ipmi/',
+            f'/api/site/{self.site.pk}/ipam/next-free/',
+            '/api/tools/resolve/',
+        )
+        for url in urls:
+            with self.subTest(url):
+                response = self.client.post(url, [1, 2, ], format='json')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('JSON object', response.data['error'])
+
+class ToolJobTestCase(TestCase):
+    '''The job-style diagnostic tools API (machineconfig.api_views.tool_job), with the RQ queues faked'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.queues = {}
+
+        patcher = mock.patch('machineconfig.api_views.django_rq.get_queue', side_effect=self.get_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_queue(self, name):
+        if name not in self.queues:
+            queue = mock.Mock(count=0)
+            queue.name = name
+            queue.started_job_registry.count = 0
+            queue.enqueue.return_value = mock.Mock(id=f'{name}-job', timeout=25)
+            self.queues[name] = queue
+
+        return self.queues[name]
+
+    @override_settings(TOOLS_MAX_INFLIGHT={'ping': 3, 'traceroute': 8, 'host': 32, 'dig': 32, })
+    def test_too_many_in_flight(self):
+        response = self.client.post('/api/tools/ping/10.99.0.1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['job_id'], 'tools_ping-job')
+
+        queue = self.get_queue('tools_ping')
+        queue.count = 2
+        queue.started_job_registry.count = 1
+        response = self.client.post('/api/tools/ping/10.99.0.1/')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(queue.enqueue.call_count, 1)
+
+    def test_get_requires_job_id(self):
+        response = self.client.get('/api/tools/ping/10.99.0.1/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('job_id', response.data['error'])
+
+    def test_job_of_another_tool(self):
+        job = mock.Mock(origin='tools_traceroute', result=None)
+        job.get_status.return_value = 'finished'
+        self.get_queue('tools_ping').fetch_job.return_value = job
+
+        response = self.client.get('/api/tools/ping/10.99.0.1/?job_id=abc')
+        self.assertEqual(response.status_code, 400)
+
+        job.origin = 'tools_ping'
+        response = self.client.get('/api/tools/ping/10.99.0.1/?job_id=abc')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'finished')
+
+class ResolveDeadlineTestCase(TestCase):
+    '''A batch against a nameserver which never answers gives up at the overall deadline'''
+
+    def test_silent_nameserver(self):
+        cache_clear()
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        self.addCleanup(silent.close)
+        port = silent.getsockname()[1]
+
+        queries = [(f'host{index}.tst.lco.gtn', 'A') for index in range(200)]
+        start = time.monotonic()
+        results = resolve(queries, nameserver='127.0.0.1', port=port, timeout=2.0, retries=2, concurrency=8,
+                          deadline=0.5)
+
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual([result['name'] for result in results], [name for (name, record_type) in queries])
+        self.assertTrue(all(result['status'] == 'ERROR' for result in results))
+        self.assertIn('deadline of 0.5 seconds', results[-1]['error'])
+
+class SearchTestCase(TestCase):
+    '''machineconfig.search.search(): each kind of match, merged into one hit per object and ranked'''
+
+    def setUp(self):
+        self.site = make_site()
+        self.networkdevices = [make_networkdevice(self.site, index) for index in (1, 2, 300, )]
+        self.pxedevice = UnrecognizedPXEDevice.objects.create(mac='00:11:22:00:01:ff', ipaddress='10.99.2.1')
+
+    def hits(self, q):
+        return [(hit['type'], hit['id'], ) for hit in search(q)]
+
+    def test_mac_prefix_formats(self):
+        expected = {('networkdevice', self.networkdevices[0].pk, ), ('unrecognizedpxedevice', self.pxedevice.pk, ), }
+        for q in ('00:11:22:00:01', '00-11-22-00-01', '0011.2200.01', '0011220001', ' 00:11:22:00:01 ', ):
+            with self.subTest(q):
+                hits = search(q)
+                self.assertEqual({(hit['type'], hit['id'], ) for hit in hits}, expected)
+                for hit in hits:
+                    self.assertEqual(hit['matches'][0]['field'], 'mac')
+                    self.assertEqual(hit['score'], round(10 / 12, 3))
+
+    def test_full_mac_is_exact(self):
+        hits = search('00-11-22-00-01-00')
+        self.assertEqual(hits[0]['id'], self.networkdevices[0].pk)
+        self.assertEqual(hits[0]['score'], 1.0)
+
+    def test_partial_ipaddress(self):
+        (first, second, third) = [networkdevice.pk for networkdevice in self.networkdevices]
+        self.assertEqual(self.hits('10.99.0'), [
+            ('networkdevice', first, ),
+            ('networkdevice', second, ),
+            ('site', self.site.pk, ),
+        ])
+        self.assertEqual(self.hits('10.99.1.'), [('networkdevice', third, ), ('site', self.site.pk, ), ])
+
+    def test_cidr(self):
+        hits = search('10.99.0.0/23')
+        self.assertEqual([(hit['type'], hit['score'], ) for hit in hits], [
+            ('networkdevice', round(23 / 32, 3), ),
+            ('networkdevice', round(23 / 32, 3), ),
+            ('networkdevice', round(23 / 32, 3), ),
+            ('site', 0.5, ),
+        ])
+        self.assertEqual(self.hits('10.98.0.0/16'), [])
+
+    def test_matches_merged(self):
+        # both Hostnames of the device contain the query: one hit, with both matches
+        networkdevice = make_networkdevice(self.site, 5, interfaces=2)
+        hits = search('host5')
+        self.assertEqual(len(hits), 1)
+        self.assertEqual(hits[0]['id'], networkdevice.pk)
+        self.assertEqual(sorted(match['value'] for match in hits[0]['matches']), [
+            'host5-1.tst.lco.gtn',
+            'host5.tst.lco.gtn',
+        ])
+
+    def test_merged_hit_keeps_best_score(self):
+        # the device matches by IP Address (exact) and by information (weak)
+        networkdevice = self.networkdevices[0]
+        NetworkDevice.objects.filter(pk=networkdevice.pk).update(information='console at 10.99.0.2')
+        hits = search('10.99.0.2')
+
+        self.assertEqual([(hit['type'], hit['id'], ) for hit in hits], [
+            ('networkdevice', networkdevice.pk, ),
+            ('site', self.site.pk, ),
+        ])
+        self.assertEqual(hits[0]['score'], 1.0)
+        self.assertEqual({match['field'] for match in hits[0]['matches']}, {'ipaddress', 'information', })
+
+    def test_ranking(self):
+        # an exact Site code beats the substring matches on every Hostname in its domain
+        hits = search('tst')
+        self.assertEqual((hits[0]['type'], hits[0]['id'], hits[0]['score'], ), ('site', self.site.pk, 1.0, ))
+        self.assertTrue(all(hit['score'] < 1.0 for hit in hits[1:]))
+        self.assertEqual(len(hits), 1 + len(self.networkdevices))
+
+        scores = [hit['score'] for hit in hits]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+class IPAMTestCase(TestCase):
+    '''/api/site/<pk>/ipam/: free addresses, allocation holds and conflicts'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevice = make_networkdevice(self.site, 1)
+
+    def url(self, name):
+        return f'/api/site/{self.site.pk}/ipam/{name}/'
+
+    def next_free(self, count, start=None):
+        params = {'count': count, } if start is None else {'count': count, 'start': start, }
+        response = self.client.get(self.url('next-free'), params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['ipaddresses']
+
+    def allocate(self, count, start):
+        response = quietly(self.client.post, self.url('next-free'), {'count': count, 'start': start, }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['ipaddresses']
+
+    def test_next_free_skips_reserved(self):
+        # the network address, and the address used by the device
+        self.assertEqual(self.next_free(2), ['10.99.0.1', '10.99.0.3', ])
+        # the DNS server
+        self.assertEqual(self.next_free(2, '10.99.0.14'), ['10.99.0.14', '10.99.0.16', ])
+        # the gateway
+        self.assertEqual(self.next_free(2, '10.99.0.253'), ['10.99.0.253', '10.99.0.255', ])
+        # the DHCP dynamic range
+        self.assertEqual(self.next_free(3, '10.99.248.255'), ['10.99.248.255', '10.99.249.0', '10.99.249.100', ])
+
+    def test_allocation_is_held(self):
+        first = self.allocate(2, '10.99.0.10')
+        self.assertEqual(first, ['10.99.0.10', '10.99.0.11', ])
+        self.assertEqual(self.allocate(2, '10.99.0.10'), ['10.99.0.12', '10.99.0.13', ])
+        self.assertEqual(self.next_free(1, '10.99.0.10'), ['10.99.0.14', ])
+
+        reservation = IPReservation.objects.get(start='10.99.0.10')
+        self.assertEqual(reservation.end, '10.99.0.10')
+        self.assertIsNotNone(reservation.expires_at)
+
+    def test_held_addresses_expire(self):
+        self.allocate(2, '10.99.0.10')
+        IPReservation.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+
+        self.assertEqual(self.next_free(1, '10.99.0.10'), ['10.99.0.10', ])
+        self.assertEqual(self.allocate(1, '10.99.0.10'), ['10.99.0.10', ])
+        self.assertEqual(IPReservation.objects.count(), 1)
+
+    def test_too_few_free(self):
+        response = self.client.get(self.url('next-free'), {'count': 2, 'start': '10.99.255.254', })
+        self.assertEqual(response.status_code, 409)
+
+    def test_conflicts(self):
+        def set_ipaddress(networkdevice, ipaddress):
+            queryset = NetworkInterfaceConfiguration.objects.filter(networkinterface__networkdevice=networkdevice)
+            queryset.update(ipaddress=ipaddress)
+
+        duplicate = make_networkdevice(self.site, 2)
+        set_ipaddress(duplicate, '10.99.0.2')
+        dhcp = make_networkdevice(self.site, 3)
+        set_ipaddress(dhcp, '10.99.249.5')
+        reserved = make_networkdevice(self.site, 4)
+        IPReservation.objects.create(site=self.site, start='10.99.0.5', end='10.99.0.9', description='lab')
+        outside = make_networkdevice(self.site, 5)
+        set_ipaddress(outside, '10.98.0.5')
+        # a temporary hold on a used address is not a conflict
+        IPReservation.objects.create(site=self.site, start='10.99.0.6', end='10.99.0.6',
+                                     expires_at=timezone.now() + datetime.timedelta(minutes=5))
+
+        response = self.client.get(self.url('conflicts'))
+        self.assertEqual(response.status_code, 200)
+        conflicts = [(conflict['ipaddress'], conflict['reason'], conflict['networkdevices'], )
+                     for conflict in response.data['conflicts']]
+        self.assertEqual(sorted(conflicts), sorted([
+            ('10.99.0.2', 'used more than once', sorted([self.networkdevice.pk, duplicate.pk, ]), ),
+            ('10.99.0.5', 'reserved: lab', [reserved.pk, ], ),
+            ('10.99.249.5', 'reserved: DHCP dynamic range', [dhcp.pk, ], ),
+            ('10.98.0.5', 'outside of the Site network 10.99.0.0/16', [outside.pk, ], ),
+        ]))
+
+class CompressionTestCase(TestCase):
+    '''compress_response(): only responses which are worth it are compressed'''
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def compressed(self, path, response):
+        request = self.factory.get(path, HTTP_ACCEPT_ENCODING='gzip')
+        response = compress_response(request, response)
+        return response.get('Content-Encoding', None)
+
+    def test_size_threshold(self):
+        self.assertIsNone(self.compressed('/api/site/', HttpResponse('x' * (COMPRESSION_MIN_SIZE - 1))))
+
+        response = HttpResponse('x' * COMPRESSION_MIN_SIZE)
+        self.assertEqual(self.compressed('/api/site/', response), 'gzip')
+        self.assertEqual(gzip.decompress(response.content), b'x' * COMPRESSION_MIN_SIZE)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+
+    def test_excluded_paths(self):
+        for path in ('/tftp/pxelinux.cfg/default', '/ks/host1.tst.lco.gtn', '/kickstart/host1.tst.lco.gtn', ):
+            with self.subTest(path):
+                self.assertIsNone(self.compressed(path, HttpResponse('x' * 4096)))
+
+    def test_content_types(self):
+        self.assertIsNone(self.compressed('/api/site/', HttpResponse(b'x' * 4096, content_type='image/png')))
+        self.assertEqual(self.compressed('/api/site/', HttpResponse('{}' * 4096, content_type='application/json')),
+                         'gzip')
+
+    def test_streaming_skipped(self):
+        response = StreamingHttpResponse(iter(['x' * 4096, ]), content_type='application/x-ndjson')
+        self.assertIsNone(self.compressed('/api/networkdevice/alive/', response))
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 4096)
+
+    def test_not_accepted(self):
+        request = self.factory.get('/api/site/')
+        response = compress_response(request, HttpResponse('x' * 4096))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+class PrecompressedTestCase(TestCase):
+    '''The Site configuration files: cached per content version, with the version as the ETag'''
+
+    def setUp(self):
+        precompressed_clear()
+        self.addCleanup(precompressed_clear)
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevices = [make_networkdevice(self.site, index) for index in range(1, 51)]
+        self.url = f'/api/site/{self.site.pk}/dnsconf/hosts/'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', **headers)
+        self.assertIn(response.status_code, (200, 304, ))
+        return response
+
+    def test_compressed_once(self):
+        response = self.get()
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'host1.tst.lco.gtn', gzip.decompress(response.content))
+
+        # the cached variant is served again, without rendering
+        with mock.patch('machineconfig.viewsets.SiteViewSet.render_dnsconf_hosts') as render:
+            again = self.get()
+
+        render.assert_not_called()
+        self.assertEqual(again.content, response.content)
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # the middleware may have sent a weak ETag for the same content
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=f'W/{etag}').status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_etag_follows_devices(self):
+        etags = [self.get()['ETag'], ]
+
+        Hostname.objects.filter(hostname='host1.tst.lco.gtn').update(hostname='renamed1.tst.lco.gtn')
+        response = self.get(HTTP_IF_NONE_MATCH=etags[-1])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'renamed1.tst.lco.gtn', gzip.decompress(response.content))
+        etags.append(response['ETag'])
+
+        queryset = NetworkInterfaceConfiguration.objects.filter(ipaddress='10.99.0.3')
+        queryset.update(ipaddress='10.99.5.3')
+        response = self.get(HTTP_IF_NONE_MATCH=etags[-1])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'10.99.5.3', gzip.decompress(response.content))
+        etags.append(response['ETag'])
+
+        self.assertEqual(len(set(etags)), 3)
+
+class ChangeLogTestCase(TransactionTestCase):
+    '''
+    GET /api/changes/?since=: the ChangeLog triggers only assign versions when the
+    transaction commits, so these tests run outside of a test transaction
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.site = make_site()
+        self.networkdevice = make_networkdevice(self.site, 1)
+
+    def changes(self, since, **params):
+        response = self.client.get('/api/changes/', dict(params, since=since))
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def latest(self):
+        return self.changes(0)['version']
+
+    def changed(self, since):
+        return {(change['type'], change['id'], ): change for change in self.changes(since)['changes']}
+
+    def test_create(self):
+        data = self.changes(0)
+        self.assertFalse(data['more'])
+        changes = {(change['type'], change['id'], ): change for change in data['changes']}
+        self.assertEqual(set(changes.keys()), {('site', self.site.pk, ), ('networkdevice', self.networkdevice.pk, ), })
+
+        change = changes[('networkdevice', self.networkdevice.pk, )]
+        self.assertFalse(change['deleted'])
+        self.assertEqual(change['data']['id'], self.networkdevice.pk)
+        self.assertEqual(change['data']['information'], 'device 1')
+        self.assertEqual(data['version'], max(change['version'] for change in data['changes']))
+
+    def test_update(self):
+        version = self.latest()
+        self.assertEqual(self.changes(version)['changes'], [])
+
+        NetworkDevice.objects.filter(pk=self.networkdevice.pk).update(information='updated')
+        changes = self.changed(version)
+        self.assertEqual(set(changes.keys()), {('networkdevice', self.networkdevice.pk, ), })
+        self.assertEqual(changes[('networkdevice', self.networkdevice.pk, )]['data']['information'], 'updated')
+
+        # a change to a nested object is a change to its NetworkDevice
+        version = self.latest()
+        Hostname.objects.filter(hostname='host1.tst.lco.gtn').update(hostname='renamed1.tst.lco.gtn')
+        self.assertEqual(set(self.changed(version).keys()), {('networkdevice', self.networkdevice.pk, ), })
+
+    def test_delete_tombstone(self):
+        version = self.latest()
+        pk = self.networkdevice.pk
+        quietly(self.client.delete, f'/api/networkdevice/{pk}/')
+
+        changes = self.changed(version)
+        change = changes[('networkdevice', pk, )]
+        self.assertTrue(change['deleted'])
+        self.assertIsNone(change['data'])
+        # the Site is touched too (its device count changed)
+        self.assertFalse(changes[('site', self.site.pk, )]['deleted'])
+
+    def test_paging(self):
+        start = self.latest()
+        networkdevices = [make_networkdevice(self.site, index) for index in range(2, 7)]
+
+        pages = []
+        since = start
+        while True:
+            data = self.changes(since, limit=2)
+            pages.append(data['changes'])
+            since = data['version']
+            if not data['more']:
+                break
+
+        changes = [change for page in pages for change in page]
+        self.assertEqual([len(page) for page in pages[:-1]], [2, ] * (len(pages) - 1))
+        versions = [change['version'] for change in changes]
+        self.assertEqual(versions, sorted(versions))
+        self.assertGreater(versions[0], start)
+        self.assertEqual(since, self.latest())
+
+        pks = [change['id'] for change in changes if change['type'] == 'networkdevice']
+        self.assertEqual(sorted(pks), sorted(networkdevice.pk for networkdevice in networkdevices))
+        self.assertEqual(len([change for change in changes if change['type'] == 'site']), 1)
+
+    def test_unknown_since(self):
+        latest = self.latest()
+        for since in (latest + 1, -1, ):
+            with self.subTest(since):
+                response = self.client.get('/api/changes/', {'since': since, })
+                self.assertEqual(response.status_code, 410)
+
+        response = self.client.get('/api/changes/', {'since': 'abc', })
+        self.assertEqual(response.status_code, 400)
@@ -28,6 +28,14 @@ def request_client_ipaddress(request):
 
     return ipaddress
 
+def request_identity(request):
+    '''Identify who made a request: the username if logged in, otherwise the client IP address'''
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.get_username()
+
+    return request_client_ipaddress(request) or ''
+
 def request_is_internal(request):
     '''
     Return True if the request is internal (made by the web client).
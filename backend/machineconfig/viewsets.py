@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
 from django.db import transaction
+from django.db.models import BooleanField
+from django.db.models import ExpressionWrapper
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import TextField
+from django.db.models import Value
+from django.db.models.functions import Cast
+from django.db.models.functions import Concat
+from django.db.models.functions import MD5
 from django.db.utils import IntegrityError
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
 
 from rest_framework.decorators import action
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 from rest_framework import permissions
 from rest_framework import viewsets
@@ -14,7 +29,43 @@ from rest_framework import status
 from rest_flex_fields import FlexFieldsModelViewSet
 from django_filters import rest_framework as filters
 
+from machineconfig.views import request_identity
 from machineconfig.views import request_is_internal
+from machineconfig.api_views import parse_boolean
+from machineconfig.api_views import parse_output_range
+
+from machineconfig.bulk import BULK_MAX_ITEMS
+from machineconfig.changes import CHANGES_DEFAULT_LIMIT
+from machineconfig.changes import CHANGES_MAX_LIMIT
+from machineconfig.changes import changes_since
+from machineconfig.changes import latest_version
+from machineconfig.bulk import bulk_upsert_networkdevices
+from machineconfig.bulk import parse_ndjson
+from machineconfig.jobs import read_job_output
+from machineconfig.jobs import create_remote_job
+from machineconfig.jobs import json_default
+from machineconfig.jobs import stream_command_output
+from machineconfig.jobs import stream_job_output
+from machineconfig.jobs import streaming_ndjson_response
+from machineconfig.compression import precompressed_response
+
+from machineconfig.ipam import IPAM_MAX_COUNT
+from machineconfig.ipam import AddressSpace
+from machineconfig.ipam import allocate_addresses
+from machineconfig.ipam import dhcp_range
+from machineconfig.ipmi import IPMI_OPERATIONS
+from machineconfig.ipmi import invalidate_ipmi_status
+from machineconfig.ipmi import ipmi_target
+from machineconfig.ipmi import ipmitool
+from machineconfig.ipmi import refresh_ipmi_status
+from machineconfig.puppet import run_puppet_agent_test
+from machineconfig.puppet import puppet_batch_timeout
+from machineconfig.puppet import run_puppet_batch
+from machineconfig.resolver import RESOLVE_DEADLINE
+from machineconfig.resolver import check_dns_records
+from machineconfig.rollups import STATS_BUCKETS
+from machineconfig.rollups import rollup_stats
+from machineconfig.resolver import default_nameserver
 
 from machineconfig.models import Site
 from machineconfig.models import NetworkDevice
@@ -22,20 +73,43 @@ from machineconfig.models import PuppetMachine
 from machineconfig.models import UnrecognizedPXEDevice
 from machineconfig.models import BootHistory
 from machineconfig.models import BuildHistory
+from machineconfig.models import IPMIStatus
+from machineconfig.models import RemoteJob
+from machineconfig.models import IPReservation
+from machineconfig.models import ChangeLog
 
 from machineconfig.serializers import SiteSerializer
 from machineconfig.serializers import NetworkDeviceSerializer
 from machineconfig.serializers import UnrecognizedPXEDeviceSerializer
 from machineconfig.serializers import BootHistorySerializer
 from machineconfig.serializers import BuildHistorySerializer
+from machineconfig.serializers import IPMIStatusSerializer
+from machineconfig.serializers import RemoteJobSerializer
+from machineconfig.serializers import IPReservationSerializer
 
 import django_rq
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import as_completed
 from contextlib import ContextDecorator
 import subprocess
 import ipaddress
 import datetime
 import socket
+import json
+import time
+
+# Maximum number of "ipmitool" processes run in parallel by a single bulk IPMI request
+IPMI_MAX_WORKERS = 16
+
+# Maximum time range (in days) of a single history statistics request, per bucket size
+HISTORY_STATS_MAX_DAYS = {
+    'hour': 93,
+    'day': 3660,
+    'week': 3660,
+    'month': 3660,
+}
 
 class mycontext(ContextDecorator):
     def __init__(self, message):
@@ -60,40 +134,114 @@ def make_simple_error(message):
 
 def run_ipmitool(networkdevice, command, timeout=15):
     '''
-    Run the /usr/bin/ipmitool utility, with the given command. Return a Django
-    REST Framework Response object. Example:
+    Run the ipmitool utility, with the given command. Return a Django REST
+    Framework Response object. Example:
 
-    run_ipmitool_command(networkdevice, command=['chassis', 'status'])
+    run_ipmitool(networkdevice, command=['chassis', 'status'])
     '''
-    puppetmachine = networkdevice.puppetmachine
-    site = networkdevice.site
-
-    username = 'ADMIN'
-    password = f'{site.code.lower()}cana1'
-    hostname = puppetmachine.get_fact_value('ipmi_ipaddress')
+    (hostname, username, password) = ipmi_target(networkdevice)
 
     if hostname is None:
-        data = make_simple_error(f'No Puppet Fact ipmi_ipaddress available for NetworkDevice pk={networkdevice.pk}')
+        data = make_simple_error(f'No BMC IP Address known for NetworkDevice pk={networkdevice.pk}')
         return Response(data, status=status.HTTP_404_NOT_FOUND)
 
-    cmd = [
-        '/usr/bin/ipmitool',
-        '-U',
-        str(username),
-        '-P',
-        str(password),
-        '-H',
-        str(hostname),
-    ] + command
-
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
-    data = {
-        #'command': cmd,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
-    }
+    data = ipmitool(hostname, username, password, command=command, timeout=timeout)
+    return Response(data, status=status.HTTP_200_OK)
+
+def ipmi_status_response(request, networkdevice, power_only=False):
+    '''
+    Return the cached IPMI chassis status of a NetworkDevice as a Django REST
+    Framework Response object. The BMC is only queried when there is no cached
+    status yet, or when the client asks for it with ?refresh=true.
+
+    The response has the same shape as run_ipmitool() (the ipmitool output and
+    returncode), plus the parsed status fields. With power_only, the output is that
+    of "ipmitool power status" (for example: "Chassis Power is on").
+    '''
+    try:
+        refresh = request.GET.get('refresh', 'false')
+        refresh = parse_boolean(refresh)
+    except ValueError as ex:
+        data = make_simple_error(f'unable to parse "refresh={refresh}" as boolean (true/false)')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        puppetmachine = networkdevice.puppetmachine
+    except PuppetMachine.DoesNotExist as ex:
+        data = make_simple_error(f'NetworkDevice(pk={networkdevice.pk}) is not Puppet managed')
+        return Response(data, status=status.HTTP_404_NOT_FOUND)
+
+    if puppetmachine.ipmi_ipaddress is None:
+        data = make_simple_error(f'No BMC IP Address known for NetworkDevice pk={networkdevice.pk}')
+        return Response(data, status=status.HTTP_404_NOT_FOUND)
+
+    cached = True
+    try:
+        ipmistatus = puppetmachine.ipmistatus
+    except IPMIStatus.DoesNotExist as ex:
+        ipmistatus = None
+
+    if refresh or ipmistatus is None:
+        cached = False
+        ipmistatus = refresh_ipmi_status([networkdevice, ])[networkdevice.pk]
+
+    data = IPMIStatusSerializer(ipmistatus).data
+    data['cached'] = cached
+    if power_only and ipmistatus.power_on is not None:
+        data['stdout'] = 'Chassis Power is {}\n'.format('on' if ipmistatus.power_on else 'off')
+
     return Response(data, status=status.HTTP_200_OK)
 
+def run_ipmitool_staggered(start_at, networkdevice, command, timeout=15):
+    '''
+    Wait until start_at (a time.monotonic() value) and then run ipmitool against a
+    NetworkDevice. Used to spread out bulk power on requests, to avoid the inrush
+    current of every machine at a site starting up at the same instant.
+    '''
+    (hostname, username, password) = ipmi_target(networkdevice)
+    if hostname is None:
+        raise ValueError(f'No BMC IP Address known for NetworkDevice pk={networkdevice.pk}')
+
+    delay = start_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+    data = ipmitool(hostname, username, password, command=command, timeout=timeout)
+    data['bmc'] = hostname
+    return data
+
+def networkdevice_ping_target(networkdevice):
+    '''Return the static IP address (preferred) or hostname to ping for a NetworkDevice, or None'''
+    target = networkdevice.primary_staticip
+    if target is None:
+        target = networkdevice.primary_hostname
+
+    return target
+
+def ping_alive(target, deadline=10):
+    '''
+    Run a simple fixed "ping" and return True if the target answered. The /bin/ping
+    program exits after the deadline (in seconds), and we add a hard deadline of five
+    more seconds on top of that, just in case something else goes wrong.
+    '''
+    cmd = [
+        '/bin/ping',
+        '-n',
+        '-w',
+        str(deadline),
+        '-i',
+        '0.2',
+        '-c',
+        '3',
+        '-l',
+        '3',
+        str(target),
+    ]
+
+    timeout = (deadline + 5)
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, check=False)
+    return proc.returncode == 0
+
 def format_columnar_data(data):
     output = []
     widths = [max(map(len, col)) for col in zip(*data)]
@@ -102,34 +250,39 @@ def format_columnar_data(data):
 
     return output
 
-def run_puppet_agent_test(networkdevice_id, timeout=3600):
-    print(f'run_puppet_agent_test: networkdevice_id={networkdevice_id}')
-    networkdevice = NetworkDevice.objects.get(pk=networkdevice_id)
-    puppet_command = '/usr/bin/sudo /opt/puppetlabs/bin/puppet agent --test'
-    env = {
-        'LANG': 'C',
-        'LC_ALL': 'C',
-    }
-    cmd = [
-        '/usr/bin/ssh',
-        '-x',
-        '-4',
-        '-o',
-        'StrictHostKeyChecking=no',
-        '-t',
-        '-t',
-        '-i',
-        '/app/ssh/id_rsa',
-        f'eng@{networkdevice.primary_hostname}',
-        puppet_command,
-    ]
-    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
-    data = {
-        'command': puppet_command,
-        'stdout': proc.stdout,
-        'returncode': proc.returncode,
-    }
-    return data
+# The NetworkDevice fields (and NetworkInterface tree fields) which the generated DNS/DHCP configuration depends on
+SITE_CONFIG_FINGERPRINT_FIELDS = (
+    'pk',
+    'updated_at',
+    'networkinterface__pk',
+    'networkinterface__mac',
+    'networkinterface__networkinterfaceconfiguration__pk',
+    'networkinterface__networkinterfaceconfiguration__ipaddress',
+    'networkinterface__networkinterfaceconfiguration__hostname__pk',
+    'networkinterface__networkinterfaceconfiguration__hostname__hostname',
+)
+
+def site_config_version(site):
+    '''
+    The version of the configuration files generated for a Site (DNS, DHCP), which
+    changes whenever their content would: the Site's last update, plus a fingerprint
+    of all of its NetworkDevices and their NetworkInterface trees, computed by the
+    database in one query. The current date is included, because the DNS Serial
+    Number depends on it (see Site.dns_serialno).
+    '''
+    values = []
+    for field in SITE_CONFIG_FINGERPRINT_FIELDS:
+        values.extend([Cast(field, output_field=TextField()), Value('/'), ])
+
+    fingerprint = StringAgg(
+        Concat(*values, output_field=TextField()),
+        delimiter=',',
+        ordering=[field for field in SITE_CONFIG_FINGERPRINT_FIELDS if field.endswith('pk')],
+    )
+
+    queryset = NetworkDevice.objects.filter(site=site)
+    aggregate = queryset.aggregate(fingerprint=MD5(fingerprint))
+    return (site.updated_at.isoformat(), aggregate['fingerprint'], datetime.datetime.utcnow().date().isoformat(), )
 
 # ViewSets define the view behavior.
 class SiteViewSet(FlexFieldsModelViewSet):
@@ -182,16 +335,30 @@ class SiteViewSet(FlexFieldsModelViewSet):
         print(f'SiteViewSet::perform_destroy: DELETE')
         return super().perform_destroy(instance=instance)
 
+    def site_config_response(self, request, pk, name, render):
+        '''
+        Serve a generated configuration file from the precompressed cache, so that
+        repeated downloads of an unchanged file cost neither rendering (with its
+        queries of the whole Site) nor compression
+        '''
+        site = get_object_or_404(Site, pk=pk)
+        self.check_object_permissions(request, site)
+        return precompressed_response(request, (name, site.pk), site_config_version(site), lambda: render(request))
+
     @action(detail=True, methods=['get', ])
     def dhcpconf(self, request, pk=None):
+        '''DHCP Configuration in ISC dhcpd format'''
+        return self.site_config_response(request, pk, 'dhcpconf', self.render_dhcpconf)
+
+    def render_dhcpconf(self, request):
         site = self.get_object()
         sitenetwork = ipaddress.ip_network(f'{site.networkip}/{site.networkcidr}')
         dhcprange = None
-        if str(sitenetwork.network_address).startswith('10.'):
-            parts = str(sitenetwork.network_address).split('.')
+        if dhcp_range(site) is not None:
+            (start, end) = dhcp_range(site)
             dhcprange = {
-                'start': f'{parts[0]}.{parts[1]}.249.1',
-                'end': f'{parts[0]}.{parts[1]}.249.99',
+                'start': str(start),
+                'end': str(end),
             }
 
         d = {
@@ -202,9 +369,88 @@ class SiteViewSet(FlexFieldsModelViewSet):
         }
         return render(request, 'dhcpconf.jinja', d, content_type='text/plain')
 
+    @action(detail=True, methods=['get', 'post', ], url_path='ipam/next-free')
+    def ipam_next_free(self, request, pk=None):
+        '''
+        The next free (not used, not reserved) IP Addresses of the Site network.
+
+        GET only looks: /api/site/<pk>/ipam/next-free/?count=4&start=10.5.10.0
+        POST allocates them, holding each with a temporary IPReservation so that
+        concurrent requests never get the same address: {"count": 4, "description": "..."}
+        '''
+        site = get_object_or_404(Site, pk=pk)
+        params = request.GET if request.method == 'GET' else request.data
+        if not isinstance(params, dict):
+            data = make_simple_error('The POST data must be a JSON object')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            count = clamp(int(params.get('count', 1)), 1, IPAM_MAX_COUNT)
+        except (TypeError, ValueError) as ex:
+            data = make_simple_error(f'unable to parse count="{params.get("count")}" as an integer')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        start = params.get('start', None)
+        try:
+            start = ipaddress.ip_address(start) if start is not None else None
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse start="{start}" as an IP Address')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        expires_at = None
+        if request.method == 'GET':
+            addresses = AddressSpace(site).next_free(count=count, start=start)
+        else:
+            description = str(params.get('description', ''))[:256]
+            (addresses, expires_at) = allocate_addresses(site, count=count, description=description, start=start)
+
+        if len(addresses) < count:
+            data = make_simple_error(f'Site network has {len(addresses)} free IP Addresses, {count} requested')
+            return Response(data, status=status.HTTP_409_CONFLICT)
+
+        data = {
+            'site': site.code,
+            'ipaddresses': [str(address) for address in addresses],
+            'expires_at': expires_at,
+        }
+        return Response(data, status=status.HTTP_201_CREATED if request.method == 'POST' else status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get', ], url_path='ipam/free-ranges')
+    def ipam_free_ranges(self, request, pk=None):
+        '''The ranges of free IP Addresses of the Site network (optionally: ?min_size=16)'''
+        site = get_object_or_404(Site, pk=pk)
+
+        try:
+            min_size = max(int(request.GET.get('min_size', 1)), 1)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse min_size="{request.GET.get("min_size")}" as an integer')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        space = AddressSpace(site)
+        data = space.summary()
+        data['site'] = site.code
+        data['ranges'] = space.free_ranges(min_size=min_size)
+        return Response(data)
+
+    @action(detail=True, methods=['get', ], url_path='ipam/conflicts')
+    def ipam_conflicts(self, request, pk=None):
+        '''
+        IP Addresses used more than once, used within a reserved range (such as the
+        DHCP dynamic range), or assigned to this Site's devices outside of its network
+        '''
+        site = get_object_or_404(Site, pk=pk)
+        space = AddressSpace(site)
+        data = space.summary()
+        data['site'] = site.code
+        data['conflicts'] = space.conflicts()
+        return Response(data)
+
     @action(detail=True, methods=['get', ], url_path='dnsconf/forward')
     def dnsconf_forward(self, request, pk=None):
         '''DNS Configuration in BIND "forward" format'''
+        return self.site_config_response(request, pk, 'dnsconf_forward', self.render_dnsconf_forward)
+
+    def render_dnsconf_forward(self, request):
         site = self.get_object()
 
         # Munge DNS records to get them into the format we need for the
@@ -250,6 +496,9 @@ class SiteViewSet(FlexFieldsModelViewSet):
     @action(detail=True, methods=['get', ], url_path='dnsconf/reverse')
     def dnsconf_reverse(self, request, pk=None):
         '''DNS Configuration in BIND "reverse" format'''
+        return self.site_config_response(request, pk, 'dnsconf_reverse', self.render_dnsconf_reverse)
+
+    def render_dnsconf_reverse(self, request):
         site = self.get_object()
         dnsrecords = [record for record in site.drf_dnsrecords if record['record_type'] in ('PTR', )]
         d = {
@@ -292,6 +541,9 @@ class SiteViewSet(FlexFieldsModelViewSet):
     @action(detail=True, methods=['get', ], url_path='dnsconf/hosts')
     def dnsconf_hosts(self, request, pk=None):
         '''DNS configuration in /etc/hosts format (for CoreDNS)'''
+        return self.site_config_response(request, pk, 'dnsconf_hosts', self.render_dnsconf_hosts)
+
+    def render_dnsconf_hosts(self, request):
         site = self.get_object()
         dnsrecords = []
 
@@ -320,6 +572,157 @@ class SiteViewSet(FlexFieldsModelViewSet):
         }
         return render(request, 'dnsconf_hosts.jinja', d, content_type='text/plain')
 
+    @action(detail=True, methods=['get', ], url_path='dnscheck')
+    def dnscheck(self, request, pk=None):
+        '''
+        Compare the DNS records generated for this Site against what a live
+        nameserver actually returns, and report the missing/mismatched records.
+
+        Parameters:
+        nameserver - the nameserver to check (default: the first Site DNS server)
+        concurrency - maximum number of DNS queries in flight at once (default: 64)
+        verbose - also include the records which are correct (default: false)
+        '''
+        site = self.get_object()
+
+        nameserver = request.GET.get('nameserver', None)
+        if nameserver is None:
+            nameserver = site.dnsservers[0] if len(site.dnsservers) > 0 else default_nameserver()
+
+        try:
+            ipaddress.ip_address(nameserver)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse nameserver="{nameserver}" as an IP Address')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            concurrency = int(request.GET.get('concurrency', 64))
+            concurrency = clamp(concurrency, 1, 256)
+        except ValueError as ex:
+            data = make_simple_error(f'''unable to parse concurrency="{request.GET.get('concurrency', '')}" as integer''')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            verbose = request.GET.get('verbose', 'false')
+            verbose = parse_boolean(verbose)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse "verbose={verbose}" as boolean (true/false)')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        data = check_dns_records(site.drf_dnsrecords, nameserver=nameserver, concurrency=concurrency,
+                                 deadline=RESOLVE_DEADLINE)
+        if not verbose:
+            data['records'] = [record for record in data['records'] if record['status'] != 'ok']
+
+        return Response(data)
+
+    @action(detail=True, methods=['post', ], url_path='ipmi')
+    def ipmi(self, request, pk=None):
+        '''
+        Run the same IPMI operation against many NetworkDevices at this Site at once.
+
+        POST data parameters:
+        operation - one of: chassis_status, power_status, power_on, power_off (required)
+        ids - list of NetworkDevice primary keys (default: all devices with a known BMC IP Address)
+        timeout - timeout for each BMC, in seconds (default: 15)
+        stagger - delay between starting each power on, in seconds (default: settings.IPMI_POWER_ON_STAGGER)
+
+        The operations run in parallel on a bounded pool of workers, and the results
+        are streamed back to the client as newline-delimited JSON (one object per device)
+        in the order they complete.
+        '''
+        site = self.get_object()
+
+        if not isinstance(request.data, dict):
+            data = make_simple_error('The POST data must be a JSON object')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        operation = request.data.get('operation', None)
+        if operation not in IPMI_OPERATIONS:
+            data = make_simple_error(f'The "operation" POST data parameter is required (choose from: {",".join(IPMI_OPERATIONS)})')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            timeout = int(request.data.get('timeout', 15))
+            timeout = clamp(timeout, 5, 60)
+        except (TypeError, ValueError) as ex:
+            data = make_simple_error(f'''unable to parse timeout="{request.data.get('timeout', '')}" as integer''')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        # only power on is staggered, everything else starts as fast as the pool allows
+        default_stagger = settings.IPMI_POWER_ON_STAGGER if operation == 'power_on' else 0
+        try:
+            stagger = float(request.data.get('stagger', default_stagger))
+            stagger = clamp(stagger, 0, 30)
+        except (TypeError, ValueError) as ex:
+            data = make_simple_error(f'''unable to parse stagger="{request.data.get('stagger', '')}" as number''')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        # select the devices (and their BMC IP Addresses) with a single query
+        queryset = NetworkDevice.objects.filter(site=site)
+        queryset = queryset.select_related('site', 'puppetmachine')
+
+        ids = request.data.get('ids', None)
+        if ids is not None:
+            try:
+                if not isinstance(ids, (list, tuple, )):
+                    raise TypeError('not a list')
+
+                ids = [int(pk) for pk in ids]
+            except (TypeError, ValueError) as ex:
+                data = make_simple_error(f'The "ids" POST data parameter must be a list of integers')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            queryset = queryset.filter(pk__in=ids)
+        else:
+            # default: every device at this Site with a known BMC IP Address
+            queryset = queryset.filter(puppetmachine__ipmi_ipaddress__isnull=False)
+
+        networkdevices = list(queryset.order_by('pk'))
+
+        command = IPMI_OPERATIONS[operation]
+
+        def results():
+            executor = ThreadPoolExecutor(max_workers=clamp(len(networkdevices), 1, IPMI_MAX_WORKERS))
+            futures = {}
+
+            try:
+                start_at = time.monotonic()
+                for networkdevice in networkdevices:
+                    future = executor.submit(run_ipmitool_staggered, start_at, networkdevice, command=command,
+                                             timeout=timeout)
+                    futures[future] = networkdevice.pk
+                    start_at += stagger
+
+                for future in as_completed(futures):
+                    data = {
+                        'id': futures[future],
+                        'operation': operation,
+                    }
+
+                    try:
+                        data.update(future.result())
+                    except subprocess.TimeoutExpired as ex:
+                        data['returncode'] = None
+                        data['error'] = f'BMC did not answer within {timeout} seconds'
+                    except Exception as ex:
+                        data['returncode'] = None
+                        data['error'] = str(ex)
+
+                    # the cached chassis status is now out of date
+                    if operation in ('power_on', 'power_off', ):
+                        invalidate_ipmi_status([futures[future], ])
+
+                    yield json.dumps(data, default=json_default) + '\n'
+            finally:
+                # the client went away: do not start any operations which are still queued
+                for future in futures:
+                    future.cancel()
+
+                executor.shutdown(wait=False)
+
+        return streaming_ndjson_response(results())
+
 class NetworkDeviceFilterSet(filters.FilterSet):
     # Filter for "Is a webcam?" as well as various webcam flags
     webcam = filters.BooleanFilter(field_name='webcam', lookup_expr='isnull', exclude=True)
@@ -329,19 +732,73 @@ class NetworkDeviceFilterSet(filters.FilterSet):
     # Filter by Site code
     site = filters.CharFilter(field_name='site__code', lookup_expr='iexact')
 
+    # Sort by the denormalized primary MAC Address, IP Address or Hostname (for example:
+    # ?ordering=primary_hostname), or by creation/modification time
+    ordering = filters.OrderingFilter(fields=(
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+        ('primary_mac', 'primary_mac'),
+        ('primary_staticip', 'primary_staticip'),
+        ('primary_hostname', 'primary_hostname'),
+    ))
+
     class Meta:
         model = NetworkDevice
         fields = {
+            'primary_mac': [ 'iexact', 'istartswith', ],
+            'primary_staticip': [ 'exact', ],
+            'primary_hostname': [ 'exact', 'iexact', 'istartswith', 'icontains', ],
         }
 
+def requested_fields(request, fields):
+    '''
+    The top-level fields which a FlexFieldsModelSerializer response will include,
+    given the sparse fieldset (?fields=id,site) and omit (?omit=dnsrecords) query
+    parameters. Nested names ("networkinterface_set.mac") need their parent field.
+    '''
+    def values(name):
+        result = []
+        for value in request.query_params.getlist(name) + request.query_params.getlist(f'{name}[]'):
+            result.extend(value.split(','))
+
+        return result
+
+    sparse = set(value.split('.')[0] for value in values('fields'))
+    omit = set(value for value in values('omit') if '.' not in value)
+    return set(field for field in fields if (len(sparse) <= 0 or field in sparse) and field not in omit)
+
+# The related objects which each NetworkDevice API field reads
+NETWORKDEVICE_SELECT_RELATED = {
+    'site': ('site', ),
+    'puppetmachine': ('puppetmachine', ),
+    'webcam': ('webcam', ),
+}
+NETWORKDEVICE_PREFETCH_RELATED = {
+    field: (
+        'networkinterface_set',
+        'networkinterface_set__networkinterfaceconfiguration_set',
+        'networkinterface_set__networkinterfaceconfiguration_set__hostname_set',
+    ) for field in ('networkinterface_set', 'dnsrecords', 'dhcprecords', )
+}
+
+# The flat NetworkDevice summary rows, see NetworkDeviceViewSet.summary()
+NETWORKDEVICE_SUMMARY_FIELDS = (
+    'id',
+    'updated_at',
+    'primary_hostname',
+    'primary_staticip',
+    'primary_mac',
+)
+NETWORKDEVICE_SUMMARY_EXPRESSIONS = {
+    'site_code': F('site__code'),
+    'operatingsystem': F('puppetmachine__operatingsystem'),
+    'boot_mode': F('puppetmachine__boot_mode'),
+    'is_webcam': ExpressionWrapper(Q(webcam__isnull=False), output_field=BooleanField()),
+}
+
 # ViewSets define the view behavior.
 class NetworkDeviceViewSet(FlexFieldsModelViewSet):
     queryset = NetworkDevice.objects.all()
-    queryset = queryset.select_related('site')
-    queryset = queryset.select_related('puppetmachine')
-    queryset = queryset.prefetch_related('networkinterface_set')
-    queryset = queryset.prefetch_related('networkinterface_set__networkinterfaceconfiguration_set')
-    queryset = queryset.prefetch_related('networkinterface_set__networkinterfaceconfiguration_set__hostname_set')
     serializer_class = NetworkDeviceSerializer
     permit_list_expands = [
         'site',
@@ -354,6 +811,54 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
     )
     filter_class = NetworkDeviceFilterSet
 
+    def get_queryset(self):
+        '''
+        Only join and prefetch the related objects which the response needs. The
+        FlexFieldsModelSerializer drops the fields which are excluded by a sparse
+        fieldset (?fields=id,primary_hostname,site) or omitted (?omit=dnsrecords)
+        before serializing anything, so the queries behind them are skipped too.
+        '''
+        queryset = super().get_queryset()
+        if self.action == 'summary':
+            return queryset.order_by('pk')
+
+        fields = set(NetworkDeviceSerializer.Meta.fields)
+        if self.request.method == 'GET' and self.action in ('list', 'retrieve', ):
+            fields = requested_fields(self.request, fields)
+
+        # NOTE: select_related() without arguments would follow every foreign key
+        select_related = set()
+        prefetch_related = set()
+        for field in fields:
+            select_related.update(NETWORKDEVICE_SELECT_RELATED.get(field, ()))
+            prefetch_related.update(NETWORKDEVICE_PREFETCH_RELATED.get(field, ()))
+
+        if len(select_related) > 0:
+            queryset = queryset.select_related(*sorted(select_related))
+
+        if len(prefetch_related) > 0:
+            queryset = queryset.prefetch_related(*sorted(prefetch_related))
+
+        return queryset
+
+    @action(detail=False, methods=['get', ])
+    def summary(self, request):
+        '''
+        A lightweight listing for device tables: one flat row per NetworkDevice
+        (id, Site code, primary Hostname / IP Address / MAC Address, operating system,
+        boot mode, and whether it is a webcam), read with a single .values() query
+        rather than through model instances and nested serializers. The filters,
+        ordering and pagination are the same as for the full list.
+        '''
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.values(*NETWORKDEVICE_SUMMARY_FIELDS, **NETWORKDEVICE_SUMMARY_EXPRESSIONS)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(list(page))
+
+        return Response(list(queryset))
+
     # This is the main entrypoint into the API once we have valid data.
     # Wrap this operation in an atomic database transaction, so that any
     # failures in database operations (CREATE/UPDATE) on nested objects will
@@ -405,38 +910,158 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
         networkdevice = self.get_object()
 
         # fetch hostname / ip address from database record
-        target = networkdevice.primary_staticip
-        if target is None:
-            target = networkdevice.primary_hostname
+        target = networkdevice_ping_target(networkdevice)
 
         # whoops, the record is missing the sub-objects? What is going on?
         if target is None:
             data = make_simple_error(f'No IP Address or Hostname for NetworkDevice pk={networkdevice.pk}')
             return Response(data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # fixed ping command to check for aliveness
-        cmd = [
-            '/bin/ping',
-            '-n',
-            '-w',
-            '10',
-            '-i',
-            '0.2',
-            '-c',
-            '3',
-            '-l',
-            '3',
-            str(target),
-        ]
-
-        # Run the command, capturing all output into a single stream. Hard deadline of 15 seconds.
-        timeout = 15
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
+        # fixed ping command to check for aliveness, hard deadline of 15 seconds
         data = {
-            'alive': proc.returncode == 0,
+            'alive': ping_alive(target, deadline=10),
         }
         return Response(data=data)
 
+    @action(detail=False, methods=['post', ], url_path='bulk', url_name='bulk')
+    def bulk(self, request):
+        '''
+        Create and/or update many NetworkDevices at once (for example, when onboarding
+        a new Site). The request body is either a JSON list of NetworkDevice objects, or
+        newline-delimited JSON (Content-Type: application/x-ndjson) with one object per
+        line. Objects with an "id" update that NetworkDevice; all others are created.
+
+        Every item is validated before anything is written, and then all of them are
+        written in a single transaction: either every item succeeds, or nothing changes.
+        The response has one result per item, with its errors (if any).
+
+        Parameters:
+        dry_run - only validate the items, do not write anything (default: false)
+        '''
+        try:
+            dry_run = request.GET.get('dry_run', 'false')
+            dry_run = parse_boolean(dry_run)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse "dry_run={dry_run}" as boolean (true/false)')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.content_type.split(';')[0].strip() in ('application/x-ndjson', 'application/ndjson', ):
+            items = parse_ndjson(request.body)
+        else:
+            items = request.data
+
+        if not isinstance(items, list):
+            data = make_simple_error('The request body must be a list of NetworkDevice objects')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(items) > BULK_MAX_ITEMS:
+            data = make_simple_error(f'Too many items: {len(items)} (maximum: {BULK_MAX_ITEMS})')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        data = bulk_upsert_networkdevices(items, context=self.get_serializer_context(), dry_run=dry_run)
+        if not data['ok']:
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data, status=status.HTTP_200_OK if dry_run else status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post', ], url_path='alive', url_name='alive-many')
+    def alive_many(self, request):
+        '''
+        Run the same "alive" check as above against many NetworkDevices at once. The
+        devices are selected with a list of primary keys in the "ids" POST data parameter,
+        and/or the normal filters (for example "?site=xyz").
+
+        All of the pings run in parallel, and the results are streamed back to the client
+        as newline-delimited JSON (one object per device) in the order they complete. The
+        whole request is bounded by the "deadline" parameter: any device which has not
+        answered by then is reported with "alive": null.
+        '''
+        # deadline parameter (default: 10 seconds)
+        try:
+            deadline = int(request.GET.get('deadline', '10'))
+            deadline = clamp(deadline, 5, 30)
+        except Exception as ex:
+            data = make_simple_error(f'''unable to parse deadline="{request.GET.get('deadline', '')}" as integer''')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if not isinstance(request.data, dict):
+            data = make_simple_error('The POST data must be a JSON object')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        # precondition: refuse to ping the entire fleet by accident
+        ids = request.data.get('ids', None)
+        if ids is None and len(request.GET.get('site', '')) <= 0:
+            data = make_simple_error(f'The "ids" POST data parameter or "site" GET parameter is required')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if ids is not None:
+            try:
+                if not isinstance(ids, (list, tuple, )):
+                    raise TypeError('not a list')
+
+                ids = [int(pk) for pk in ids]
+            except (TypeError, ValueError) as ex:
+                data = make_simple_error(f'The "ids" POST data parameter must be a list of integers')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            queryset = queryset.filter(pk__in=ids)
+
+        # fetch hostname / ip address from all database records before we start streaming
+        targets = [(networkdevice.pk, networkdevice_ping_target(networkdevice)) for networkdevice in queryset]
+
+        def results():
+            # one worker per device (see settings.ALIVE_MAX_WORKERS), so that every ping runs at once
+            executor = ThreadPoolExecutor(max_workers=clamp(len(targets), 1, settings.ALIVE_MAX_WORKERS))
+            futures = {}
+
+            try:
+                for (pk, target) in targets:
+                    # whoops, the record is missing the sub-objects? What is going on?
+                    if target is None:
+                        data = {
+                            'id': pk,
+                            'alive': None,
+                            'error': f'No IP Address or Hostname for NetworkDevice pk={pk}',
+                        }
+                        yield json.dumps(data) + '\n'
+                        continue
+
+                    futures[executor.submit(ping_alive, target, deadline)] = pk
+
+                try:
+                    for future in as_completed(futures, timeout=(deadline + 5)):
+                        try:
+                            data = {
+                                'id': futures[future],
+                                'alive': future.result(),
+                            }
+                        except Exception as ex:
+                            data = {
+                                'id': futures[future],
+                                'alive': None,
+                                'error': str(ex),
+                            }
+
+                        yield json.dumps(data) + '\n'
+                except FuturesTimeoutError as ex:
+                    for (future, pk) in futures.items():
+                        if not future.done():
+                            data = {
+                                'id': pk,
+                                'alive': None,
+                                'error': f'Deadline of {deadline} seconds exceeded',
+                            }
+                            yield json.dumps(data) + '\n'
+            finally:
+                # don't start any pings which are still queued, and don't wait for stragglers
+                for future in futures:
+                    future.cancel()
+
+                executor.shutdown(wait=False)
+
+        return streaming_ndjson_response(results())
+
     @action(detail=True, methods=['get', 'post', ])
     def bootmode(self, request, pk=None):
         '''Toggle the PuppetMachine.boot_mode database field for this NetworkDevice'''
@@ -496,9 +1121,7 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
         networkdevice = self.get_object()
 
         # fetch hostname / ip address from database record
-        target = networkdevice.primary_staticip
-        if target is None:
-            target = networkdevice.primary_hostname
+        target = networkdevice_ping_target(networkdevice)
 
         # whoops, the record is missing the sub-objects? What is going on?
         if target is None:
@@ -549,6 +1172,14 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
             str(target),
         ]
 
+        # stream parameter (default: false)
+        try:
+            stream = request.GET.get('stream', 'false')
+            stream = parse_boolean(stream)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse "stream={stream}" as boolean (true/false)')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
         # Run the command, capturing all output into a single stream. Another hard
         # deadline on the execution time is added here too. This should never hit,
         # but will protect us just in case something else is going wrong in /bin/ping.
@@ -556,43 +1187,60 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
         # when the /bin/ping program terminates incorrectly (cannot reach the device).
         timeout = (deadline + 5)
         timeout = clamp(timeout, 5, 40)
+
+        # Send each line of output (newline-delimited JSON) as soon as ping produces it
+        if stream:
+            return streaming_ndjson_response(stream_command_output(cmd, timeout=timeout))
+
         proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False)
         return Response(data=proc.stdout, content_type='text/plain')
 
     @action(detail=True, methods=['get', ])
     def ipmi_chassis_status(self, request, pk=None):
-        '''IPMI chassis status'''
+        '''IPMI chassis status (cached by the background poller, unless ?refresh=true)'''
         networkdevice = self.get_object()
-        return run_ipmitool(networkdevice, command=['chassis', 'status', ], timeout=15)
+        return ipmi_status_response(request, networkdevice)
 
     @action(detail=True, methods=['get', ])
     def ipmi_power_status(self, request, pk=None):
-        '''Use IPMI to retrieve the power status of a NetworkDevice'''
+        '''Use IPMI to retrieve the power status of a NetworkDevice (cached, unless ?refresh=true)'''
         networkdevice = self.get_object()
-        return run_ipmitool(networkdevice, command=['power', 'status', ], timeout=15)
+        return ipmi_status_response(request, networkdevice, power_only=True)
 
     @action(detail=True, methods=['post', ])
     def ipmi_power_on(self, request, pk=None):
         '''Use IPMI to power on a NetworkDevice'''
         networkdevice = self.get_object()
+        invalidate_ipmi_status([networkdevice.pk, ])
         return run_ipmitool(networkdevice, command=['power', 'on', ], timeout=15)
 
     @action(detail=True, methods=['post', ])
     def ipmi_power_off(self, request, pk=None):
         '''Use IPMI to power off a NetworkDevice'''
         networkdevice = self.get_object()
+        invalidate_ipmi_status([networkdevice.pk, ])
         return run_ipmitool(networkdevice, command=['power', 'off', ], timeout=15)
 
     @action(detail=True, methods=['get', 'post'])
     def puppet_agent_test(self, request, pk=None):
-        '''Trigger a "puppet agent --test" run immediately on this NetworkDevice'''
+        '''
+        Trigger a "puppet agent --test" run immediately on this NetworkDevice
+
+        POST starts the run and returns the job_id. GET with the job_id parameter
+        polls for completion, and returns the tail of the output (see the start, limit
+        and tail parameters). Add the stream=true parameter to the GET request to
+        receive the output line by line (newline-delimited JSON) while Puppet runs.
+        '''
         # Fetch record from database
         networkdevice = self.get_object()
 
         # POST request starts a Puppet Agent run immediately
         if request.method == 'POST':
             queue = django_rq.get_queue()
-            job = queue.enqueue(run_puppet_agent_test, networkdevice_id=networkdevice.pk, job_timeout=3600)
+            remotejob = create_remote_job('puppet_agent_test', networkdevice_id=networkdevice.pk,
+                                          requested_by=request_identity(request))
+            job = queue.enqueue(run_puppet_agent_test, networkdevice_id=networkdevice.pk, job_id=remotejob.job_id,
+                                job_timeout=3600)
             data = {
                 'job_id': job.id,
                 'job_timeout': job.timeout,
@@ -613,12 +1261,129 @@ class NetworkDeviceViewSet(FlexFieldsModelViewSet):
                 data = make_simple_error(f'No RQ Job with job_id={job_id} found')
                 return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
+            # stream parameter (default: false)
+            try:
+                stream = request.GET.get('stream', 'false')
+                stream = parse_boolean(stream)
+            except ValueError as ex:
+                data = make_simple_error(f'unable to parse "stream={stream}" as boolean (true/false)')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            # Stream the output line by line (newline-delimited JSON) while Puppet runs
+            if stream:
+                return streaming_ndjson_response(stream_job_output(job))
+
+            # Only part of the output is returned (default: the last 100 lines), use
+            # the start/limit/tail parameters to read more
+            try:
+                (start, limit, tail) = parse_output_range(request.GET)
+            except ValueError as ex:
+                data = make_simple_error(f'unable to parse start/limit/tail parameters as integers')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            data = {
+                'status': job.get_status(),
+                'result': job.result,
+                'output': read_job_output(job.connection, job.id, start=start, limit=limit, tail=tail),
+            }
+            return Response(data)
+
+    @action(detail=False, methods=['get', 'post', ], url_path='puppet_batch', url_name='puppet-batch')
+    def puppet_batch(self, request):
+        '''
+        Roll out a "puppet agent --test" run across many NetworkDevices.
+
+        POST starts a batch, and returns the job_id of the batch coordinator. The
+        devices are selected with a list of primary keys in the "ids" POST data
+        parameter (run in that order), and/or the normal filters (for example
+        "?site=xyz"). Only Puppet managed devices are included. Other parameters:
+
+        canaries - run this many devices first, abort if any fail (default: 1)
+        max_parallel - maximum number of Puppet runs at once (default: 4)
+        max_failure_rate - abort when this fraction of runs fail (default: 0.25)
+
+        GET with the job_id parameter returns the aggregated status of the batch.
+        '''
+        queue = django_rq.get_queue('puppet_batch')
+
+        # GET request polls for status
+        if request.method == 'GET':
+            job_id = request.GET.get('job_id', None)
+            if job_id is None:
+                data = make_simple_error(f'GET parameter job_id is required')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            job = queue.fetch_job(job_id)
+            if job is None or job.origin != queue.name:
+                data = make_simple_error(f'No Puppet batch RQ Job with job_id={job_id} found')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
             data = {
                 'status': job.get_status(),
+                'batch': job.meta.get('batch', None),
                 'result': job.result,
             }
             return Response(data)
 
+        # POST request starts a new batch
+        if not isinstance(request.data, dict):
+            data = make_simple_error('The POST data must be a JSON object')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            canaries = int(request.data.get('canaries', 1))
+            canaries = clamp(canaries, 0, 10)
+            max_parallel = int(request.data.get('max_parallel', 4))
+            max_parallel = clamp(max_parallel, 1, 32)
+            max_failure_rate = float(request.data.get('max_failure_rate', 0.25))
+            max_failure_rate = clamp(max_failure_rate, 0.0, 1.0)
+        except (TypeError, ValueError) as ex:
+            data = make_simple_error(f'unable to parse canaries/max_parallel (integer) or max_failure_rate (number)')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        # precondition: refuse to run Puppet on the entire fleet by accident
+        ids = request.data.get('ids', None)
+        if ids is None and len(request.GET.get('site', '')) <= 0:
+            data = make_simple_error(f'The "ids" POST data parameter or "site" GET parameter is required')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.filter(puppetmachine__isnull=False)
+        if ids is not None:
+            try:
+                if not isinstance(ids, (list, tuple, )):
+                    raise TypeError('not a list')
+
+                ids = [int(pk) for pk in ids]
+            except (TypeError, ValueError) as ex:
+                data = make_simple_error(f'The "ids" POST data parameter must be a list of integers')
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+            queryset = queryset.filter(pk__in=ids)
+
+        # keep the order given by the client (the canaries come first), otherwise by primary key
+        selected = set(queryset.values_list('pk', flat=True))
+        if ids is not None:
+            networkdevice_ids = [pk for pk in dict.fromkeys(ids) if pk in selected]
+        else:
+            networkdevice_ids = sorted(selected)
+
+        if len(networkdevice_ids) <= 0:
+            data = make_simple_error(f'No Puppet managed NetworkDevices selected')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        job_timeout = puppet_batch_timeout(len(networkdevice_ids), max_parallel=max_parallel, canaries=canaries)
+        remotejob = create_remote_job('puppet_batch', requested_by=request_identity(request))
+        job = queue.enqueue(run_puppet_batch, networkdevice_ids=networkdevice_ids, max_parallel=max_parallel,
+                            canaries=canaries, max_failure_rate=max_failure_rate, job_id=remotejob.job_id,
+                            job_timeout=job_timeout)
+        data = {
+            'job_id': job.id,
+            'job_timeout': job.timeout,
+            'networkdevice_ids': networkdevice_ids,
+        }
+        return Response(data)
+
 class UnrecognizedPXEDeviceFilterSet(filters.FilterSet):
     class Meta:
         model = UnrecognizedPXEDevice
@@ -640,9 +1405,68 @@ class UnrecognizedPXEDeviceViewSet(FlexFieldsModelViewSet):
     )
     filter_class = UnrecognizedPXEDeviceFilterSet
 
+def history_stats_response(request, kind):
+    '''
+    Return a DRF Response with the boot/build history counts over a time range,
+    read from the precomputed rollups (see machineconfig.rollups).
+
+    Parameters:
+    start - ISO 8601 date or date and time: start of the range (default: 30 days before the end)
+    end - ISO 8601 date or date and time: end of the range (default: now)
+    bucket - the bucket size: hour, day, week or month (default: day)
+    site - only count history for this Site code (default: all Sites)
+    '''
+    bucket = request.GET.get('bucket', 'day')
+    if bucket not in STATS_BUCKETS:
+        data = make_simple_error(f'unable to parse bucket="{bucket}": valid values are {", ".join(STATS_BUCKETS)}')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    times = {}
+    for name in ('start', 'end', ):
+        value = request.GET.get(name, None)
+        if value is None:
+            continue
+
+        # either a full date and time, or a date (midnight)
+        try:
+            times[name] = parse_datetime(value)
+            if times[name] is None and parse_date(value) is not None:
+                times[name] = datetime.datetime.combine(parse_date(value), datetime.time())
+        except ValueError as ex:
+            times[name] = None
+
+        if times[name] is None:
+            data = make_simple_error(f'unable to parse {name}="{value}" as an ISO 8601 date and time')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if timezone.is_naive(times[name]):
+            times[name] = timezone.make_aware(times[name], datetime.timezone.utc)
+
+    end = times.get('end', timezone.now())
+    start = times.get('start', end - datetime.timedelta(days=30))
+    if start >= end:
+        data = make_simple_error('start must be before end')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    max_days = HISTORY_STATS_MAX_DAYS[bucket]
+    if (end - start) > datetime.timedelta(days=max_days):
+        data = make_simple_error(f'time range is too long for bucket="{bucket}": maximum is {max_days} days')
+        return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+    site = request.GET.get('site', None)
+    data = {
+        'kind': kind,
+        'bucket': bucket,
+        'start': start,
+        'end': end,
+        'site': site,
+        'results': rollup_stats(kind, start, end, bucket=bucket, site=site),
+    }
+    return Response(data)
+
 class BootHistoryFilterSet(filters.FilterSet):
     # Filter by Site code
-    site = filters.CharFilter(field_name='puppetmachine__networkdevice__site__code', lookup_expr='iexact')
+    site = filters.CharFilter(field_name='site__code', lookup_expr='iexact')
 
     class Meta:
         model = BootHistory
@@ -663,7 +1487,15 @@ class BootHistoryViewSet(FlexFieldsModelViewSet):
     )
     filter_class = BootHistoryFilterSet
 
+    @action(detail=False, methods=['get', ], url_path='stats')
+    def stats(self, request):
+        '''Boot counts per boot mode over time (see history_stats_response)'''
+        return history_stats_response(request, 'boot')
+
 class BuildHistoryFilterSet(filters.FilterSet):
+    # Filter by Site code
+    site = filters.CharFilter(field_name='site__code', lookup_expr='iexact')
+
     class Meta:
         model = BuildHistory
         fields = {
@@ -683,4 +1515,149 @@ class BuildHistoryViewSet(FlexFieldsModelViewSet):
     )
     filter_class = BuildHistoryFilterSet
 
+    @action(detail=False, methods=['get', ], url_path='stats')
+    def stats(self, request):
+        '''Build counts per status over time (see history_stats_response)'''
+        return history_stats_response(request, 'build')
+
+class RemoteJobFilterSet(filters.FilterSet):
+    # Filter by Site code
+    site = filters.CharFilter(field_name='networkdevice__site__code', lookup_expr='iexact')
+
+    # Sort by time or duration (for example: ?ordering=-duration to find slow hosts)
+    ordering = filters.OrderingFilter(fields=(
+        ('enqueued_at', 'enqueued_at'),
+        ('duration', 'duration'),
+    ))
+
+    class Meta:
+        model = RemoteJob
+        fields = {
+            'networkdevice': [ 'exact', ],
+            'kind': [ 'exact', ],
+            'status': [ 'exact', ],
+            'requested_by': [ 'exact', ],
+            'returncode': [ 'exact', ],
+            'enqueued_at': [ 'exact', 'lte', 'gte', ],
+            'duration': [ 'lte', 'gte', ],
+        }
+
+class RemoteJobPagination(LimitOffsetPagination):
+    # The job history grows forever, so never return all of it at once
+    default_limit = 100
+    max_limit = 1000
+
+class RemoteJobViewSet(FlexFieldsModelViewSet):
+    queryset = RemoteJob.objects.order_by('-enqueued_at')
+    serializer_class = RemoteJobSerializer
+    http_method_names = ['get', 'head', 'options', ]
+    permit_list_expands = [
+        'networkdevice',
+    ]
+    filter_backends = (
+        filters.DjangoFilterBackend,
+    )
+    filter_class = RemoteJobFilterSet
+    pagination_class = RemoteJobPagination
+
+class IPReservationFilterSet(filters.FilterSet):
+    # Filter by Site code
+    site = filters.CharFilter(field_name='site__code', lookup_expr='iexact')
+    # Filter for "Is a temporary hold?"
+    temporary = filters.BooleanFilter(field_name='expires_at', lookup_expr='isnull', exclude=True)
+
+    class Meta:
+        model = IPReservation
+        fields = {
+            'expires_at': [ 'lte', 'gte', ],
+        }
+
+class IPReservationViewSet(FlexFieldsModelViewSet):
+    queryset = IPReservation.objects.all()
+    serializer_class = IPReservationSerializer
+    permit_list_expands = [
+        'site',
+    ]
+    filter_backends = (
+        filters.DjangoFilterBackend,
+    )
+    filter_class = IPReservationFilterSet
+
+class ChangeViewSet(viewsets.ViewSet):
+    '''
+    Delta sync: the Sites and NetworkDevices which changed since a version, oldest
+    change first (see machineconfig.changes). Each object is returned once, with
+    the same representation as /api/site/<pk>/ and /api/networkdevice/<pk>/, or
+    as a tombstone if it was deleted.
+
+    /api/changes/?since=0 (everything)
+    /api/changes/?since=1234&limit=100
+
+    Repeat with since=<version> from the response, until "more" is false.
+    '''
+
+    def list(self, request):
+        try:
+            since = int(request.GET.get('since', 0))
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse since="{request.GET.get("since")}" as an integer')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = clamp(int(request.GET.get('limit', CHANGES_DEFAULT_LIMIT)), 1, CHANGES_MAX_LIMIT)
+        except ValueError as ex:
+            data = make_simple_error(f'unable to parse limit="{request.GET.get("limit")}" as an integer')
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        # a version from the future (a restored database?) means the local mirror must start over
+        version = latest_version()
+        if since < 0 or since > version:
+            data = make_simple_error(f'since={since} is not a known version (latest: {version}), sync again from since=0')
+            return Response(data, status=status.HTTP_410_GONE)
+
+        (changes, more) = changes_since(since, limit=limit)
+        pks = {object_type: [] for (object_type, name) in ChangeLog.OBJECT_TYPE_CHOICES}
+        for change in changes:
+            if not change.deleted:
+                pks[change.object_type].append(change.object_id)
+
+        context = {'request': request, }
+        objects = {'site': {}, 'networkdevice': {}, }
+
+        queryset = Site.objects.filter(pk__in=pks['site'])
+        for item in SiteSerializer(queryset, many=True, context=context).data:
+            objects['site'][item['id']] = item
+
+        select_related = set()
+        prefetch_related = set()
+        for field in NetworkDeviceSerializer.Meta.fields:
+            select_related.update(NETWORKDEVICE_SELECT_RELATED.get(field, ()))
+            prefetch_related.update(NETWORKDEVICE_PREFETCH_RELATED.get(field, ()))
+
+        queryset = NetworkDevice.objects.filter(pk__in=pks['networkdevice'])
+        queryset = queryset.select_related(*sorted(select_related)).prefetch_related(*sorted(prefetch_related))
+        for item in NetworkDeviceSerializer(queryset, many=True, context=context).data:
+            objects['networkdevice'][item['id']] = item
+
+        results = []
+        for change in changes:
+            # deleted since the ChangeLog was read: its tombstone comes with a later version
+            item = objects[change.object_type].get(change.object_id, None)
+            results.append({
+                'version': change.version,
+                'type': change.object_type,
+                'id': change.object_id,
+                'deleted': item is None,
+                'changed_at': change.changed_at,
+                'data': item,
+            })
+
+        data = {
+            'since': since,
+            'version': changes[-1].version if len(changes) > 0 else since,
+            'more': more,
+            'changes': results,
+        }
+        return Response(data)
+
 # vim: set ts=4 sts=4 sw=4 et tw=120: